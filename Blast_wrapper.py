@@ -1,19 +1,95 @@
 #!/usr/bin/env python3
 import os
+import mmap
+import json
+import fcntl
+import logging
+import shutil
+import hashlib
+import tempfile as tmp
+from bisect import bisect_left
 from operator import itemgetter
 from collections import defaultdict, namedtuple
-from shared_code_box import run_cmd
+from shared_code_box import run_cmd, hash_fasta
 
 
-def make_blast_db(genome, temp_dir):
-    name = genome.split("/")[-1]
-    out_dir = os.path.join(temp_dir, name)
-    if os.path.exists(out_dir + ".nhr"):
-        print("\n\t[-] BLAST db already exists:\t{}\n".format(os.path.join(temp_dir, name)))
-        return out_dir
-    command = "makeblastdb -in " + genome + " -dbtype nucl -parse_seqids -out " + out_dir
-    run_cmd(command=command, wait=True)
-    return out_dir
+Region = namedtuple('Region', 'contig, s_start, s_end, strand, chunk_cov, query_cov, q_len')
+
+
+makeblastdb_options = ["-dbtype", "nucl", "-parse_seqids"]
+
+
+def get_genome_checksum(genome, cache_dir):
+    """sha256 of the genome content; remembered in the cache directory by path, size and modification time, so an
+    unchanged genome is only read once"""
+    stat = os.stat(genome)
+    signature = [os.path.abspath(genome), stat.st_size, stat.st_mtime_ns]
+    memo_file = os.path.join(cache_dir, "checksums", hashlib.sha1(signature[0].encode()).hexdigest() + ".json")
+    try:
+        with open(memo_file) as memo:
+            memo_entry = json.load(memo)
+        if memo_entry["signature"] == signature:
+            return memo_entry["sha256"]
+    except (IOError, ValueError, KeyError):
+        pass
+    checksum = hashlib.sha256()
+    with open(genome, "rb") as genome_f:
+        for block in iter(lambda: genome_f.read(1 << 24), b""):
+            checksum.update(block)
+    os.makedirs(os.path.dirname(memo_file), exist_ok=True)
+    with open(memo_file + ".{}.tmp".format(os.getpid()), "w") as memo:
+        json.dump({"signature": signature, "sha256": checksum.hexdigest()}, memo)
+    os.replace(memo_file + ".{}.tmp".format(os.getpid()), memo_file)
+    return checksum.hexdigest()
+
+
+def validate_blast_db(db_dir):
+    """True if db_dir holds a completely built database: the marker written after makeblastdb lists all volume
+    files with their sizes"""
+    try:
+        with open(os.path.join(db_dir, "GenePS_blast_db.json")) as marker:
+            volumes = json.load(marker)["volumes"]
+    except (IOError, ValueError, KeyError):
+        return False
+    return bool(volumes) and all([os.path.isfile(os.path.join(db_dir, name)) and os.path.getsize(os.path.join(db_dir, name)) == size
+                                  for name, size in volumes.items()])
+
+
+def make_blast_db(genome, cache_dir):
+    """returns the path of the BLAST database of genome in cache_dir, keyed by genome checksum and makeblastdb
+    options. Databases are built in a temporary directory and renamed when complete; a lock file makes concurrent
+    runs wait for the first one instead of building the same genome twice."""
+    os.makedirs(cache_dir, exist_ok=True)
+    options_hash = hashlib.sha256(" ".join(makeblastdb_options).encode()).hexdigest()
+    key = "{}_{}".format(get_genome_checksum(genome, cache_dir)[:24], options_hash[:8])
+    db_dir = os.path.join(cache_dir, key)
+    db_path = os.path.join(db_dir, "genome")
+    if validate_blast_db(db_dir):
+        print("\n\t[-] BLAST db already exists:\t{}\n".format(db_path))
+        return db_path
+    with open(os.path.join(cache_dir, key + ".lock"), "w") as lock_f:
+        fcntl.flock(lock_f, fcntl.LOCK_EX)
+        try:
+            if validate_blast_db(db_dir):   # built by a concurrent run meanwhile
+                return db_path
+            if os.path.exists(db_dir):
+                shutil.rmtree(db_dir)   # left over by an interrupted or failed build
+            build_dir = tmp.mkdtemp(prefix=key + ".", dir=cache_dir)
+            try:
+                command = ["makeblastdb", "-in", os.path.abspath(genome)] + makeblastdb_options + ["-out", os.path.join(build_dir, "genome")]
+                run_cmd(command=command, wait=True)   # raises ToolCallError if makeblastdb failed or was killed
+                volumes = {name: os.path.getsize(os.path.join(build_dir, name)) for name in os.listdir(build_dir)}
+                if not [name for name in volumes if name.endswith((".nhr", ".nal"))]:
+                    raise Exception("[!] makeblastdb failed for {}".format(genome))
+                with open(os.path.join(build_dir, "GenePS_blast_db.json"), "w") as marker:
+                    json.dump({"genome": os.path.abspath(genome), "options": makeblastdb_options, "volumes": volumes}, marker)
+                os.rename(build_dir, db_dir)
+            finally:
+                if os.path.exists(build_dir):
+                    shutil.rmtree(build_dir)
+        finally:
+            fcntl.flock(lock_f, fcntl.LOCK_UN)
+    return db_path
 
 
 def parse_blastdb(db_path, contig, start, end):
@@ -27,6 +103,155 @@ def parse_blastdb(db_path, contig, start, end):
     return "".join(results)
 
 
+def get_seqid_aliases(name):
+    """other names tblastn may report (sacc of a -parse_seqids database) for a fasta id: the accession without
+    version (NC_003279.8 -> NC_003279) and, for NCBI style ids (gi|25|ref|NC_003279.8|), the fields of the id"""
+    fields = [name] + [field for field in name.split("|") if field and not (len(field) <= 3 and field.islower())]
+    aliases = set(fields)
+    for field in fields:
+        accession, dot, version = field.rpartition(".")
+        if dot and version.isdigit():
+            aliases.add(accession)
+    aliases.discard(name)
+    return aliases
+
+
+class GenomeIndexObject:
+    """faidx style index (name, length, offset, bases per line, bytes per line) of a genome fasta file. The index is
+    written once to index_path (samtools compatible, e.g. next to the BLAST database in the cache) or only kept in
+    memory without index_path. Regions are sliced from a read-only memory map of the genome, so no process is started
+    per region. Worker processes open their own map."""
+
+    def __init__(self, genome_path, index_path=None):
+        self.genome_path = genome_path
+        self.index_path = index_path
+        self.contig_to_entry = {}
+        self.alias_to_contig = {}
+        self.genome_map = None
+        self.genome_map_pid = None
+
+    def load(self):
+        index_path = self.index_path
+        if index_path is None or not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(self.genome_path):
+            entries = index_genome_fasta(self.genome_path)
+            if index_path is not None:
+                with open(index_path + ".{}.tmp".format(os.getpid()), "w") as index_f:
+                    for entry in entries:
+                        index_f.write("\t".join([str(field) for field in entry]) + "\n")
+                os.replace(index_path + ".{}.tmp".format(os.getpid()), index_path)
+        else:
+            with open(index_path) as index_f:
+                entries = [line.rstrip("\n").split("\t") for line in index_f if line.strip()]
+        alias_to_contigs = defaultdict(set)
+        for name, length, offset, line_bases, line_bytes in entries:
+            self.contig_to_entry[name] = (int(length), int(offset), int(line_bases), int(line_bytes))
+            for alias in get_seqid_aliases(name):
+                alias_to_contigs[alias].add(name)
+        self.alias_to_contig = {alias: contigs.pop() for alias, contigs in alias_to_contigs.items()
+                                if len(contigs) == 1 and alias not in self.contig_to_entry}
+        return self
+
+    def has_contig(self, contig):
+        return contig in self.contig_to_entry or contig in self.alias_to_contig
+
+    def get_entry(self, contig):
+        """index entry of a fasta id or of a name tblastn reports for it"""
+        return self.contig_to_entry[self.alias_to_contig.get(contig, contig)]
+
+    def get_genome_map(self):
+        if self.genome_map is None or self.genome_map_pid != os.getpid():
+            with open(self.genome_path, "rb") as genome_f:
+                self.genome_map = mmap.mmap(genome_f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.genome_map_pid = os.getpid()
+        return self.genome_map
+
+    def get_byte_position(self, entry, position):
+        """byte position of the 0-based sequence position"""
+        length, offset, line_bases, line_bytes = entry
+        return offset + (position // line_bases) * line_bytes + position % line_bases
+
+    def get_contig_length(self, contig):
+        return self.get_entry(contig)[0]
+
+    def get_region(self, contig, start, end):
+        """sequence (upper case, like blastdbcmd) of contig from start to end (1-based, inclusive); end is clamped
+        to the contig end"""
+        entry = self.get_entry(contig)
+        end = min(end, entry[0])
+        if end < start:
+            return ""
+        genome_map = self.get_genome_map()
+        region = genome_map[self.get_byte_position(entry, start - 1):self.get_byte_position(entry, end - 1) + 1]
+        return region.replace(b"\n", b"").replace(b"\r", b"").decode().upper()
+
+
+def index_genome_fasta(genome_path):
+    """faidx entries (name, length, offset, bases per line, bytes per line) of all sequences; raises a ValueError
+    if the lines of a sequence differ in length (except the last one) as samtools does. The last line of the file
+    may lack its newline."""
+    entries = []
+    name, length, offset, line_bases, line_bytes, last_line = None, 0, 0, 0, 0, False
+    position = 0
+    with open(genome_path, "rb") as genome_f:
+        for line in genome_f:
+            if line.startswith(b">"):
+                if name is not None:
+                    entries.append((name, length, offset, line_bases, line_bytes))
+                name = line[1:].strip().split()[0].decode()
+                length, offset, line_bases, line_bytes, last_line = 0, position + len(line), 0, 0, False
+            else:
+                bases = len(line.rstrip(b"\r\n"))
+                uneven_ending = bases == line_bases and len(line) != line_bytes and line.endswith(b"\n")
+                if bases and (last_line or bases > line_bases > 0 or uneven_ending):
+                    raise ValueError("[!] {}: lines of {} differ in length; reformat the genome to equal line lengths".format(genome_path, name))
+                if not line_bases:
+                    line_bases, line_bytes = bases, len(line)
+                if bases < line_bases or not bases:
+                    last_line = True
+                length += bases
+            position += len(line)
+    if name is not None:
+        entries.append((name, length, offset, line_bases, line_bytes))
+    return entries
+
+
+genome_indices = {}
+genome_to_blast_db = {}
+
+
+def get_genome_index(genome_path, blast_db=None):
+    """index of a genome fasta file, built (or read) once per genome and process; fork workers inherit it. With the
+    BLAST database of the genome (make_blast_db), the index is stored next to it in the cache and regions the index
+    cannot serve are read from the database. Returns None for genomes with uneven line lengths (blastdbcmd only)."""
+    if blast_db is not None:
+        genome_to_blast_db[genome_path] = blast_db
+    if genome_path not in genome_indices:
+        index_path = os.path.join(os.path.dirname(blast_db), "genome.fai") if blast_db is not None else None
+        try:
+            genome_indices[genome_path] = GenomeIndexObject(genome_path, index_path).load()
+        except ValueError as error:
+            logging.getLogger("Tools").warning("{}; regions are read with blastdbcmd".format(error))
+            genome_indices[genome_path] = None
+    return genome_indices[genome_path]
+
+
+def extract_region(db_path, contig, start, end):
+    """region of a contig from the genome fasta file (memory mapped); blastdbcmd is used if db_path is just a BLAST
+    database without the fasta file, or for contigs the index of the genome does not know"""
+    if os.path.isfile(db_path):
+        genome_index = get_genome_index(db_path)
+        if genome_index is not None and genome_index.has_contig(contig):
+            return genome_index.get_region(contig, start, end)
+        if db_path not in genome_to_blast_db:
+            raise KeyError("[!] {} is not a sequence of {}".format(contig, db_path))
+        db_path = genome_to_blast_db[db_path]
+    return parse_blastdb(db_path, contig, start, end)
+
+
+def region_to_fasta(db_path, region):
+    return ">{}\n{}".format(region.contig, extract_region(db_path, region.contig, region.s_start, region.s_end))
+
+
 def set_min_start(position):
     if position < 0:
         return 1
@@ -34,6 +259,12 @@ def set_min_start(position):
         return position
 
 
+chain_query_overlap = 10     # aa two HSPs of a chain may overlap on the query (e.g. at exon borders)
+chain_query_gap_cost = 0.5   # per aa of the query repeated between two HSPs of a chain, or skipped without room on the subject
+chain_subject_gap_cost = 0.001   # per bp between two HSPs of a chain on the subject
+chain_max_predecessors = 50  # closest HSPs within the merging distance tried as predecessor of an HSP
+
+
 class HspListObject:
     def __init__(self, subject_hsp_list, merging_dist):
         self.merge_dist = merging_dist
@@ -57,7 +288,7 @@ class HspListObject:
 
     def sort_hsp_list(self):
         for hsp_x in self.hsp_list:
-            if hsp_x["strand"] == "-":
+            if hsp_x["strand"] == "-" and hsp_x["s_start"] > hsp_x["s_end"]:
                 s_start = hsp_x["s_start"]
                 hsp_x["s_start"] = hsp_x["s_end"]
                 hsp_x["s_end"] = s_start
@@ -95,6 +326,68 @@ class HspListObject:
             all_merged_regions.append([len(self.hsp_sorted) - 1])
         return all_merged_regions
 
+    def chain_hsps(self, idx_list, reverse):
+        """sparse chaining DP: the score of an HSP is its aligned query length plus the best chain score of a
+        predecessor ending at most merge_dist bp before it, minus gap costs. Predecessors are found by bisect on the
+        HSP ends and must be collinear on the query. Skipped query positions (exons without Blast hit) only cost if
+        the subject gap is too short to code for them. Chains are traced back from the best scoring HSP; a trace
+        stops at HSPs which are already part of a better chain"""
+        if reverse:     # the query runs from high to low subject positions on the minus strand
+            anchors = sorted([(-self.s_end[idx], -self.s_start[idx], idx) for idx in idx_list], key=itemgetter(1, 0))
+        else:
+            anchors = sorted([(self.s_start[idx], self.s_end[idx], idx) for idx in idx_list], key=itemgetter(1, 0))
+        ends = [anchor[1] for anchor in anchors]
+        scores, predecessors = [], []
+        for pos, (start, end, idx) in enumerate(anchors):
+            best_score, best_pos = 0, None
+            first_pos = bisect_left(ends, start - self.merge_dist, 0, pos)
+            last_pos = bisect_left(ends, start, 0, pos)
+            for prev_pos in range(last_pos - 1, max(first_pos, last_pos - chain_max_predecessors) - 1, -1):
+                query_gap = self.q_start[idx] - self.q_end[anchors[prev_pos][2]] - 1
+                if query_gap < -chain_query_overlap:
+                    continue
+                subject_gap = start - ends[prev_pos] - 1
+                missing_query = max(0, query_gap - subject_gap // 3) if query_gap >= 0 else -query_gap
+                chain_score = scores[prev_pos] - chain_query_gap_cost * missing_query - chain_subject_gap_cost * subject_gap
+                if chain_score > best_score:
+                    best_score, best_pos = chain_score, prev_pos
+            scores.append(best_score + self.q_end[idx] - self.q_start[idx] + 1)
+            predecessors.append(best_pos)
+        used = [False] * len(anchors)
+        chains = []
+        for pos in sorted(range(len(anchors)), key=lambda x: scores[x], reverse=True):
+            chain = []
+            while pos is not None and not used[pos]:
+                used[pos] = True
+                chain.append(anchors[pos][2])
+                pos = predecessors[pos]
+            if chain:
+                chains.append(sorted(chain))
+        return chains
+
+    def join_overlapping_chains(self, chains):
+        """chains overlapping on the subject (e.g. HSPs of different frames at one locus) become one region"""
+        joined_chains = []
+        joined_end = None
+        for chain in sorted(chains, key=lambda x: self.s_start[x[0]]):
+            chain_end = max([self.s_end[idx] for idx in chain])
+            if joined_chains and self.s_start[chain[0]] <= joined_end:
+                joined_chains[-1] = sorted(joined_chains[-1] + chain)
+                joined_end = max(joined_end, chain_end)
+            else:
+                joined_chains.append(chain)
+                joined_end = chain_end
+        return joined_chains
+
+    def chain_to_region(self):
+        """alternative to merge_to_region: one region per collinear HSP chain, so that tandem copies of a gene get
+        separate regions; returns lists of indices of the sorted HSPs"""
+        all_chained_regions = []
+        for strand in sorted(set(self.strand)):
+            idx_list = [idx for idx in range(len(self.hsp_sorted)) if self.strand[idx] == strand]
+            all_chained_regions.extend(self.join_overlapping_chains(self.chain_hsps(idx_list, strand == "-")))
+        return all_chained_regions
+
     def compute_coverage(self, q_start_pos, q_end_pos, q_length):
         q_starts, q_ends = zip(*sorted(zip(q_start_pos, q_end_pos)))
         aligned_bits_sum = 0
@@ -114,51 +407,95 @@ class HspListObject:
         return chunck_cov, query_cov
 
 
+default_merging_distance = 10000
+default_flanking_distance = 5000
+
+
 class BlastObject:
-    def __init__(self, blast_out, db_path, merging_dist=10000, flanking_dist=5000):
+    def __init__(self, blast_out, db_path, merging_dist=default_merging_distance, flanking_dist=default_flanking_distance):
         self.blast_out = blast_out
         self.db_path = db_path
         self.merging_distance = merging_dist
         self.flanking_distance = flanking_dist
+        self.query_to_distances = {}
         self.inferred_regions = None
         self.amount_regions = None
-        self.region_tuple_to_fasta = {}
-        self.fasta_region = {} #GK 
 
     def adjust_oversized_end_pos(self, region_seq, start_position):
         return len(region_seq) + start_position - 1
 
-    def infer_regions(self):
+    def get_region_end(self, contig, start, end):
+        """end of a region clamped to the contig end"""
+        if os.path.isfile(self.db_path):
+            genome_index = get_genome_index(self.db_path)
+            if genome_index is not None and genome_index.has_contig(contig):
+                return min(end, genome_index.get_contig_length(contig))
+        return self.adjust_oversized_end_pos(extract_region(self.db_path, contig, start, end), start)
+
+    def get_region_fasta(self, region):
+        """fasta string of a region; regions are kept as coordinates and their sequence is read on demand"""
+        return region_to_fasta(self.db_path, region)
+
+    def get_distances(self, query):
+        """merging and flanking distance of the regions of a query"""
+        return self.query_to_distances.get(query, (self.merging_distance, self.flanking_distance))
+
+    def infer_regions(self, query_to_distances=None, chain_hsps=False):
+        """merges the HSPs of each query into regions and adds flanks; query_to_distances: query: (merging distance,
+        flanking distance) for queries which do not use the defaults of the object; with chain_hsps, regions are
+        collinear HSP chains instead of HSPs closer than the merging distance"""
+        if query_to_distances is not None:
+            self.query_to_distances = query_to_distances
         self.amount_regions = 0
         inferred_regions = {}
-        Region = namedtuple('Region', 'contig, s_start, s_end, strand, chunk_cov, query_cov, q_len')
         for subject in self.blast_out:
             if subject not in inferred_regions:
                 inferred_regions[subject] = defaultdict(list)
             for query in self.blast_out[subject]:
                 hsp_list = self.blast_out[subject][query]
-                hits = HspListObject(hsp_list, self.merging_distance)
+                merging_distance, flanking_distance = self.get_distances(query)
+                hits = HspListObject(hsp_list, merging_distance)
                 hits.sort_hsp_list()
-                idx_all_merged_regions = hits.merge_to_region()
+                if chain_hsps:
+                    idx_all_merged_regions = hits.chain_to_region()
+                else:
+                    idx_all_merged_regions = hits.merge_to_region()
                 self.amount_regions += len(idx_all_merged_regions)
                 for region in idx_all_merged_regions:
                     begin, stop = region[0], region[-1]
                     strand = hits.strand[begin]
-                    s_start = set_min_start(hits.s_start[begin] - self.flanking_distance)
-                    fictive_s_end = hits.s_end[stop] + self.flanking_distance   # contig may be shorter
-                    fasta_str = parse_blastdb(self.db_path, subject, s_start, fictive_s_end)
-                    s_end = self.adjust_oversized_end_pos(fasta_str, s_start)
-                    q_start_pos = hits.q_start[begin:stop + 1]
-                    q_end_pos = hits.q_end[begin:stop + 1]
+                    s_start = set_min_start(hits.s_start[begin] - flanking_distance)
+                    if chain_hsps:
+                        stop = max(region, key=lambda idx: hits.s_end[idx])
+                    fictive_s_end = hits.s_end[stop] + flanking_distance   # contig may be shorter
+                    s_end = self.get_region_end(subject, s_start, fictive_s_end)
+                    q_start_pos = [hits.q_start[idx] for idx in region]
+                    q_end_pos = [hits.q_end[idx] for idx in region]
                     chunk_cov, query_cov = hits.compute_coverage(q_start_pos, q_end_pos, hits.q_len[0])
                     region = Region(contig=subject, s_start=s_start, s_end=s_end, strand=strand,
                                     chunk_cov=chunk_cov, query_cov=query_cov, q_len=hits.q_len[0])
                     inferred_regions[subject][query].append(region)
-                    self.region_tuple_to_fasta[region] = ">{}\n{}".format(subject, fasta_str)
-                    self.fasta_region[region] = "{}".format(fasta_str) #GK
         self.inferred_regions = inferred_regions
 
 
+def parse_blast_line(line):
+    """query, subject and hit row of a tabular (outfmt 7) tblastn line"""
+    line = line.strip("\n").split("\t")
+    if "-" in line[8]:
+        strand = "-"
+    else:
+        strand = "+"
+    row = {"contig": line[1],
+           "evalue": float(line[2]),
+           "q_start": int(line[3]),
+           "q_end": int(line[4]),
+           "s_start": int(line[5]),
+           "s_end": int(line[6]),
+           "q_len": int(line[7]),
+           "strand": strand}
+    return line[0], line[1], row
+
+
 def read_blast_output(blast_file, db_path):
     blast_dict = {}
     results_flag = False
@@ -166,21 +503,7 @@ def read_blast_output(blast_file, db_path):
         for line in blast_f:
             if not line.startswith("#"):
                 results_flag = True
-                line = line.strip("\n").split("\t")
-                if "-" in line[8]:
-                    strand = "-"
-                else:
-                    strand = "+"
-                query = line[0]
-                subject = line[1]
-                row = {"contig": subject,
-                       "evalue": float(line[2]),
-                       "q_start": int(line[3]),
-                       "q_end": int(line[4]),
-                       "s_start": int(line[5]),
-                       "s_end": int(line[6]),
-                       "q_len": int(line[7]),
-                       "strand": strand}
+                query, subject, row = parse_blast_line(line)
                 if subject not in blast_dict:
                     blast_dict[subject] = defaultdict(list)
                 blast_dict[subject][query].append(row)
@@ -191,11 +514,115 @@ def read_blast_output(blast_file, db_path):
         return None
 
 
-def run_tblastn(db_path, q_file, file_location):
-    command = ["tblastn", "-query", q_file, "-db", db_path, "-outfmt",
-               """7 qacc sacc evalue qstart qend sstart send qlen sframe""", "-evalue", "1e-1", "-out", file_location]
+tblastn_options = ["-outfmt", "7 qacc sacc evalue qstart qend sstart send qlen sframe", "-evalue", "1e-1"]
+
+
+def get_tblastn_cache_file(cache_dir, q_file, genome_checksum):
+    """tblastn results only depend on the queries, the genome and the options; the cache file name is a sha256
+    over all three"""
+    key = hashlib.sha256()
+    with open(q_file, "rb") as query_f:
+        key.update(query_f.read())
+    key.update(genome_checksum.encode())
+    key.update(" ".join(tblastn_options).encode())
+    return os.path.join(cache_dir, "tblastn", key.hexdigest() + ".json")
+
+
+def load_tblastn_cache(cache_file, genome_path):
+    """returns (True, BlastObject or None if tblastn found no hits) for cached results, else (False, None)"""
+    try:
+        with open(cache_file) as cache_f:
+            blast_dict = json.load(cache_f)["blast_out"]
+    except (IOError, ValueError, KeyError):
+        return False, None
+    if not blast_dict:
+        return True, None
+    return True, BlastObject(blast_dict, genome_path)
+
+
+def store_tblastn_cache(cache_file, blast_obj):
+    """writes the parsed HSP table of blast_obj (empty if None)"""
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file + ".{}.tmp".format(os.getpid()), "w") as cache_f:
+        json.dump({"blast_out": blast_obj.blast_out if blast_obj is not None else {}}, cache_f)
+    os.replace(cache_file + ".{}.tmp".format(os.getpid()), cache_file)
+
+
+def run_tblastn(db_path, q_file, file_location, genome_path=None, cache_dir=None):
+    """tblastn against db_path; regions of the returned BlastObject are read from genome_path (default: db_path).
+    With cache_dir, results are taken from or written to the tblastn cache."""
+    genome_path = genome_path or db_path
+    if cache_dir:
+        cache_file = get_tblastn_cache_file(cache_dir, q_file, get_genome_checksum(genome_path, cache_dir))
+        cached, blast_obj = load_tblastn_cache(cache_file, genome_path)
+        if cached:
+            return blast_obj
+    command = ["tblastn", "-query", q_file, "-db", db_path] + tblastn_options + ["-out", file_location]
     run_cmd(command=command, wait=True)
-    return read_blast_output(file_location, db_path)
+    blast_obj = read_blast_output(file_location, genome_path)
+    if cache_dir:
+        store_tblastn_cache(cache_file, blast_obj)
+    return blast_obj
+
+
+def write_tagged_query_file(group_to_query_file, query_file):
+    """writes the queries of all groups into one fasta file with headers GenePSq<idx>; returns a dict
+    tag: (group, query name)"""
+    tag_to_group_query = {}
+    with open(query_file, "w") as q_file:
+        for group, group_query_file in group_to_query_file.items():
+            for header, sequence in hash_fasta(group_query_file).items():
+                tag = "GenePSq{}".format(len(tag_to_group_query))
+                tag_to_group_query[tag] = (group, header[1:])
+                q_file.write(">{}\n{}\n".format(tag, "".join(sequence)))
+    return tag_to_group_query
+
+
+def read_tagged_blast_output(blast_file, db_path, tag_to_group_query):
+    """splits the output of a tblastn run with tagged queries into one BlastObject per group (groups without hits
+    are missing)"""
+    group_to_blast_dict = defaultdict(dict)
+    with open(blast_file) as blast_f:
+        for line in blast_f:
+            if not line.startswith("#"):
+                tag, subject, row = parse_blast_line(line)
+                group, query = tag_to_group_query[tag]
+                if subject not in group_to_blast_dict[group]:
+                    group_to_blast_dict[group][subject] = defaultdict(list)
+                group_to_blast_dict[group][subject][query].append(row)
+    return {group: BlastObject(blast_dict, db_path) for group, blast_dict in group_to_blast_dict.items()}
+
+
+def run_tblastn_all_groups(db_path, group_to_query_file, file_location, genome_path=None, cache_dir=None, threads=None):
+    """one tblastn run for the queries of all groups (the database is scanned once instead of once per group);
+    it runs with 'threads' threads (default: set by the tool scheduler, --tool_threads). Returns a dict group:
+    BlastObject. With cache_dir, results are cached per group (shared with run_tblastn) and only uncached groups
+    are searched."""
+    genome_path = genome_path or db_path
+    group_to_blast_obj = {}
+    group_to_cache_file = {}
+    if cache_dir:
+        genome_checksum = get_genome_checksum(genome_path, cache_dir)
+        for group, group_query_file in group_to_query_file.items():
+            group_to_cache_file[group] = get_tblastn_cache_file(cache_dir, group_query_file, genome_checksum)
+            cached, blast_obj = load_tblastn_cache(group_to_cache_file[group], genome_path)
+            if cached:
+                group_to_blast_obj[group] = blast_obj
+    missing_group_to_query_file = {group: group_query_file for group, group_query_file in group_to_query_file.items()
+                                   if group not in group_to_blast_obj}
+    if missing_group_to_query_file:
+        tag_to_group_query = write_tagged_query_file(missing_group_to_query_file, file_location + ".queries.fa")
+        command = ["tblastn", "-query", file_location + ".queries.fa", "-db", db_path] + tblastn_options + ["-out", file_location]
+        if threads:
+            command += ["-num_threads", str(threads)]
+        run_cmd(command=command, wait=True)
+        searched_group_to_blast_obj = read_tagged_blast_output(file_location, genome_path, tag_to_group_query)
+        for group in missing_group_to_query_file:
+            group_to_blast_obj[group] = searched_group_to_blast_obj.get(group)
+            if cache_dir:
+                store_tblastn_cache(group_to_cache_file[group], group_to_blast_obj[group])
+    return {group: blast_obj for group, blast_obj in group_to_blast_obj.items() if blast_obj is not None}
+
 
 if __name__ == "__main__":
     db = "/home/jgravemeyer/Dropbox/MSc_project/res/c_elegans.PRJNA13758.WS254.genomic.fa"
@@ -215,4 +642,4 @@ if __name__ == "__main__":
             print(query)
             for region_x in blast.inferred_regions[contig][query]:
                     print(region_x)
-                    print(blast.region_tuple_to_fasta[region_x])
+                    print(blast.get_region_fasta(region_x))
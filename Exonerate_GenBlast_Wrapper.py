@@ -1,16 +1,19 @@
 #!/usr/bin/env python3
 import re
+import bisect
 import os
+import logging
 from collections import defaultdict, namedtuple
 import tempfile as tmp
-from shared_code_box import run_cmd, write_to_tempfile, hash_fasta, get_phmm_score, tempdir
+from shared_code_box import run_cmd, write_to_tempfile, hash_fasta, get_phmm_score_from_fasta, tempdir, ToolCallError
 
 
 ########################################################################################################################
 # Prediction Object and related functions
 ########################################################################################################################
 
-def isolate_overlapping_predictions(pred_obj_list):
+def isolate_overlapping_predictions_pairwise(pred_obj_list):
+    """compares every prediction with every other one (check_overlap); see isolate_overlapping_predictions"""
     passed = []
     previous_interactions = set()
     for pred_obj in pred_obj_list:
@@ -25,6 +28,79 @@ def isolate_overlapping_predictions(pred_obj_list):
     return previous_interactions.difference(set(passed)), passed
 
 
+class PredictionIntervalIndex:
+    """predictions of one contig and strand sorted by their start. A max-tree over the ends of the predictions still
+    in the index returns all predictions overlapping an interval in O(log n) per hit."""
+
+    def __init__(self, pred_obj_list):
+        self.predictions = sorted(pred_obj_list, key=lambda x: min(x.gene_start, x.gene_end))
+        self.starts = [min(pred_obj.gene_start, pred_obj.gene_end) for pred_obj in self.predictions]
+        self.position = {pred_obj: idx for idx, pred_obj in enumerate(self.predictions)}
+        self.size = 1
+        while self.size < len(self.predictions):
+            self.size *= 2
+        self.max_end = [float("-inf")] * (2 * self.size)
+        for idx, pred_obj in enumerate(self.predictions):
+            self.max_end[self.size + idx] = max(pred_obj.gene_start, pred_obj.gene_end)
+        for node in range(self.size - 1, 0, -1):
+            self.max_end[node] = max(self.max_end[2 * node], self.max_end[2 * node + 1])
+
+    def __contains__(self, pred_obj):
+        return self.max_end[self.size + self.position[pred_obj]] != float("-inf")
+
+    def remove(self, pred_obj):
+        node = self.size + self.position[pred_obj]
+        self.max_end[node] = float("-inf")
+        node //= 2
+        while node:
+            self.max_end[node] = max(self.max_end[2 * node], self.max_end[2 * node + 1])
+            node //= 2
+
+    def overlapping(self, start, end):
+        """predictions in the index sharing at least one base with start-end (same rule as check_overlap)"""
+        last = bisect.bisect_right(self.starts, end)
+        hits = []
+        node_stack = [(1, 0, self.size)]
+        while node_stack:
+            node, first_idx, last_idx = node_stack.pop()
+            if first_idx >= last or self.max_end[node] < start:
+                continue
+            if node >= self.size:
+                hits.append(self.predictions[first_idx])
+            else:
+                middle = (first_idx + last_idx) // 2
+                node_stack.extend([(2 * node, first_idx, middle), (2 * node + 1, middle, last_idx)])
+        return hits
+
+
+def isolate_overlapping_predictions(pred_obj_list):
+    """every prediction (in list order) which is not yet part of an overlap claims all remaining predictions
+    overlapping it on the same contig and strand; only the best of them (score, aln_score; the later one on ties)
+    passes. Same result as isolate_overlapping_predictions_pairwise, but overlaps are looked up in one interval index
+    per contig and strand. Returns the set of removed predictions and the list of passed predictions."""
+    contig_strand_to_pred_list = defaultdict(list)
+    for pred_obj in pred_obj_list:
+        contig_strand_to_pred_list[(pred_obj.contig, pred_obj.strand)].append(pred_obj)
+    contig_strand_to_index = {contig_strand: PredictionIntervalIndex(contig_pred_list) for contig_strand, contig_pred_list in contig_strand_to_pred_list.items()}
+    list_position = {pred_obj: idx for idx, pred_obj in enumerate(pred_obj_list)}
+    overlapping, passed = set(), []
+    for pred_obj in pred_obj_list:
+        interval_index = contig_strand_to_index[(pred_obj.contig, pred_obj.strand)]
+        if pred_obj not in interval_index:
+            continue
+        interval_index.remove(pred_obj)
+        competitors = sorted(interval_index.overlapping(min(pred_obj.gene_start, pred_obj.gene_end), max(pred_obj.gene_start, pred_obj.gene_end)), key=list_position.get)
+        region_owner = pred_obj
+        for competitor in competitors:
+            interval_index.remove(competitor)
+            if not (competitor.score, competitor.aln_score) < (region_owner.score, region_owner.aln_score):
+                region_owner = competitor
+        if competitors:
+            overlapping.update([pred_obj] + competitors)
+        passed.append(region_owner)
+    return overlapping.difference(set(passed)), passed
+
+
 class PredictionObject:
     def __init__(self, region, score, cluster, cutoff, length_range):
         self.cluster = cluster
@@ -137,6 +213,18 @@ def remove_lower(text_string):
     return re.sub('[a-z]', '', text_string)
 
 
+nucleotides = "TCAG"
+amino_acids = "FFLLSSSSYYXXCCXWLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+codon_to_aa_dict = {a + b + c: amino_acids[idx] for idx, (a, b, c) in enumerate((a, b, c) for a in nucleotides for b in nucleotides for c in nucleotides)}
+
+
+def translate_coding_sequence(dna_string):
+    """translates a coding sequence like the target rows of the exonerate alignment (stops and ambiguous
+    codons become X)"""
+    dna_string = dna_string.upper()
+    return "".join([codon_to_aa_dict.get(dna_string[i:i+3], "X") for i in range(0, len(dna_string) - 2, 3)])
+
+
 def all_proteins_to_fasta_string(exonerate_obj):
     """returns a fasta string containing all predicted protein sequences, with query name as header."""
     fasta_list = []
@@ -211,45 +299,105 @@ def write_exonerate_aug_gff(gff_list, off_set_tuple, strand, region):
         new_gff_list.append("\t".join(line))
     return new_gff_list
 
-def make_exonerate_command(model, query_file, region_file):
+# one record per alignment: query, query description, target, target description, target strand, query range,
+# target range, raw score and the target coding sequence (no spaces, the command is split on whitespace)
+ryo_format = r"GenePS_ryo\t%qi\t%qd\t%ti\t%td\t%tS\t%qab\t%qae\t%tab\t%tae\t%s\n%tcs\nGenePS_ryo_end\n"
+
+
+def make_exonerate_command(model, query_file, region_file, ryo=False):
+    if ryo:
+        output_options = "--showalignment no --showtargetgff yes --ryo {}".format(ryo_format)
+    else:
+        output_options = "--showalignment yes --showtargetgff yes"
     cmd = "exonerate {} --softmaskquery no -Q protein -T dna  " \
       "--softmasktarget no --showvulgar no --minintron 20 --maxintron 50000 " \
-      "--showalignment yes --showtargetgff yes -q {} -t {}".format(model, query_file, region_file) #--minintron 20 --maxintron 50000
+      "{} -q {} -t {}".format(model, output_options, query_file, region_file) #--minintron 20 --maxintron 50000
     return cmd
 
 
-def get_exonerate_object(output_path, command):
-    line_count = 0
+def tee_lines(lines, output_path):
+    """yields the lines and copies them to output_path (if not None)"""
+    if output_path is None:
+        yield from lines
+        return
     with open(output_path, "w") as ex:
-        for line in run_cmd(command=command, wait=False):
+        for line in lines:
             ex.write(line)
-            line_count += 1
+            yield line
+
+
+def get_exonerate_object(output_path, command, ryo=False):
+    """runs exonerate and returns the parsed output (None without alignments, or if exonerate failed or was killed).
+    The alignment output is written to output_path and parsed afterwards; --ryo records are parsed straight from
+    the pipe and only copied to output_path if it is given."""
+    if ryo:
+        try:
+            exonerate_obj = ExonerateObject(output_path, ryo_lines=tee_lines(run_cmd(command=command, wait=False), output_path))
+        except ToolCallError as error:
+            logging.getLogger("Tools").warning(str(error))
+            return None
+        if not exonerate_obj.target_dna:
+            return None
+        return exonerate_obj
+    line_count = 0
+    try:
+        with open(output_path, "w") as ex:
+            for line in run_cmd(command=command, wait=False):
+                ex.write(line)
+                line_count += 1
+    except ToolCallError as error:
+        logging.getLogger("Tools").warning(str(error))
+        return None
     if line_count < 10:
         return None
     else:
         return ExonerateObject(output_path)
 
 
-def run_exonerate(mode_string, name, directory, region, query):    # sometimes exhaustive results in core dump
-    cmd = make_exonerate_command(mode_string, query, region)     # "-m p2g:b -E yes" is the best exhaustive command
-    out_file = os.path.join(directory, name)
-    exonerate_obj = get_exonerate_object(out_file, cmd)
+def run_exonerate(mode_string, name, directory, region, query, ryo=False):    # sometimes exhaustive results in core dump
+    """with ryo, directory can be None (the output is then not written to a file)"""
+    cmd = make_exonerate_command(mode_string, query, region, ryo=ryo)     # "-m p2g:b -E yes" is the best exhaustive command
+    out_file = os.path.join(directory, name) if directory is not None else None
+    exonerate_obj = get_exonerate_object(out_file, cmd, ryo=ryo)
     if exonerate_obj is None and "-E yes" in mode_string:
         print("coredump")
-        cmd = make_exonerate_command("-m p2g -E no", query, region)
-        exonerate_obj = get_exonerate_object(out_file, cmd)
+        cmd = make_exonerate_command("-m p2g -E no", query, region, ryo=ryo)
+        exonerate_obj = get_exonerate_object(out_file, cmd, ryo=ryo)
     return exonerate_obj
 
 
+ExonerateHit = namedtuple('ExonerateHit', 'query, qrange, trange, target, score, idx')
+
+
 class ExonerateObject:
 
-    def __init__(self, exonerate_file):
-        self.path = os.path.realpath(exonerate_file)
+    def __init__(self, exonerate_file, ryo_lines=None):
+        self.path = os.path.realpath(exonerate_file) if exonerate_file is not None else None
         self.query_prot = defaultdict(list)
         self.target_dna = defaultdict(list)
         self.target_prot = defaultdict(list)
         self.gff = defaultdict(list)
-        self.exonerate_processor(exonerate_file)
+        if ryo_lines is not None:
+            self.ryo_processor(ryo_lines)
+        elif exonerate_file is not None:
+            self.exonerate_processor(exonerate_file)
+
+    def split_by_query(self, query_to_members):
+        """hits of a run with the queries of several members (e.g. clusters) per member. query_to_members: query:
+        [(member, query name of the member)]; a query can belong to several members. Returns a dict member:
+        ExonerateObject with the hits of its queries, renamed."""
+        member_to_exonerate_obj = {}
+        for hit in self.target_dna:
+            for member, query in query_to_members.get(hit.query, []):
+                if member not in member_to_exonerate_obj:
+                    member_to_exonerate_obj[member] = ExonerateObject(None)
+                    member_to_exonerate_obj[member].path = self.path
+                member_obj, member_hit = member_to_exonerate_obj[member], hit._replace(query=query)
+                member_obj.query_prot[member_hit] = self.query_prot[hit]
+                member_obj.target_dna[member_hit] = self.target_dna[hit]
+                member_obj.target_prot[member_hit] = self.target_prot[hit]
+                member_obj.gff[member_hit] = self.gff[hit]
+        return member_to_exonerate_obj
 
     def exonerate_processor(self, exonerate_file):
         ''' protein against 1 or more genome regions (targets),
@@ -260,7 +408,6 @@ class ExonerateObject:
         next_block = lambda size: [next_line() for x in range(0, size)]
 
         read_flag = 0
-        Region = namedtuple('Region', 'query, qrange, trange, target, score, idx')
         with open(exonerate_file, "r") as ex:
             count = 0
             for line in ex:
@@ -272,7 +419,7 @@ class ExonerateObject:
                         count += 1
                         query, target, model, score = next_block(4)
                         qrange, trange = [tuple(x.split(" -> ")) for x in next_block(2)]
-                        header_tuple = Region(query=query, qrange=qrange, trange=trange, target=target, score=score, idx=count)
+                        header_tuple = ExonerateHit(query=query, qrange=qrange, trange=trange, target=target, score=score, idx=count)
                         read_flag = 2
                     elif read_flag == 2:
                         if not line.startswith("#"):
@@ -300,14 +447,48 @@ class ExonerateObject:
                         pass
             ex.seek(0)
 
+    def ryo_processor(self, lines):
+        """ --ryo records (see ryo_format) and gff output in one pass; the n-th gff dump belongs to the n-th
+        record. Records of a truncated output (core dump) without gff are ignored. """
+        hit_list, gff_list = [], []
+        read_flag = 0
+        for line in lines:
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            if read_flag == 1:
+                if line == "GenePS_ryo_end":
+                    hit_list.append((fields, "".join(coding_seq)))
+                    read_flag = 0
+                else:
+                    coding_seq.append(line.strip())
+            elif read_flag == 2:
+                if "END OF GFF DUMP" in line:
+                    read_flag = 0
+                elif not line.startswith("#"):
+                    gff_list[-1].append(line)
+            elif line.startswith("GenePS_ryo\t"):
+                fields, coding_seq = line.split("\t")[1:], []
+                read_flag = 1
+            elif line.startswith("# --- START OF GFF DUMP"):
+                gff_list.append([])
+                read_flag = 2
+        for count, ((fields, coding_seq), gff) in enumerate(zip(hit_list, gff_list), 1):
+            query_id, query_def, target_id, target_def, strand, q_start, q_end, t_start, t_end, score = fields
+            target = " ".join([target_id, target_def]).strip() + (" [revcomp]" if strand == "-" else "")
+            header_tuple = ExonerateHit(query=" ".join([query_id, query_def]).strip(), qrange=(q_start, q_end), trange=(t_start, t_end),
+                                        target=target, score=score, idx=count)
+            self.target_dna[header_tuple] = coding_seq.upper()
+            self.target_prot[header_tuple] = translate_coding_sequence(coding_seq)
+            self.query_prot[header_tuple] = ""
+            self.gff[header_tuple] = gff
+
 
 def markov_model_scoring2(fasta_string, hmm):
     if hmm:
-        with tmp.NamedTemporaryFile() as ex_file:
-            write_to_tempfile(ex_file.name, fasta_string)
-            score_hash = get_phmm_score(hmm, ex_file.name)
-            if score_hash:
-                return score_hash
+        score_hash = get_phmm_score_from_fasta(hmm, fasta_string)
+        if score_hash:
+            return score_hash
     return None
 
 
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+"""
+Usage: benchmark_hmmer_backend.py              -i <FILE> -m <FILE> [-r <INT>]
+
+    Options:
+        -h, --help                            show this screen.
+
+        General
+        -i, --input <FILE>                    protein fasta-file from one cluster
+        -m, --hmm <FILE>                      profile HMM of the cluster (e.g. from build_models.py)
+        -r, --regions <INT>                   number of simulated candidate regions for the use_models path [default: 20]
+"""
+
+import time
+from docopt import docopt
+from shared_code_box import hash_fasta, which, get_phmm_score_from_fasta, set_hmmer_backend
+
+
+def time_build_path(hmm, cluster_hash):
+    """build_models: one call per protein (leave-one-out rounds) and one for the whole cluster"""
+    start_time = time.time()
+    score_dict = {}
+    for header, sequence in cluster_hash.items():
+        score_dict.update(get_phmm_score_from_fasta(hmm, "{}\n{}".format(header, sequence)))
+    cluster_scores = get_phmm_score_from_fasta(hmm, "\n".join(["{}\n{}".format(header, sequence) for header, sequence in cluster_hash.items()]))
+    return (score_dict, cluster_scores), time.time() - start_time
+
+
+def time_use_path(hmm, cluster_hash, regions):
+    """use_models: predictions of all regions of a cluster (headers tagged per region) in one call"""
+    tagged_fasta = "\n".join([">{}|{}\n{}".format(region, header[1:], sequence) for region in range(regions) for header, sequence in cluster_hash.items()])
+    start_time = time.time()
+    score_dict = get_phmm_score_from_fasta(hmm, tagged_fasta, search_space=1, domain_search_space=1)
+    return score_dict, time.time() - start_time
+
+
+if __name__ == "__main__":
+    __version__ = 0.1
+    args = docopt(__doc__)
+    cluster_hash = hash_fasta(args['--input'])
+    regions = int(args['--regions'])
+
+    backend_results = {}
+    for backend in ["hmmsearch", "pyhmmer"]:
+        if set_hmmer_backend(backend) != backend:
+            print("\t[!] pyhmmer is not installed, skipping the in-process backend")
+            continue
+        if backend == "hmmsearch" and which("hmmsearch") is False:
+            print("\t[!] hmmsearch not found, skipping the subprocess backend")
+            continue
+        build_scores, build_time = time_build_path(args['--hmm'], cluster_hash)
+        use_scores, use_time = time_use_path(args['--hmm'], cluster_hash, regions)
+        backend_results[backend] = (build_scores, build_time, use_scores, use_time)
+
+    print("\n\t{}\t{}\t{}".format("backend", "build_models (sec)", "use_models (sec)"))
+    for backend, (build_scores, build_time, use_scores, use_time) in backend_results.items():
+        print("\t{}\t{:.2f}\t{:.2f}".format(backend, build_time, use_time))
+    print("\n\t# proteins: {}\tsimulated regions: {}".format(len(cluster_hash), regions))
+    if len(backend_results) == 2:
+        subprocess_results, in_process_results = backend_results["hmmsearch"], backend_results["pyhmmer"]
+        same_scores = subprocess_results[0] == in_process_results[0] and subprocess_results[2] == in_process_results[2]
+        print("\t# identical scores: {}".format(same_scores))
+        print("\t# speedup build_models: {:.2f}x\tuse_models: {:.2f}x\n".format(subprocess_results[1] / in_process_results[1],
+                                                                               subprocess_results[3] / in_process_results[3]))
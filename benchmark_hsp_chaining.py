@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+Usage: benchmark_hsp_chaining.py               [-n <INT>...] [-t <INT>] [-m <INT>] [--seed <INT>]
+
+    Options:
+        -h, --help                            show this screen.
+
+        General
+        -n, --genes <INT>...                  numbers of synthetic gene copies of one query on a contig (repeat -n for several sizes) [default: 100 1000 5000]
+        -t, --tandem <INT>                    copies per tandem array (copies of an array are 1-5 kb apart) [default: 4]
+        -m, --merging_distance <INT>          merging distance (bp), also the largest gap within a chain [default: 10000]
+        --seed <INT>                          seed of the random generator [default: 1]
+"""
+
+import time
+import random
+from docopt import docopt
+from Blast_wrapper import HspListObject
+
+q_len = 400
+
+
+def make_gene(gene, start, strand, random_gen):
+    """tblastn-like HSPs of one gene copy: one HSP per exon (some exons without hit), introns of 50-2000 bp"""
+    exon_borders = sorted(random_gen.sample(range(20, q_len - 20), random_gen.randint(3, 7)))
+    exons = list(zip([1] + [border + 1 for border in exon_borders], exon_borders + [q_len]))
+    if strand == "-":
+        exons.reverse()
+    hsp_list, position = [], start
+    for q_start, q_end in exons:
+        s_end = position + 3 * (q_end - q_start + 1) - 1
+        if random_gen.random() > 0.1:
+            s_coords = (s_end, position) if strand == "-" else (position, s_end)
+            hsp_list.append({"contig": "contig_1", "evalue": 0.0, "q_start": q_start, "q_end": q_end, "s_start": s_coords[0],
+                             "s_end": s_coords[1], "q_len": q_len, "strand": strand, "gene": gene})
+        position = s_end + random_gen.randint(50, 2000)
+    return hsp_list, position
+
+
+def make_hsp_list(genes, tandem, random_gen):
+    hsp_list, position = [], 1
+    for gene in range(genes):
+        if gene % tandem == 0:
+            position += random_gen.randint(20000, 100000)
+            strand = random_gen.choice("+-")
+        gene_hsps, position = make_gene(gene, position, strand, random_gen)
+        hsp_list.extend(gene_hsps)
+        position += random_gen.randint(1000, 5000)
+    return hsp_list
+
+
+def evaluate(region_function, hsp_list, merging_distance):
+    """time of sorting and region inference; copies with all their HSPs in a region of their own (resolved) and
+    copies spread over several regions (split)"""
+    start_time = time.time()
+    hits = HspListObject([dict(hsp) for hsp in hsp_list], merging_distance)
+    hits.sort_hsp_list()
+    regions = region_function(hits)
+    run_time = time.time() - start_time
+    gene_to_regions = {}
+    for region_idx, region in enumerate(regions):
+        for idx in region:
+            gene_to_regions.setdefault(hits.hsp_sorted[idx]["gene"], set()).add(region_idx)
+    region_to_genes = {}
+    for gene, region_set in gene_to_regions.items():
+        for region_idx in region_set:
+            region_to_genes.setdefault(region_idx, set()).add(gene)
+    resolved = len([gene for gene, region_set in gene_to_regions.items() if len(region_set) == 1 and len(region_to_genes[list(region_set)[0]]) == 1])
+    split = len([gene for gene, region_set in gene_to_regions.items() if len(region_set) > 1])
+    return len(regions), resolved, split, run_time
+
+
+if __name__ == "__main__":
+    __version__ = 0.1
+    args = docopt(__doc__)
+    random_gen = random.Random(int(args['--seed']))
+    sizes = [int(size) for value in args['--genes'] for size in value.split()]
+    merging_distance = int(args['--merging_distance'])
+
+    print("\n\t{}\t{}\t{}\t{}\t{}\t{}\t{}".format("#genes", "#HSPs", "mode", "#regions", "resolved copies", "split copies", "time (sec)"))
+    for genes in sizes:
+        hsp_list = make_hsp_list(genes, int(args['--tandem']), random_gen)
+        for mode, region_function in [("merge", HspListObject.merge_to_region), ("chain", HspListObject.chain_to_region)]:
+            amount_regions, resolved, split, run_time = evaluate(region_function, hsp_list, merging_distance)
+            print("\t{}\t{}\t{}\t{}\t{}\t{}\t{:.2f}".format(genes, len(hsp_list), mode, amount_regions, resolved, split, run_time))
+    print()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+"""
+Usage: benchmark_loo_scoring.py                -i <FILE> [-w <INT>] [--einsi]
+
+    Options:
+        -h, --help                            show this screen.
+
+        General
+        -i, --input <FILE>                    protein fasta-file from one cluster
+        -w, --workers <INT>                   number of parallel leave-one-out rounds [default: 1]
+        --einsi                               use the E-INS-i algorithm of mafft for all alignments
+"""
+
+import time
+import build_models
+from docopt import docopt
+from shared_code_box import hash_fasta, tempdir
+from build_models import ScoreObject, generate_msa
+
+
+def time_scoring(fasta_hash, workers, msa_list=None):
+    score_obj = ScoreObject(fasta_hash, "benchmark.hmm")
+    start_time = time.time()
+    score_dict = score_obj.iterative_score_computation(workers=workers, msa_list=msa_list)
+    return score_dict, time.time() - start_time
+
+
+if __name__ == "__main__":
+    __version__ = 0.1
+    args = docopt(__doc__)
+    build_models.einsi = args['--einsi']
+    workers = int(args['--workers'])
+    cluster_hash = hash_fasta(args['--input'])
+
+    with tempdir() as tmp_dir:
+        start = time.time()
+        cluster_msa = generate_msa(args['--input'])
+        msa_time = time.time() - start
+        realign_scores, realign_time = time_scoring(cluster_hash, workers)
+        msa_scores, msa_drop_time = time_scoring(cluster_hash, workers, msa_list=cluster_msa)
+
+    differences = []
+    print("\n\t{}\t{}\t{}\t{}".format("header", "re-aligned", "msa_drop", "difference"))
+    for header in cluster_hash:
+        realign_score, msa_score = realign_scores.get(header), msa_scores.get(header)
+        if realign_score is not None and msa_score is not None:
+            differences.append(msa_score - realign_score)
+            print("\t{}\t{}\t{}\t{}".format(header, realign_score, msa_score, msa_score - realign_score))
+        else:
+            print("\t{}\t{}\t{}\t{}".format(header, realign_score, msa_score, "-"))
+    print("\n\t# proteins: {}".format(len(cluster_hash)))
+    if differences:
+        print("\t# mean difference: {:.2f}\tmean absolute difference: {:.2f}\tmax absolute difference: {}".format(
+            sum(differences) / len(differences), sum([abs(x) for x in differences]) / len(differences), max([abs(x) for x in differences])))
+    print("\t# re-aligned mode: {:.2f} sec".format(realign_time))
+    print("\t# msa_drop mode: {:.2f} sec (+ {:.2f} sec for the full MSA)".format(msa_drop_time, msa_time))
+    print("\t# speedup: {:.2f}x\n".format(realign_time / (msa_drop_time + msa_time)))
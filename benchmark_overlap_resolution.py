@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""
+Usage: benchmark_overlap_resolution.py         [-n <INT>...] [-c <INT>] [-l <INT>] [--max_pairwise <INT>] [--seed <INT>]
+
+    Options:
+        -h, --help                            show this screen.
+
+        General
+        -n, --predictions <INT>...            sizes of the synthetic prediction sets (repeat -n for several sizes) [default: 1000 5000 20000]
+        -c, --contigs <INT>                   number of contigs the predictions are distributed on [default: 5]
+        -l, --contig_length <INT>             length of each contig [default: 1000000]
+        --max_pairwise <INT>                  largest set that is also resolved by the pairwise comparison [default: 5000]
+        --seed <INT>                          seed of the random generator [default: 1]
+"""
+
+import time
+import random
+from collections import namedtuple
+from docopt import docopt
+from Exonerate_GenBlast_Wrapper import PredictionObject, isolate_overlapping_predictions, isolate_overlapping_predictions_pairwise
+
+Region = namedtuple("Region", "contig, s_start, s_end, strand")
+
+
+def make_predictions(amount, contigs, contig_length, random_gen):
+    """synthetic predictions with gene lengths between 500 and 20000 bp, clustered like predictions of a large gene
+    family on a repeat-rich scaffold"""
+    loci = [(random_gen.randint(1, contigs), random_gen.randint(1, contig_length)) for x in range(max(1, amount // 20))]
+    pred_obj_list = []
+    for idx in range(amount):
+        contig, locus = random_gen.choice(loci)
+        pred_obj = PredictionObject(Region("contig_{}".format(contig), 0, 0, random_gen.choice("+-")), random_gen.randint(1, 1000), "cluster", 0, [0, 0])
+        pred_obj.gene_start = max(1, locus + random_gen.randint(-5000, 5000))
+        pred_obj.gene_end = pred_obj.gene_start + random_gen.randint(500, 20000)
+        pred_obj.gene_length = pred_obj.gene_end - pred_obj.gene_start
+        pred_obj.aln_score = random_gen.randint(1, 5000)
+        pred_obj_list.append(pred_obj)
+    return sorted(pred_obj_list, key=lambda x: x.score, reverse=True)
+
+
+def time_resolution(resolution_function, pred_obj_list):
+    start_time = time.time()
+    result = resolution_function(pred_obj_list)
+    return result, time.time() - start_time
+
+
+if __name__ == "__main__":
+    __version__ = 0.1
+    args = docopt(__doc__)
+    random_gen = random.Random(int(args['--seed']))
+    sizes = [int(size) for value in args['--predictions'] for size in value.split()]
+
+    print("\n\t{}\t{}\t{}\t{}\t{}".format("#predictions", "#passed", "interval index (sec)", "pairwise (sec)", "same result"))
+    for amount in sizes:
+        pred_obj_list = make_predictions(amount, int(args['--contigs']), int(args['--contig_length']), random_gen)
+        (filtered, passed), index_time = time_resolution(isolate_overlapping_predictions, pred_obj_list)
+        if amount <= int(args['--max_pairwise']):
+            (pairwise_filtered, pairwise_passed), pairwise_time = time_resolution(isolate_overlapping_predictions_pairwise, pred_obj_list)
+            print("\t{}\t{}\t{:.2f}\t{:.2f}\t{}".format(amount, len(passed), index_time, pairwise_time,
+                                                        filtered == pairwise_filtered and passed == pairwise_passed))
+        else:
+            print("\t{}\t{}\t{:.2f}\t{}\t{}".format(amount, len(passed), index_time, "-", "-"))
+    print()
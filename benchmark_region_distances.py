@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+Usage: benchmark_region_distances.py           -i <DIR> -g <FILE> -b <FILE> [--intron_model <INT,INT>] [--no_exonerate]
+
+    Options:
+        -h, --help                            show this screen.
+
+        General
+        -i, --use_models_input <DIR>          directory with results from build_models.py
+        -g, --genome <FILE>                   genome fasta-file the Blast file was computed against
+        -b, --blast <FILE>                    tblastn output of the consensus sequences (e.g. *_intermediate_blast.txt of use_models.py --keep)
+        --intron_model <INT,INT>              intron model for clusters without #span (models of older versions) [default: 5,500]
+        --no_exonerate                        only compares the candidate regions (number and total length)
+"""
+
+import time
+import tempfile as tmp
+from docopt import docopt
+import use_models
+from shared_code_box import get_expected_span, get_phmm_score_from_fasta, tempdir, write_to_tempfile
+from Blast_wrapper import read_blast_output, region_to_fasta
+from Exonerate_GenBlast_Wrapper import run_exonerate, all_proteins_to_fasta_string, PredictionObject
+
+
+def get_adaptive_distances(data_base, intron_model):
+    """merging and flanking distance per cluster as use_models.py computes them; spans of clusters without #span
+    are computed from their length range"""
+    cluster_to_distances = {}
+    for group in data_base.group_names:
+        for cluster, length_range in data_base.group_by_cluster_to_length_range[group].items():
+            max_span = data_base.group_by_cluster_to_span[group].get(cluster, get_expected_span(length_range, intron_model))[1]
+            cluster_to_distances[cluster] = (max_span, max_span // 2)
+    return cluster_to_distances
+
+
+def get_region_list(blast_obj):
+    return [(query, region) for contig in blast_obj.inferred_regions for query, region_list in blast_obj.inferred_regions[contig].items() for region in region_list]
+
+
+def predict_loci(region_list, data_base, genome, tmp_dir):
+    """exonerate (p2g -E no) on all regions passing the coverage filter; returns the summed exonerate time and the
+    predictions reaching the score cut-off of their cluster as (cluster, contig, strand, start, end)"""
+    cluster_to_group = {cluster: group for group in data_base.group_names for cluster in data_base.group_by_cluster_to_hmm[group]}
+    exonerate_time, loci = 0, []
+    for cluster, region in region_list:
+        group = cluster_to_group.get(cluster)
+        if group is None or not use_models.coverage_filter(region):
+            continue
+        with tmp.NamedTemporaryFile(dir=tmp_dir) as reg_file:
+            write_to_tempfile(reg_file.name, region_to_fasta(genome, region))
+            start_time = time.time()
+            ex_obj = run_exonerate("-m p2g -E no", "{}.exon".format(reg_file.name), tmp_dir, reg_file.name, data_base.group_by_cluster_to_fasta_file[group][cluster])
+            exonerate_time += time.time() - start_time
+        if ex_obj is None:
+            continue
+        scores = get_phmm_score_from_fasta(data_base.group_by_cluster_to_hmm[group][cluster], all_proteins_to_fasta_string(ex_obj))
+        for hit in ex_obj.target_dna:
+            score = scores.get(">{};{}".format(hit.query, hit.idx))
+            if score is not None and score >= data_base.group_by_cluster_to_score_cutoff[group][cluster]:
+                pred_obj = PredictionObject(region, score, cluster, None, None)
+                pred_obj.infer_data_from_exonerate_obj(ex_obj, hit)
+                loci.append((cluster, pred_obj.contig, pred_obj.strand, pred_obj.gene_start, pred_obj.gene_end))
+    return exonerate_time, loci
+
+
+def found_loci(reference_loci, loci):
+    """reference loci overlapped by a locus of the same cluster on the same contig and strand"""
+    return [ref for ref in reference_loci if any([ref[:3] == locus[:3] and locus[3] <= ref[4] and ref[3] <= locus[4] for locus in loci])]
+
+
+if __name__ == "__main__":
+    __version__ = 0.1
+    args = docopt(__doc__)
+    data_base = use_models.DataProviderObject(args['--use_models_input'])
+    intron_model = tuple([int(x) for x in args['--intron_model'].split(",")])
+    blast_obj = read_blast_output(args['--blast'], args['--genome'])
+
+    mode_to_regions = {}
+    for mode, distances in [("fixed", {}), ("adaptive", get_adaptive_distances(data_base, intron_model))]:
+        blast_obj.infer_regions(distances)
+        mode_to_regions[mode] = get_region_list(blast_obj)
+
+    print("\n\t{}\t{}\t{}".format("mode", "#regions", "total length (bp)"))
+    for mode, region_list in mode_to_regions.items():
+        print("\t{}\t{}\t{}".format(mode, len(region_list), sum([region.s_end - region.s_start + 1 for query, region in region_list])))
+
+    if not args['--no_exonerate']:
+        with tempdir() as tmp_dir:
+            fixed_time, fixed_loci = predict_loci(mode_to_regions["fixed"], data_base, args['--genome'], tmp_dir)
+            adaptive_time, adaptive_loci = predict_loci(mode_to_regions["adaptive"], data_base, args['--genome'], tmp_dir)
+        print("\n\t{}\t{}\t{}".format("mode", "exonerate (sec)", "#predictions >= cut-off"))
+        print("\t{}\t{:.2f}\t{}".format("fixed", fixed_time, len(fixed_loci)))
+        print("\t{}\t{:.2f}\t{}".format("adaptive", adaptive_time, len(adaptive_loci)))
+        if fixed_loci:
+            print("\n\t# sensitivity (fixed predictions found with adaptive regions): {:.1f}%".format(100 * len(found_loci(fixed_loci, adaptive_loci)) / len(fixed_loci)))
+        if adaptive_time:
+            print("\t# exonerate speedup: {:.2f}x\n".format(fixed_time / adaptive_time))
@@ -4,7 +4,7 @@
 ###############
 
 """
-Usage: build_models.py                         -i <DIR> -o <DIR> [-f <FILE>] [--keep] [--subset] [--einsi]
+Usage: build_models.py                         -i <DIR> -o <DIR> [-f <FILE>] [--keep] [--subset] [--einsi] [--jobs <INT>] [--loo_workers <INT>] [--loo_msa] [--score_folds <INT>] [--cache <DIR>] [--blast_index <FILE>] [--blast_top_hits <INT>] [--proteome_index <FILE>] [--intron_model <INT,INT>] [--threads <INT>] [--tool_threads <INT>] [--timeout <INT>]
 
     Options:
         -h, --help                            show this screen.
@@ -16,16 +16,37 @@ Usage: build_models.py                         -i <DIR> -o <DIR> [-f <FILE>] [--
         --keep                                command to safe intermediate files
         --subset                              clusters all filtered proteins by length and outputs a length representative subset instead of all filtered proteins
         --einsi                               changes the default simple progressive method of mafft to the E-INS-i algorithm
+        --jobs <INT>                          number of clusters processed in parallel (MSA, HMM, TP/TN scores) [default: 1]
+        --loo_workers <INT>                   number of parallel leave-one-out (or k-fold) scoring rounds per cluster [default: 1]
+        --loo_msa                             leave-one-out HMMs are built by removing the held-out protein from the cluster MSA instead of re-aligning all other proteins
+        --score_folds <INT>                   clusters >= 20 proteins are scored by k-fold cross-validation (K HMMs, each scoring its held-out fold) instead of a single HMM
+        --cache <DIR>                         persistent cache directory; clusters with unchanged sequences and options are not recomputed
+        --blast_index <FILE>                  on-disk index of the self-BLAST files (-f); built once and re-used as long as the BLAST files are unchanged (default: <output>/blast_index.sqlite)
+        --blast_top_hits <INT>                number of best self-BLAST hits per protein kept in the index [default: 100]
+        --proteome_index <FILE>               on-disk offset index of the proteins and sequenceIDs files (-f); sequences are read on demand (default: <output>/proteome_index.sqlite)
+        --intron_model <INT,INT>              introns per kb of coding sequence and intron length (bp), used with the length range for the expected gene span of each cluster (sizes the candidate regions of use_models.py) [default: 5,500]
+        --threads <INT>                       total number of threads all external tools (mafft, trimal, hmmer) may use at once, shared by --jobs and --loo_workers (default: no limit)
+        --tool_threads <INT>                  threads per mafft/hmmbuild/hmmsearch call (default: 1 with --threads, else tool defaults)
+        --timeout <INT>                       seconds after which a single external tool call is killed (default: no timeout)
 """
 
 import os
 import sys
+import time
+import json
+import shutil
+import hashlib
+import sqlite3
 import tempfile as tmp
 import logging
+from array import array
 from operator import itemgetter
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from shared_code_box import run_cmd, tempdir, check_programs, hash_fasta, write_hash_to_fasta,\
-    print_progress, write_to_tempfile, get_outdir, generate_hmm, get_consensus, get_phmm_score
+    print_progress, get_outdir, generate_hmm, get_consensus,\
+    get_process_pool, start_log_listener, init_worker_logging, index_fasta_offsets, map_fasta_file, read_fasta_sequence,\
+    pipe_cmd, generate_hmm_from_msa, get_phmm_score_from_fasta, tool_scheduler, tool_recorder, get_expected_span, ToolCallError
 import warnings
 warnings.filterwarnings("ignore")
 import_errors = []
@@ -39,15 +60,9 @@ try:
 except ImportError:
     import_errors.append("[ERROR] : Module \'numpy\' was not found. Please install \'numpy\' using \'pip install numpy\'")
 try:
-    from scipy.optimize import fsolve
     from scipy.signal import argrelmax
 except ImportError:
     import_errors.append("[ERROR] : Module \'scipy\' was not found. Please install \'scipy\' using \'pip install scipy\'")
-try:
-    from sklearn.neighbors.kde import KernelDensity
-    from sklearn import cluster
-except ImportError:
-    import_errors.append("[ERROR] : Module \'sklearn\' was not found. Please install \'sklearn\' using \'pip install sklearn\'")
 if import_errors:
     sys.exit("\n".join(import_errors))
 
@@ -124,18 +139,47 @@ def write_length_binned_fasta(fasta_dict, cluster_name, location):
     return length_hash
 
 
-def kde_sklearn(x, x_grid, bandwidth=0.2, **kwargs):
-    """Kernel Density Estimation with Scikit-learn. Fit KDE"""
-    kde_skl = KernelDensity(bandwidth=bandwidth, **kwargs)
-    kde_skl.fit(x[:, np.newaxis])
-    # score_samples() returns the log-likelihood of the samples
-    log_pdf = kde_skl.score_samples(x_grid[:, np.newaxis])
-    return kde_skl, np.exp(log_pdf)
-
-
-def get_intersection(fun1, fun2, xo):
-    """Find intersections between two functions. xo = initial guess for intersection"""
-    return fsolve(lambda x : fun1(x) - fun2(x), xo, xtol=1e-01, maxfev=500)
+def grid_bandwidth(max_x, grid_points=5000, quantile=0.1):
+    """closed form of the mean-shift bandwidth estimate (mean distance to the k-th nearest neighbour,
+    k = quantile * grid_points) of the evenly spaced grid np.linspace(0, max_x, grid_points). Points closer than
+    k/2 to an end of the grid have to take their neighbours from one side."""
+    k = int(grid_points * quantile)
+    edge_dist = np.minimum(np.arange(grid_points), np.arange(grid_points)[::-1])
+    neighbour_steps = np.where(2 * edge_dist >= k - 1, np.ceil((k - 1) / 2), k - 1 - edge_dist)
+    return max_x * neighbour_steps.mean() / (grid_points - 1)
+
+
+def gaussian_kde_on_grids(sample_list, x_grids, bandwidths, max_block=4000000):
+    """evaluates gaussian kernel densities of several sample sets on their grids in one vectorized computation.
+    Samples are padded to equal length (zero weight) and processed in blocks of at most max_block array cells.
+    Returns an array of shape (len(sample_list), grid_points)."""
+    x_grids = np.atleast_2d(np.asarray(x_grids, dtype=float))
+    bandwidths = np.asarray(bandwidths, dtype=float)[:, np.newaxis, np.newaxis]
+    max_samples = max([len(samples) for samples in sample_list])
+    padded = np.zeros((len(sample_list), max_samples))
+    weights = np.zeros((len(sample_list), max_samples))
+    for idx, samples in enumerate(sample_list):
+        padded[idx, :len(samples)] = samples
+        weights[idx, :len(samples)] = 1.0 / len(samples)
+    pdf = np.zeros(x_grids.shape)
+    block = max(1, int(max_block / x_grids.size))
+    for first in range(0, max_samples, block):
+        distance = x_grids[:, :, np.newaxis] - padded[:, np.newaxis, first:first + block]
+        kernel = np.exp(-0.5 * (distance / bandwidths) ** 2)
+        pdf += (kernel * weights[:, np.newaxis, first:first + block]).sum(axis=2)
+    return pdf / (bandwidths[:, :, 0] * np.sqrt(2 * np.pi))
+
+
+def grid_intersections(x_axis, pdf_a, pdf_b):
+    """x-values where two densities cross, taken from sign changes of their difference on the grid and refined by
+    linear interpolation. Rounded to integers (as the former fsolve based solution)."""
+    difference = pdf_a - pdf_b
+    points = set(np.round(x_axis[difference == 0]).astype(int).tolist())
+    change_idx = np.where(difference[:-1] * difference[1:] < 0)[0]
+    left, right = difference[change_idx], difference[change_idx + 1]
+    crossing = x_axis[change_idx] + (x_axis[change_idx + 1] - x_axis[change_idx]) * left / (left - right)
+    points.update(np.round(crossing).astype(int).tolist())
+    return sorted(points, reverse=True)
 
 
 def find_density_drop_idx(pdf_tn, x_axis):
@@ -161,29 +205,41 @@ def best_intersection_if_curves_overlap(intersec_points, lower, upper):
         return None
 
 
+def find_density_intersections(tp_tn_list, grid_points=5000):
+    """batch mode of find_density_intersection: takes a list of (tp, tn) score lists, e.g. of all clusters of a
+    group, and evaluates all densities in one call. Returns the list of intersection points (or None)."""
+    if not tp_tn_list:
+        return []
+    x_axes = np.array([np.linspace(0, max(tp), grid_points) for tp, tn in tp_tn_list])
+    bandwidths = [grid_bandwidth(max(tp), grid_points) for tp, tn in tp_tn_list]
+    pdf_tp_all = gaussian_kde_on_grids([np.array(tp, dtype=float) for tp, tn in tp_tn_list], x_axes, bandwidths)
+    pdf_tn_all = gaussian_kde_on_grids([np.array(tn, dtype=float) for tp, tn in tp_tn_list], x_axes, bandwidths)
+    intersections = []
+    for idx, (tp, tn) in enumerate(tp_tn_list):
+        x_axis, pdf_tp, pdf_tn = x_axes[idx], pdf_tp_all[idx], pdf_tn_all[idx]
+        if int(min(tp)) > int(max(tn)):
+            intersections.append(round((max(tn) + min(tp)) / 2))
+            continue
+        tn_maxima = argrelmax(pdf_tn)[0]
+        highest_maximum_tn = tn_maxima[np.argmax(pdf_tn[tn_maxima])] if len(tn_maxima) else np.argmax(pdf_tn)
+        maxima_x_axis = int(round(x_axis[highest_maximum_tn], -1))
+        intersec_points = grid_intersections(x_axis, pdf_tp, pdf_tn)
+        tn_curve_end = find_density_drop_idx(pdf_tn, x_axis)
+        intersections.append(best_intersection_if_curves_overlap(intersec_points, maxima_x_axis, tn_curve_end))
+    return intersections
+
+
 def find_density_intersection(tp, tn):
     """find intersection between tp and tn density functions. pdf = probability density function (y-density values).
-    kde = kernel density estimate. Initial intersections have to be guess -> range(tn(first local maxima), tn(last x-value), 10).
-    Bandwidth will be estimated. FuncA and B re-generate pdf data again for intersection computation with fsolve.
-    Two case: curves do not touch and curves overlap."""
-    x_axis = np.linspace(0, max(tp), 5000)
-    tp_array = np.array(tp)
-    tn_array = np.array(tn)
-    bandwidth = cluster.estimate_bandwidth(np.array([[x] for x in x_axis]), quantile=0.1)
-    kde_tp, pdf_tp = kde_sklearn(tp_array, x_axis, bandwidth=bandwidth)
-    kde_tn, pdf_tn = kde_sklearn(tn_array, x_axis, bandwidth=bandwidth)
-    highest_maxima_tn = [[pdf_tn[first_tn], x_axis[first_tn]] for first_tn in argrelmax(pdf_tn)[0]]
-    maxima_x_axis = int(round(sorted(highest_maxima_tn, key=lambda x: x[0], reverse=True)[0][1], -1))
-    funcA = lambda x: np.exp(kde_tp.score_samples([[x]][0]))
-    funcB = lambda x: np.exp(kde_tn.score_samples([[x]][0]))
-    intersection_interval = range(maxima_x_axis, int(max(tn)) + 10, 10)
-    point_guesses = [round(float(get_intersection(funcA, funcB, guess))) for guess in intersection_interval]
-    intersec_points = sorted(set(point_guesses), reverse=True)
-    if int(min(tp)) > int(max(tn)):
-        return round((max(tn) + min(tp)) / 2)
-    else:
-        tn_curve_end = find_density_drop_idx(pdf_tn, x_axis)
-        return best_intersection_if_curves_overlap(intersec_points, maxima_x_axis, tn_curve_end)
+    Both densities are evaluated once on a 5000 point grid (gaussian kernel, bandwidth from grid_bandwidth) and
+    intersections are the sign changes of their difference. Two cases: curves do not touch (midpoint between
+    max(tn) and min(tp)) and curves overlap (first intersection between highest tn maximum and end of tn curve)."""
+    return find_density_intersections([(tp, tn)])[0]
+
+
+def score_lists_intersectable(tp, tn):
+    """intersections are only computed if both score distributions have at least 10 values"""
+    return len(tp) >= 10 and len(tn) >= 10
 
 
 def calculate_length_range(length_dict):
@@ -198,10 +254,41 @@ def calculate_length_range(length_dict):
 # Global Functions: MSA related functions
 ########################################################################################################################
 
+def msa_list_to_hash(msa_list):
+    """turns the alternating [header, aln, header, aln...] list of a MsaObject into a hash in style of >header:aln"""
+    return {msa_list[x]: msa_list[x + 1] for x in range(0, len(msa_list) - 1, 2)}
+
+
+def drop_sequences_from_msa(msa_hash, held_out):
+    """removes the held out rows from an aligned fasta hash and deletes all columns that only consist of gaps
+    afterwards. Returns the remaining MSA as string in fasta format."""
+    rest_prot = [header for header in msa_hash if header not in held_out]
+    columns = zip(*[msa_hash[header] for header in rest_prot])
+    keep_idx = [idx for idx, column in enumerate(columns) if column.count("-") != len(column)]
+    return "\n".join(["{}\n{}".format(header, "".join([msa_hash[header][idx] for idx in keep_idx])) for header in rest_prot])
+
+
 def msa_operations(command):
+    return parse_msa_lines(run_cmd(command=command, wait=False))
+
+
+def trim_operations(command):
+    """msa_operations for trimal, which may exit with an error if no sequence passes its filters; this is an empty
+    MSA (see check_msa_size_and_length). A killed trimal still raises ToolCallError."""
+    try:
+        return msa_operations(command)
+    except ToolCallError as error:
+        if error.killed:
+            raise
+        return [""]
+
+
+def parse_msa_lines(msa_lines):
+    """parses aligned fasta lines into a list in style of [header, aln, header, aln...]; lines before the first
+    header are skipped"""
     read_flag = 0
     seq, msa_list = [], []
-    for line in run_cmd(command=command, wait=False):
+    for line in msa_lines:
         if read_flag == 0:
             if line.startswith(">"):
                 read_flag = 1
@@ -226,7 +313,19 @@ def generate_msa(fasta):
     return msa_operations(command)
 
 
+def generate_msa_from_fasta(fasta_string):
+    """aligns a fasta string fed to mafft via stdin"""
+    if einsi:
+        command = ["einsi", "-"]
+    else:
+        command = ["mafft", "-"]
+    return parse_msa_lines(pipe_cmd(command, fasta_string).splitlines())
+
+
 class MsaObject:
+    trim_remove_options = "-resoverlap 0.50 -seqoverlap 75"    # 70 70
+    trim_length_options = "-automated1"
+
     def __init__(self, msa_list, name_cluster, output_directory):
         self.msa_list = msa_list
         self.cluster_name = name_cluster
@@ -235,15 +334,15 @@ class MsaObject:
 
         self.size_history = [len(self.msa_list) / 2]
         self.lengths_history = [len(self.msa_list[1])]
-        self.cmd_trim_remove = "trimal -in " + self.file_path + " -resoverlap 0.50 -seqoverlap 75" #70 70
-        self.cmd_trim_length = "trimal -in " + self.file_path + " -automated1"
+        self.cmd_trim_remove = "trimal -in " + self.file_path + " " + self.trim_remove_options
+        self.cmd_trim_length = "trimal -in " + self.file_path + " " + self.trim_length_options
 
     def msa_to_fasta(self):
         with open(self.file_path, "w") as m:
             m.write("\n".join(self.msa_list) + "\n")
 
     def trim_remove(self):
-        self.msa_list = msa_operations(self.cmd_trim_remove)
+        self.msa_list = trim_operations(self.cmd_trim_remove)
         new_size = len(self.msa_list)/2
         if new_size == 0.5:
             new_size = 0
@@ -251,7 +350,7 @@ class MsaObject:
         self.msa_to_fasta()
 
     def trim_length(self):
-        self.msa_list = msa_operations(self.cmd_trim_length)
+        self.msa_list = trim_operations(self.cmd_trim_length)
         self.lengths_history.append(len(self.msa_list[1]))
         self.msa_to_fasta()
 
@@ -326,41 +425,185 @@ def get_blast_files(input_dir):
             return os.path.abspath(subdir), set(dir_list)
 
 
-def hash_single_blast_file(blast_file):
+def hash_single_blast_file(blast_file, top_hits=None):
     """ hashes single within-species-blast and returns hash in style of: [protein_id] = list(hits). Hits are
-     sorted because they are sorted by E-value in the blast file."""
+     sorted because they are sorted by E-value in the blast file. Only the first 'top_hits' hits are kept."""
     protid_hits_hash = defaultdict(list)
     with open(blast_file) as blast_f:
         for line in blast_f:
             line = line.split("\t")
             spec_id, prot_id = line[0].split("_")   # line[0] = self, line[1] = other
-            protid_hits_hash[prot_id].append(line[1].split("_")[1])
+            if top_hits is None or len(protid_hits_hash[prot_id]) < top_hits:
+                protid_hits_hash[prot_id].append(line[1].split("_")[1])
     return protid_hits_hash
 
 
-def hash_all_blast_files(species_id_set):
-    """opens all blast files for which species_ids could be found. Calls hash_single_blast_file and fills the global blast dictionary in style of
-    [species_id][protein_id]=list of all blast hits for this protein id"""
-    for species_id in species_id_set:
+def index_single_blast_file(blast_file_job):
+    """worker function of the blast index pool: returns the top hits of each protein as (protein_id, packed hit ids)"""
+    species_id, blast_file, top_hits = blast_file_job
+    protid_hits_hash = hash_single_blast_file(blast_file, top_hits=top_hits)
+    return species_id, [(int(prot_id), array("i", [int(hit) for hit in hits]).tobytes())
+                        for prot_id, hits in protid_hits_hash.items()]
+
+
+class SqliteIndexObject:
+    """base of the on-disk indices of the true negative input files. The index is valid as long as its signature
+    (files it was built from and options) is unchanged; connections are opened lazily per process."""
+    version = 1
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.connection = None
+        self.pid = None
+
+    def get_connection(self):
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.index_path)
+            self.pid = os.getpid()
+        return self.connection
+
+    def get_meta(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        connection = sqlite3.connect(self.index_path)
+        try:
+            return dict(connection.execute("SELECT key, value FROM meta"))
+        except sqlite3.DatabaseError:
+            return {}
+        finally:
+            connection.close()
+
+    def is_valid(self, signature):
+        return self.get_meta().get("signature") == signature
+
+    def write_index(self, signature, fill_index):
+        """fill_index(connection) writes the index into a temporary file which replaces the old index only when
+        complete"""
+        tmp_path = self.index_path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with sqlite3.connect(tmp_path) as connection:
+            connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            fill_index(connection)
+            connection.execute("INSERT INTO meta VALUES ('signature', ?)", (signature,))
+        connection.close()
+        os.replace(tmp_path, self.index_path)
+        self.connection = None
+
+
+class BlastIndexObject(SqliteIndexObject):
+    """SQLite index of the OrthoFinder self-BLAST files: one row per species and protein (integer ids) holding the
+    best 'top_hits' hits as packed integer array."""
+
+    def build(self, blast_file_jobs, signature, jobs=1):
+        """parses the blast files (in parallel if jobs > 1) into the index"""
+        def fill_index(connection):
+            connection.execute("CREATE TABLE hits (species INTEGER, protein INTEGER, hits BLOB, "
+                               "PRIMARY KEY (species, protein)) WITHOUT ROWID")
+            if jobs > 1:
+                with get_process_pool(min(jobs, len(blast_file_jobs))) as pool:
+                    for species_id, rows in pool.imap_unordered(index_single_blast_file, blast_file_jobs):
+                        connection.executemany("INSERT INTO hits VALUES (?, ?, ?)", [(int(species_id), prot_id, hits) for prot_id, hits in rows])
+            else:
+                for blast_file_job in blast_file_jobs:
+                    species_id, rows = index_single_blast_file(blast_file_job)
+                    connection.executemany("INSERT INTO hits VALUES (?, ?, ?)", [(int(species_id), prot_id, hits) for prot_id, hits in rows])
+        self.write_index(signature, fill_index)
+
+    def count_species(self):
+        return len(self.get_connection().execute("SELECT DISTINCT species FROM hits").fetchall())
+
+    def get_hits(self, species_id, prot_id):
+        """best blast hits of a protein sorted by E-value, as list of protein ids"""
+        row = self.get_connection().execute("SELECT hits FROM hits WHERE species = ? AND protein = ?",
+                                            (int(species_id), int(prot_id))).fetchone()
+        if row is None:
+            return []
+        hits = array("i")
+        hits.frombytes(row[0])
+        return [str(hit) for hit in hits]
+
+
+def index_all_blast_files(index_path, blast_dir, species_id_set, top_hits, jobs=1):
+    """builds the blast index for all species_ids unless an index of the same blast files and top_hits exists.
+    Returns the index object and the number of indexed species."""
+    blast_file_jobs = []
+    for species_id in sorted(species_id_set):
         b_file_name = "Blast{}_{}.txt".format(species_id, species_id)
-        b_file_path = os.path.join(blast_path, b_file_name)
-        blast_specID_protID_hitList[species_id] = hash_single_blast_file(b_file_path)
-    return len(blast_specID_protID_hitList)
+        blast_file_jobs.append((species_id, os.path.join(blast_dir, b_file_name), top_hits))
+    signature = json.dumps([BlastIndexObject.version, top_hits] + [get_file_signature(job[1]) for job in blast_file_jobs])
+    index_obj = BlastIndexObject(index_path)
+    if not index_obj.is_valid(signature):
+        index_obj.build(blast_file_jobs, signature, jobs=jobs)
+    else:
+        print("\t[-] BLAST index already exists:\t{}\n".format(index_path))
+    return index_obj, index_obj.count_species()
 
 
-def hash_sequence_translation_file(sequence_id_name_file):
-    """ hashes translation file and returns hash-list in style of: [species_protein_name] = species_protein_id
-     as well as an reversed hash: [species_protein_id] = species_protein_name """
-    translation_dict = {}
-    translation_dict_rev = {}
+def read_sequence_translation_file(sequence_id_name_file):
+    """yields (species_protein_id, species_protein_name) for each line of the SequenceIDs file"""
     with open(sequence_id_name_file) as tf:
         for line in tf:
             line = line.strip("\n").split(":")
-            prot_sp_name = line[1].strip()
-            prot_sp_id = line[0]
-            translation_dict[prot_sp_name] = prot_sp_id
-            translation_dict_rev[prot_sp_id] = prot_sp_name
-    return translation_dict, translation_dict_rev
+            yield line[0], line[1].strip()
+
+
+class ProteomeIndexObject(SqliteIndexObject):
+    """SQLite index of the OrthoFinder proteome and SequenceIDs file: byte offsets of all sequences (faidx style)
+    and the species_protein_id <-> name translation. Sequences are read on demand from the memory mapped
+    proteome file, so memory does not grow with the size of the proteome."""
+
+    def __init__(self, index_path, fasta_path):
+        SqliteIndexObject.__init__(self, index_path)
+        self.fasta_path = fasta_path
+        self.fasta_map = None
+        self.fasta_map_pid = None
+
+    def build(self, sequence_id_file, signature):
+        def fill_index(connection):
+            connection.execute("CREATE TABLE sequences (header TEXT PRIMARY KEY, offset INTEGER, length INTEGER) WITHOUT ROWID")
+            connection.execute("CREATE TABLE sequence_ids (id_pair TEXT PRIMARY KEY, name TEXT) WITHOUT ROWID")
+            connection.executemany("INSERT OR IGNORE INTO sequences VALUES (?, ?, ?)", index_fasta_offsets(self.fasta_path))
+            connection.executemany("INSERT OR REPLACE INTO sequence_ids VALUES (?, ?)", read_sequence_translation_file(sequence_id_file))
+            connection.execute("CREATE INDEX sequence_names ON sequence_ids (name)")
+        self.write_index(signature, fill_index)
+
+    def get_fasta_map(self):
+        if self.fasta_map is None or self.fasta_map_pid != os.getpid():
+            self.fasta_map = map_fasta_file(self.fasta_path)
+            self.fasta_map_pid = os.getpid()
+        return self.fasta_map
+
+    def get_id_pair(self, name):
+        """species_protein_id of a protein name (or None)"""
+        row = self.get_connection().execute("SELECT id_pair FROM sequence_ids WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def get_name(self, id_pair):
+        """protein name of a species_protein_id (or None)"""
+        row = self.get_connection().execute("SELECT name FROM sequence_ids WHERE id_pair = ?", (id_pair,)).fetchone()
+        return row[0] if row else None
+
+    def get_sequence(self, header):
+        """sequence of a >header of the proteome (or None)"""
+        row = self.get_connection().execute("SELECT offset, length FROM sequences WHERE header = ?", (header,)).fetchone()
+        if row is None:
+            return None
+        return read_fasta_sequence(self.get_fasta_map(), *row)
+
+    def count_sequences(self):
+        return self.get_connection().execute("SELECT COUNT(*) FROM sequences").fetchone()[0]
+
+
+def index_proteome(index_path, fasta_file, sequence_id_file):
+    """builds the proteome index unless an index of the same proteome and SequenceIDs file exists"""
+    signature = json.dumps([ProteomeIndexObject.version] + get_file_signature(fasta_file) + get_file_signature(sequence_id_file))
+    index_obj = ProteomeIndexObject(index_path, fasta_file)
+    if not index_obj.is_valid(signature):
+        index_obj.build(sequence_id_file, signature)
+    else:
+        print("\t[-] Proteome index already exists:\t{}\n".format(index_path))
+    return index_obj
 
 
 def hash_species_translation_file(species_id_file):
@@ -375,22 +618,21 @@ def hash_species_translation_file(species_id_file):
 
 def translate_cluster_hash(header_list):
     """ hashes cluster file and returns hash-list in style of: [species_id] = list(protein_id)
-    needs idpair_to_name pair as translation dict"""
+    needs the proteome index for the name to id_pair translation"""
     cluster_dict = defaultdict(list)
     for header in header_list:
         header = header.strip("\n")
         protein_sp_name = header.strip(">")
         try:
-            protein_sp_id = idPair_2_namePair[protein_sp_name]
-            sp_id, protein_id = protein_sp_id.split("_")
+            sp_id, protein_id = proteome_index.get_id_pair(protein_sp_name).split("_")
             cluster_dict[sp_id].append(protein_id)
-        except KeyError:
+        except AttributeError:
             return None
     return cluster_dict
 
 
 def next_best_blast_hit(unfiltered_protein_ids, self_hits):
-    """unfiltered_protein_ids -> list of all protein ids of one species belonging to one cluster - CAN NOT BE TN
+    """unfiltered_protein_ids -> set of all protein ids of one species belonging to one cluster - CAN NOT BE TN
     self_hits -> [protein]= list of corresponding blast hits within one species, sorted by evalue."""
     for hit in self_hits:
         if hit not in unfiltered_protein_ids:
@@ -402,23 +644,88 @@ def get_twin_hash(translated_filtered_cluster_header, translated_unfiltered_clus
     """generates a True negative fasta hash of a cluster_file by searching for each proteins next best blast hit.
     Takes as input files in style of [species_id]=list(protein_ids). One for the filtered data one for unfiltered"""
     fasta_hash = {}
+    unfiltered_protein_sets = {species_id: set(prot_ids) for species_id, prot_ids in translated_unfiltered_cluster_header.items()}
     for species_id, prot_list in translated_filtered_cluster_header.items():
         for prot_id in prot_list:
             # two proteins of the same species are allowed to have the same next best
-            protID_selfHits = blast_specID_protID_hitList[species_id][prot_id]
-            next_best = next_best_blast_hit(translated_unfiltered_cluster_header[species_id], protID_selfHits)
+            protID_selfHits = blast_index.get_hits(species_id, prot_id)
+            next_best = next_best_blast_hit(unfiltered_protein_sets.get(species_id, set()), protID_selfHits)
             if next_best is not None:
                 idx_pair = "{}_{}".format(species_id, next_best)
-                name_pair = ">" + namePair_2_idPair[idx_pair]
-                try:
-                    sequence = all_protein_fasta_dict[name_pair]
-                except KeyError:
+                name_pair = ">{}".format(proteome_index.get_name(idx_pair))
+                sequence = proteome_index.get_sequence(name_pair)
+                if sequence is None:
                     logger_TN_Warning.info("could not translate {}".format(name_pair))
                     continue
                 fasta_hash[name_pair] = sequence
     return fasta_hash
 
 
+########################################################################################################################
+# Global Functions: incremental rebuild cache
+########################################################################################################################
+
+def get_file_signature(path):
+    """path, size and modification time of a file or of all files in a directory"""
+    signature = []
+    if os.path.isdir(path):
+        for single_file in sorted(os.listdir(path)):
+            signature.extend(get_file_signature(os.path.join(path, single_file)))
+    elif os.path.exists(path):
+        stat = os.stat(path)
+        signature.append([os.path.abspath(path), stat.st_size, int(stat.st_mtime)])
+    return signature
+
+
+def get_cache_options(tn_arguments=None):
+    """all options which influence the per cluster results. True negative input files are represented by their
+    signatures (size, modification time) to avoid hashing the whole OrthoFinder output"""
+    cache_options = {"version": __cache_version__, "einsi": bool(einsi), "subset": bool(subset), "loo_msa": bool(loo_msa),
+                     "score_folds": score_folds, "trim_remove": MsaObject.trim_remove_options,
+                     "trim_length": MsaObject.trim_length_options, "true_negatives": None}
+    if tn_arguments:
+        cache_options["true_negatives"] = {name: get_file_signature(tn_arguments[name]) for name in sorted(tn_arguments)}
+        cache_options["blast_top_hits"] = blast_top_hits
+    return cache_options
+
+
+def get_cluster_cache_key(file_name, fasta_hash, cache_options):
+    """sha256 over cluster name, sequences and options"""
+    key = hashlib.sha256()
+    key.update(file_name.encode())
+    for header in sorted(fasta_hash):
+        key.update("{}\n{}\n".format(header, fasta_hash[header]).encode())
+    key.update(json.dumps(cache_options, sort_keys=True).encode())
+    return key.hexdigest()
+
+
+def get_cluster_cache_dir(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def read_cluster_cache(cache_dir, key):
+    """returns the cached entry of a cluster as dictionary or None if not (completely) cached"""
+    entry_file = os.path.join(get_cluster_cache_dir(cache_dir, key), "cluster.json")
+    try:
+        with open(entry_file) as entry:
+            return json.load(entry)
+    except (IOError, ValueError):
+        return None
+
+
+def write_cluster_cache(cache_dir, key, cache_entry, files):
+    """copies the result files (ending: path) and writes the json entry last, so an interrupted run never
+    leaves a seemingly complete entry"""
+    entry_dir = get_cluster_cache_dir(cache_dir, key)
+    os.makedirs(entry_dir, exist_ok=True)
+    for ending, file_path in files.items():
+        shutil.copyfile(file_path, os.path.join(entry_dir, "cluster" + ending))
+    with open(os.path.join(entry_dir, "cluster.json.tmp"), "w") as entry:
+        json.dump(cache_entry, entry)
+    os.replace(os.path.join(entry_dir, "cluster.json.tmp"), os.path.join(entry_dir, "cluster.json"))
+    return entry_dir
+
+
 ########################################################################################################################
 # Class ScoreObject - Positive Scores
 ########################################################################################################################
@@ -437,53 +744,83 @@ class ScoreObject:
         if not self.score_dict:
             raise AttributeError("Empty Score List, exciting ... {}".format(self.hmm_path))
         score_list = list(self.score_dict.values())
-        if true_negative_scores:
-            if len(score_list) >= 10 and len(true_negative_scores) >= 10:
-                inter_point = find_density_intersection(score_list, true_negative_scores)
-                if inter_point:
-                    self.score_distribution_parameters = inter_point
-                    return self.score_distribution_parameters
-        self.score_distribution_parameters = np.median(score_list) / 2
+        inter_point = None
+        if true_negative_scores and score_lists_intersectable(score_list, true_negative_scores):
+            inter_point = find_density_intersection(score_list, true_negative_scores)
+        return self.set_score_cut_off(inter_point)
+
+    def set_score_cut_off(self, inter_point=None):
+        """cutoff is the intersection point of TP and TN distribution if one exists, else half the median of TP"""
+        if inter_point:
+            self.score_distribution_parameters = inter_point
+        else:
+            self.score_distribution_parameters = np.median(list(self.score_dict.values())) / 2
         return self.score_distribution_parameters
 
     def generate_msa_string(self, rest_prot):
         """returns a MSA as string in fasta format, derived from the a list of headers"""
         seq_list = ["{}\n{}".format(header, self.fasta_hash[header]) for header in rest_prot]
-        with tmp.NamedTemporaryFile() as r_tmp:
-            write_to_tempfile(r_tmp.name, "\n".join(seq_list))
-            list_msa = generate_msa(r_tmp.name)
-        return "\n".join(list_msa)
-
-    def iterative_score_computation(self):
-        for idx in range(0, len(self.fasta_hash.keys())):
-            rest_prot = list(self.fasta_hash.keys())
-            query = rest_prot.pop(idx)
-            with tmp.NamedTemporaryFile() as q_tmp:
-                write_to_tempfile(q_tmp.name, query.split()[0] + "\n" + self.fasta_hash[query])
-                msa_string = self.generate_msa_string(rest_prot)
-                with tmp.NamedTemporaryFile() as msa_tmp:
-                    write_to_tempfile(msa_tmp.name, msa_string)
-                    with tmp.NamedTemporaryFile() as hmm_tmp:
-                        generate_hmm(hmm_tmp.name, msa_tmp.name)
-                        try:
-                            score_dict = get_phmm_score(hmm_tmp.name, q_tmp.name)
-                        except IndexError:
-                            continue
+        return "\n".join(generate_msa_from_fasta("\n".join(seq_list) + "\n"))
+
+    def held_out_round(self, held_out, msa_hash=None):
+        """builds a HMM from all proteins except the held out ones and scores the held out proteins against it.
+        If the MSA of the whole cluster is given, the held out rows are removed from it instead of re-aligning
+        the remaining proteins. Every held out protein is scored as if it was searched alone (search space 1), so
+        k-fold scores do not depend on the fold size and equal leave-one-out scores of the same HMM."""
+        start_time = time.time()
+        rest_prot = [header for header in self.fasta_hash.keys() if header not in held_out]
+        query_string = "\n".join(["{}\n{}".format(query.split()[0], self.fasta_hash[query]) for query in held_out]) + "\n"
+        if msa_hash and len(msa_hash) == len(self.fasta_hash) and all([query in msa_hash for query in held_out]):
+            msa_string = drop_sequences_from_msa(msa_hash, held_out)
+        else:
+            msa_string = self.generate_msa_string(rest_prot)
+        with tmp.NamedTemporaryFile() as hmm_tmp:     # hmmsearch reads the queries from stdin, so the HMM needs a file
+            generate_hmm_from_msa(hmm_tmp.name, msa_string + "\n")
+            try:
+                score_dict = get_phmm_score_from_fasta(hmm_tmp.name, query_string, search_space=1, domain_search_space=1, cache_hmm=False)
+            except IndexError:
+                score_dict = {}
+        logger_Scores.debug("held out round {} - {} ({} proteins): {:.2f} sec".format(os.path.basename(self.hmm_path), held_out[0], len(held_out), time.time() - start_time))
+        return score_dict
+
+    def held_out_score_computation(self, held_out_sets, workers=1, msa_list=None):
+        """one held_out_round per set of held out proteins. Rounds run in 'workers' threads (the work is done by
+        mafft/hmmer child processes); results are merged in input order, so the score_dict is the same as in a
+        serial run."""
+        msa_hash = msa_list_to_hash(msa_list) if msa_list else None
+        if workers > 1:
+            tool_context = tool_recorder.get_context()
+
+            def threaded_round(held_out):
+                with tool_recorder.context(tool_context):
+                    return self.held_out_round(held_out, msa_hash)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                round_results = list(executor.map(threaded_round, held_out_sets))
+        else:
+            round_results = [self.held_out_round(held_out, msa_hash) for held_out in held_out_sets]
+        for score_dict in round_results:
             self.score_dict.update(score_dict)
         return self.score_dict
 
+    def iterative_score_computation(self, workers=1, msa_list=None):
+        """leave-one-out scoring: one HMM per protein, built from all other proteins of the cluster"""
+        return self.held_out_score_computation([[query] for query in self.fasta_hash.keys()], workers=workers, msa_list=msa_list)
+
+    def kfold_score_computation(self, folds, workers=1, msa_list=None):
+        """k-fold cross-validation scoring: proteins are assigned to 'folds' held out sets in input order
+        (protein idx % folds); every set is scored against a HMM built from the remaining proteins"""
+        queries = list(self.fasta_hash.keys())
+        folds = min(folds, len(queries))
+        return self.held_out_score_computation([queries[fold::folds] for fold in range(0, folds)], workers=workers, msa_list=msa_list)
+
     def compute_full_phmm(self, location):
         """realignes the fasta file stored in this object but to a different location"""
         msa_string = self.generate_msa_string(self.fasta_hash.keys())
-        with tmp.NamedTemporaryFile() as msa_tmp:
-            write_to_tempfile(msa_tmp.name, msa_string)
-            generate_hmm(location, msa_tmp.name)
-        return location
+        return generate_hmm_from_msa(location, msa_string + "\n")
 
     def bulk_score_computation(self):
-        with tmp.NamedTemporaryFile() as q_tmp:
-            write_hash_to_fasta(q_tmp.name, self.fasta_hash)
-            self.score_dict = get_phmm_score(self.hmm_path, q_tmp.name)
+        fasta_string = "".join(["{}\n{}\n".format(header, seq) for header, seq in self.fasta_hash.items()])
+        self.score_dict = get_phmm_score_from_fasta(self.hmm_path, fasta_string)
         return self.score_dict
 
 
@@ -492,17 +829,26 @@ class ScoreObject:
 ########################################################################################################################
 
 class Overseer:
+    # per-cluster results which are exchanged between worker processes and the main overseer
+    per_cluster_attributes = ["group_by_file_to_cluster_hash", "group_by_file_to_length_range", "group_by_file_to_msa_obj",
+                              "group_by_file_to_hmm", "group_by_file_to_score_obj", "group_by_file_to_consensus",
+                              "group_by_file_to_twin_hash", "group_by_file_to_twin_score_obj", "group_by_file_to_twin_hmm"]
 
     def __init__(self, input_dir):
         self.input_dir = input_dir
         self.group_by_file_to_filepath = defaultdict(dict)
         self.group_to_file_list = defaultdict(list)
+        self.group_to_filtered_file_list = defaultdict(list)
         self.group_to_result_path = {}
         self.group_by_file_to_cluster_hash = defaultdict(dict)
         self.group_by_file_to_length_range = defaultdict(dict)
         self.group_by_file_to_msa_obj = defaultdict(dict)
         self.group_by_file_to_hmm = defaultdict(dict)
         self.group_by_file_to_score_obj = defaultdict(dict)
+        self.group_by_file_to_consensus = defaultdict(dict)
+        self.group_by_file_to_score_cut_off = defaultdict(dict)
+        self.group_by_file_to_cache_key = defaultdict(dict)
+        self.cached_clusters = set()
         self.input_scope = 0
         self.valid_input_scope = 0
 
@@ -515,14 +861,17 @@ class Overseer:
     ####################################################################################################################
     # Overseer - Functions to specify input/output directories and hash cluster files
     ####################################################################################################################
+    def add_cluster(self, group_name, file_name, file_path, fasta_hash):
+        self.group_by_file_to_cluster_hash[group_name][file_name] = fasta_hash
+        self.group_by_file_to_unfiltered_header_set[group_name][file_name] = set(fasta_hash.keys())
+        self.group_by_file_to_filepath[group_name][file_name] = file_path
+        self.group_to_file_list[group_name].append(file_name)
+        self.valid_input_scope += 1
+
     def feed_in_to_overseer(self, group_name, file_name, file_path):
         fasta_hash = check_and_hash_fasta(file_path, file_name)
         if fasta_hash is not None:
-            self.group_by_file_to_cluster_hash[group_name][file_name] = fasta_hash
-            self.group_by_file_to_unfiltered_header_set[group_name][file_name] = set(fasta_hash.keys())
-            self.group_by_file_to_filepath[group_name][file_name] = file_path
-            self.group_to_file_list[group_name].append(file_name)
-            self.valid_input_scope += 1
+            self.add_cluster(group_name, file_name, file_path, fasta_hash)
         else:
             logger_Filtered.warning("Not enough entries in {} - min 3\n".format(file_name))
         return 1
@@ -565,55 +914,86 @@ class Overseer:
     # Overseer - MSA/HMM generation and normal true negative score computation
     ####################################################################################################################
 
+    def clusters_to_compute(self):
+        """returns a list of (group, file_name) of all valid clusters which could not be restored from the cache"""
+        compute_list = []
+        for group, file_list in self.group_to_file_list.items():
+            for file_name in file_list:
+                if (group, file_name) not in self.cached_clusters:
+                    compute_list.append((group, file_name))
+        return compute_list
+
     def remove_filtered_files(self, removal_group_to_file_list):
         for group, file_list in removal_group_to_file_list.items():
             for file_name in file_list:
                 self.group_to_file_list[group].remove(file_name)
+                self.group_to_filtered_file_list[group].append(file_name)
                 self.valid_input_scope -= 1
         return self.valid_input_scope
 
+    def generate_cluster_hmm_and_filtered_fasta(self, group, file_name, directory):
+        """MSA -> trimming -> re-alignment -> HMM of a single cluster. Returns False if the cluster got filtered"""
+        msa_list = generate_msa(self.group_by_file_to_filepath[group][file_name])
+        msa_obj = MsaObject(msa_list, file_name, directory)
+        msa_obj.msa_to_fasta()
+        msa_obj.trim_remove()
+        if msa_obj.check_msa_size_and_length() is True:
+            if msa_obj.size_history[0] != msa_obj.size_history[-1]:
+                self.group_by_file_to_cluster_hash[group][file_name] = clean_fasta_hash(self.group_by_file_to_cluster_hash[group][file_name], msa_obj.all_header(), file_name)
+                same_msa_path = write_hash_to_fasta(msa_obj.file_path, self.group_by_file_to_cluster_hash[group][file_name], ">{}\n{}\n")
+                msa_obj.re_align(same_msa_path)
+            self.group_by_file_to_msa_obj[group][file_name] = msa_obj
+            length_hash = write_length_binned_fasta(self.group_by_file_to_cluster_hash[group][file_name], file_name, os.path.join(output_dir, file_name + ".fasta"))
+            self.group_by_file_to_length_range[group][file_name] = calculate_length_range(length_hash)
+            self.group_by_file_to_hmm[group][file_name] = generate_hmm(os.path.join(output_dir, file_name + ".hmm"), msa_obj.file_path)
+            return True
+        else:
+            logger_Filtered.warning("Filtered due to MSA benchmarking {}".format(file_name))
+            return False
+
     def generate_hmm_and_filtered_fasta(self, directory):
         count = 1
         removed_group_to_file_list = defaultdict(list)
-        for group, file_list in self.group_to_file_list.items():
-            for file_name in file_list:
-                msa_list = generate_msa(self.group_by_file_to_filepath[group][file_name])
-                msa_obj = MsaObject(msa_list, file_name, directory)
-                msa_obj.msa_to_fasta()
-                msa_obj.trim_remove()
-                if msa_obj.check_msa_size_and_length() is True:
-                    if msa_obj.size_history[0] != msa_obj.size_history[-1]:
-                        self.group_by_file_to_cluster_hash[group][file_name] = clean_fasta_hash(self.group_by_file_to_cluster_hash[group][file_name], msa_obj.all_header(), file_name)
-                        same_msa_path = write_hash_to_fasta(msa_obj.file_path, self.group_by_file_to_cluster_hash[group][file_name], ">{}\n{}\n")
-                        msa_obj.re_align(same_msa_path)
-                    self.group_by_file_to_msa_obj[group][file_name] = msa_obj
-                    length_hash = write_length_binned_fasta(self.group_by_file_to_cluster_hash[group][file_name], file_name, os.path.join(output_dir, file_name + ".fasta"))
-                    self.group_by_file_to_length_range[group][file_name] = calculate_length_range(length_hash)
-                    self.group_by_file_to_hmm[group][file_name] = generate_hmm(os.path.join(output_dir, file_name + ".hmm"), msa_obj.file_path)
-                else:
+        compute_list = self.clusters_to_compute()
+        for group, file_name in compute_list:
+            with tool_recorder.context("{}/{}".format(group, file_name)):
+                if not self.generate_cluster_hmm_and_filtered_fasta(group, file_name, directory):
                     removed_group_to_file_list[group].append(file_name)
-                    logger_Filtered.warning("Filtered due to MSA benchmarking {}".format(file_name))
-                print_progress(count, self.valid_input_scope, prefix='\tGenerating Hidden Markov Models:\t', suffix='Complete', bar_length=30)
-                count += 1
+            print_progress(count, len(compute_list), prefix='\tGenerating Hidden Markov Models:\t', suffix='Complete', bar_length=30)
+            count += 1
         return self.remove_filtered_files(removed_group_to_file_list)
 
+    def compute_cluster_hmm_scores(self, group, file_name):
+        fasta_hash = self.group_by_file_to_cluster_hash[group][file_name]
+        self.group_by_file_to_score_obj[group][file_name] = ScoreObject(fasta_hash, self.group_by_file_to_hmm[group][file_name])
+        msa_list = self.group_by_file_to_msa_obj[group][file_name].msa_list if loo_msa else None
+        if len(fasta_hash) < 20:
+            score_hash = self.group_by_file_to_score_obj[group][file_name].iterative_score_computation(workers=loo_workers, msa_list=msa_list)
+        elif score_folds:
+            score_hash = self.group_by_file_to_score_obj[group][file_name].kfold_score_computation(score_folds, workers=loo_workers, msa_list=msa_list)
+        else:
+            score_hash = self.group_by_file_to_score_obj[group][file_name].bulk_score_computation()
+        if keep:
+            keep_file = write_hash_to_fasta(os.path.join(keep_dir, "{}_{}_scores.txt".format(group, file_name)), score_hash, "{}\t{}\n")
+        return score_hash
+
     def compute_all_hmm_scores(self):
         count = 1
         print("\n")
-        for group, file_list in self.group_to_file_list.items():
-            for file_name in file_list:
-                fasta_hash = self.group_by_file_to_cluster_hash[group][file_name]
-                self.group_by_file_to_score_obj[group][file_name] = ScoreObject(fasta_hash, self.group_by_file_to_hmm[group][file_name])
-                if len(fasta_hash) < 20:
-                    score_hash = self.group_by_file_to_score_obj[group][file_name].iterative_score_computation()
-                else:
-                    score_hash = self.group_by_file_to_score_obj[group][file_name].bulk_score_computation()
-                print_progress(count, self.valid_input_scope, prefix='\tComputing HMM Score Distributions:\t', suffix='Complete', bar_length=30)
-                count += 1
-                if keep:
-                    keep_file = write_hash_to_fasta(os.path.join(keep_dir, "{}_{}_scores.txt".format(group, file_name)), score_hash, "{}\t{}\n")
+        compute_list = self.clusters_to_compute()
+        for group, file_name in compute_list:
+            with tool_recorder.context("{}/{}".format(group, file_name)):
+                self.compute_cluster_hmm_scores(group, file_name)
+            print_progress(count, len(compute_list), prefix='\tComputing HMM Score Distributions:\t', suffix='Complete', bar_length=30)
+            count += 1
         return self.group_by_file_to_score_obj
 
+    def get_cluster_consensus(self, group, file_name):
+        """infers the consensus sequence from the cluster HMM once; later calls return the stored sequence"""
+        if file_name not in self.group_by_file_to_consensus[group]:
+            self.group_by_file_to_consensus[group][file_name] = get_consensus(self.group_by_file_to_hmm[group][file_name])
+        return self.group_by_file_to_consensus[group][file_name]
+
     ####################################################################################################################
     # Overseer - Functions for generating True negative scores
     ####################################################################################################################
@@ -629,26 +1009,233 @@ class Overseer:
         self.group_by_file_to_twin_hash[group][file_name] = fasta_hash
         return fasta_hash
 
+    def compute_cluster_true_negative_hmm_scores(self, group, file_name):
+        hmm = self.group_by_file_to_hmm[group][file_name]
+        fasta_hash = self.make_cluster_specific_TN_hash(group, file_name)
+        if fasta_hash and len(fasta_hash) >= 10:
+            scoring_obj = ScoreObject(fasta_hash, hmm)
+            score_hash = scoring_obj.bulk_score_computation()
+            self.group_by_file_to_twin_score_obj[group][file_name] = scoring_obj
+            if len(fasta_hash) >= 20:
+                self.group_by_file_to_twin_hmm[group][file_name] = scoring_obj.compute_full_phmm(os.path.join(output_dir, file_name + ".TN_hmm"))
+            if keep:
+                keep_file = write_hash_to_fasta(os.path.join(keep_dir, "{}_{}_TrueNegativeScores.txt".format(group, file_name)), score_hash, "{}\t{}\n")
+            return score_hash
+        else:
+            self.group_by_file_to_twin_score_obj[group][file_name] = None
+            return None
+
     def compute_true_negative_hmm_scores(self):
         count = 1
         print("\n")
+        compute_list = self.clusters_to_compute()
+        for group, file_name in compute_list:
+            with tool_recorder.context("{}/{}".format(group, file_name)):
+                tn_score_hash = self.compute_cluster_true_negative_hmm_scores(group, file_name)
+            if tn_score_hash is not None:
+                print_progress(count, len(compute_list), prefix='\tTrue Negative Score Distributions:\t', suffix='Complete', bar_length=30)
+            count += 1
+        return self.group_by_file_to_twin_score_obj
+
+    ####################################################################################################################
+    # Overseer - Score cut offs and incremental rebuild cache
+    ####################################################################################################################
+
+    def get_score_cut_off(self, group, file_name, true_negatives=False):
+        """computes the score cut off of a cluster once (or takes it from the cache)"""
+        if file_name not in self.group_by_file_to_score_cut_off[group]:
+            score_obj = self.group_by_file_to_score_obj[group][file_name]
+            if true_negatives:
+                try:
+                    tn_scores = list(self.group_by_file_to_twin_score_obj[group][file_name].score_dict.values())
+                except AttributeError:
+                    tn_scores = [0]
+                score_cut_off = score_obj.calculate_score_distribution_parameters(true_negative_scores=tn_scores)
+            else:
+                score_cut_off = score_obj.calculate_score_distribution_parameters()
+            self.group_by_file_to_score_cut_off[group][file_name] = score_cut_off
+        return self.group_by_file_to_score_cut_off[group][file_name]
+
+    def calibrate_group_score_cut_offs(self, group, true_negatives=False):
+        """computes the score cut offs of all clusters of a group; intersections of TP and TN distributions are
+        computed in one batched call"""
+        if true_negatives:
+            batch_clusters, batch_scores = [], []
+            for file_name in self.group_to_file_list[group]:
+                if file_name not in self.group_by_file_to_score_cut_off[group]:
+                    tp_scores = list(self.group_by_file_to_score_obj[group][file_name].score_dict.values())
+                    try:
+                        tn_scores = list(self.group_by_file_to_twin_score_obj[group][file_name].score_dict.values())
+                    except AttributeError:
+                        tn_scores = [0]
+                    if tp_scores and score_lists_intersectable(tp_scores, tn_scores):
+                        batch_clusters.append(file_name)
+                        batch_scores.append((tp_scores, tn_scores))
+            for file_name, inter_point in zip(batch_clusters, find_density_intersections(batch_scores)):
+                score_obj = self.group_by_file_to_score_obj[group][file_name]
+                self.group_by_file_to_score_cut_off[group][file_name] = score_obj.set_score_cut_off(inter_point)
+        return {file_name: self.get_score_cut_off(group, file_name, true_negatives) for file_name in self.group_to_file_list[group]}
+
+    def load_cached_clusters(self, cache_dir, cache_options):
+        """computes the cache key of every cluster and restores all clusters found in the cache. Clusters that were
+        filtered in an earlier run are filtered again. Returns the number of restored clusters."""
+        removed_group_to_file_list = defaultdict(list)
         for group, file_list in self.group_to_file_list.items():
             for file_name in file_list:
-                hmm = self.group_by_file_to_hmm[group][file_name]
-                fasta_hash = self.make_cluster_specific_TN_hash(group, file_name)
-                if fasta_hash and len(fasta_hash) >= 10:
-                    scoring_obj = ScoreObject(fasta_hash, hmm)
-                    score_hash = scoring_obj.bulk_score_computation()
-                    self.group_by_file_to_twin_score_obj[group][file_name] = scoring_obj
-                    if len(fasta_hash) >= 20:
-                        self.group_by_file_to_twin_hmm[group][file_name] = scoring_obj.compute_full_phmm(os.path.join(output_dir, file_name + ".TN_hmm"))
-                    print_progress(count, self.valid_input_scope, prefix='\tTrue Negative Score Distributions:\t', suffix='Complete', bar_length=30)
-                    if keep:
-                        keep_file = write_hash_to_fasta(os.path.join(keep_dir, "{}_{}_TrueNegativeScores.txt".format(group, file_name)), score_hash, "{}\t{}\n")
+                key = get_cluster_cache_key(file_name, self.group_by_file_to_cluster_hash[group][file_name], cache_options)
+                self.group_by_file_to_cache_key[group][file_name] = key
+                cache_entry = read_cluster_cache(cache_dir, key)
+                if cache_entry is None:
+                    continue
+                elif cache_entry["filtered"]:
+                    removed_group_to_file_list[group].append(file_name)
+                    logger_Filtered.warning("Filtered due to MSA benchmarking (cached) {}".format(file_name))
                 else:
-                    self.group_by_file_to_twin_score_obj[group][file_name] = None
-                count += 1
-        return self.group_by_file_to_twin_score_obj
+                    self.restore_cluster_from_cache(group, file_name, cache_dir, cache_entry)
+        self.remove_filtered_files(removed_group_to_file_list)
+        for group, file_list in removed_group_to_file_list.items():
+            self.cached_clusters.update([(group, file_name) for file_name in file_list])
+        return len(self.cached_clusters) - sum([len(x) for x in removed_group_to_file_list.values()])
+
+    def restore_cluster_from_cache(self, group, file_name, cache_dir, cache_entry):
+        entry_dir = get_cluster_cache_dir(cache_dir, self.group_by_file_to_cache_key[group][file_name])
+        for ending in [".hmm", ".fasta", ".TN_hmm"]:
+            out_path = os.path.join(output_dir, file_name + ending)
+            if os.path.exists(os.path.join(entry_dir, "cluster" + ending)):
+                shutil.copyfile(os.path.join(entry_dir, "cluster" + ending), out_path)
+            elif os.path.exists(out_path):
+                os.remove(out_path)     # stale file of an older version of this cluster
+        hmm_path = os.path.join(output_dir, file_name + ".hmm")
+        self.group_by_file_to_hmm[group][file_name] = hmm_path
+        self.group_by_file_to_length_range[group][file_name] = cache_entry["length_range"]
+        self.group_by_file_to_consensus[group][file_name] = cache_entry["consensus"]
+        self.group_by_file_to_score_cut_off[group][file_name] = cache_entry["score_cut_off"]
+        score_obj = ScoreObject(self.group_by_file_to_cluster_hash[group][file_name], hmm_path)
+        score_obj.score_dict = cache_entry["score_dict"]
+        self.group_by_file_to_score_obj[group][file_name] = score_obj
+        if cache_entry["tn_score_dict"] is not None:
+            self.group_by_file_to_twin_score_obj[group][file_name] = ScoreObject({}, hmm_path)
+            self.group_by_file_to_twin_score_obj[group][file_name].score_dict = cache_entry["tn_score_dict"]
+        else:
+            self.group_by_file_to_twin_score_obj[group][file_name] = None
+        if os.path.exists(os.path.join(output_dir, file_name + ".TN_hmm")):
+            self.group_by_file_to_twin_hmm[group][file_name] = os.path.join(output_dir, file_name + ".TN_hmm")
+        self.cached_clusters.add((group, file_name))
+        return hmm_path
+
+    def store_clusters_in_cache(self, cache_dir):
+        """writes all clusters computed in this run to the cache; filtered clusters are stored as filtered"""
+        stored = 0
+        for group, file_name in self.clusters_to_compute():
+            twin_score_obj = self.group_by_file_to_twin_score_obj[group].get(file_name)
+            cache_entry = {"filtered": False,
+                           "length_range": [x for x in self.group_by_file_to_length_range[group][file_name]],
+                           "consensus": self.get_cluster_consensus(group, file_name),
+                           "score_cut_off": float(self.group_by_file_to_score_cut_off[group][file_name]),
+                           "score_dict": self.group_by_file_to_score_obj[group][file_name].score_dict,
+                           "tn_score_dict": twin_score_obj.score_dict if twin_score_obj else None}
+            files = {ending: os.path.join(output_dir, file_name + ending) for ending in [".hmm", ".fasta"]}
+            if file_name in self.group_by_file_to_twin_hmm[group]:
+                files[".TN_hmm"] = self.group_by_file_to_twin_hmm[group][file_name]
+            elif os.path.exists(os.path.join(output_dir, file_name + ".TN_hmm")):
+                os.remove(os.path.join(output_dir, file_name + ".TN_hmm"))     # stale file of an older version
+            write_cluster_cache(cache_dir, self.group_by_file_to_cache_key[group][file_name], cache_entry, files)
+            stored += 1
+        for group, file_list in self.group_to_filtered_file_list.items():
+            for file_name in file_list:
+                if (group, file_name) not in self.cached_clusters:
+                    write_cluster_cache(cache_dir, self.group_by_file_to_cache_key[group][file_name], {"filtered": True}, {})
+                    stored += 1
+        return stored
+
+    def remove_deleted_clusters(self, group):
+        """removes the output files of clusters which are listed in an existing group file of a former run, but
+        are no longer part of the group; the group files (.GenePS, .fa.consensus) are removed with its last cluster"""
+        group_file = self.group_to_result_path[group] + ".GenePS"
+        removed = []
+        if os.path.exists(group_file):
+            with open(group_file) as old_group:
+                for line in old_group:
+                    if line.startswith("#name:"):
+                        cluster = line.split(":")[1].strip()
+                        if cluster not in self.group_to_file_list[group]:
+                            removed.append(cluster)
+        for cluster in removed:
+            for ending in [".hmm", ".fasta", ".TN_hmm"]:
+                if os.path.exists(os.path.join(output_dir, cluster + ending)):
+                    os.remove(os.path.join(output_dir, cluster + ending))
+            logging.info("[-] {} was removed from group {}".format(cluster, group))
+        if not self.group_to_file_list[group]:
+            for group_file in [self.group_to_result_path[group] + ".GenePS", self.group_to_result_path[group] + ".fa.consensus"]:
+                if os.path.exists(group_file):
+                    os.remove(group_file)
+            logging.info("[-] group {} has no clusters left".format(group))
+        return removed
+
+    ####################################################################################################################
+    # Overseer - Parallel mode: whole cluster pipeline per worker process
+    ####################################################################################################################
+
+    def run_cluster_pipeline(self, group, file_name, directory, true_negatives=False):
+        """runs all per-cluster steps (MSA, trimming, HMM, TP scores, TN scores/TN HMM, consensus) for one cluster.
+        Returns False if the cluster got filtered during MSA benchmarking."""
+        if not self.generate_cluster_hmm_and_filtered_fasta(group, file_name, directory):
+            return False
+        self.compute_cluster_hmm_scores(group, file_name)
+        if true_negatives:
+            self.compute_cluster_true_negative_hmm_scores(group, file_name)
+        self.get_cluster_consensus(group, file_name)
+        return True
+
+    def export_cluster(self, group, file_name):
+        """returns all per-cluster results as dict of attribute_name: value, used to send results between processes"""
+        cluster_results = {}
+        for attribute in self.per_cluster_attributes:
+            attribute_dict = getattr(self, attribute)[group]
+            if file_name in attribute_dict:
+                cluster_results[attribute] = attribute_dict[file_name]
+        return cluster_results
+
+    def import_cluster(self, group, file_name, cluster_results):
+        for attribute, value in cluster_results.items():
+            getattr(self, attribute)[group][file_name] = value
+
+    def run_cluster_pipeline_pool(self, directory, jobs, true_negatives=False):
+        """distributes the per-cluster pipeline over a pool of 'jobs' worker processes. Results are merged back into
+        this overseer in input order, as in a serial run; log records of the workers are written by the main process."""
+        count = 1
+        removed_group_to_file_list = defaultdict(list)
+        cluster_jobs = []
+        for group, file_name in self.clusters_to_compute():
+            cluster_jobs.append((group, file_name, self.group_by_file_to_filepath[group][file_name],
+                                 self.group_by_file_to_cluster_hash[group][file_name], directory, true_negatives))
+        if not cluster_jobs:
+            return self.valid_input_scope
+        log_queue, log_listener = start_log_listener()
+        try:
+            with get_process_pool(jobs, initializer=init_worker_logging, initargs=(log_queue,)) as pool:
+                for group, file_name, passed, cluster_results, tool_records in pool.imap(build_cluster_worker, cluster_jobs):
+                    tool_recorder.records.extend(tool_records)
+                    if passed:
+                        self.import_cluster(group, file_name, cluster_results)
+                    else:
+                        removed_group_to_file_list[group].append(file_name)
+                    print_progress(count, len(cluster_jobs), prefix='\tBuilding Cluster Models:\t\t', suffix='Complete', bar_length=30)
+                    count += 1
+        finally:
+            log_listener.stop()
+        return self.remove_filtered_files(removed_group_to_file_list)
+
+
+def build_cluster_worker(cluster_job):
+    """worker function of the cluster pool: runs the complete pipeline for one cluster in a private overseer"""
+    group, file_name, file_path, fasta_hash, directory, true_negatives = cluster_job
+    cluster_overseer = Overseer(file_path)
+    cluster_overseer.add_cluster(group, file_name, file_path, fasta_hash)
+    tool_recorder.drain()   # records inherited from the main process
+    with tool_recorder.context("{}/{}".format(group, file_name)):
+        passed = cluster_overseer.run_cluster_pipeline(group, file_name, directory, true_negatives=true_negatives)
+    return group, file_name, passed, cluster_overseer.export_cluster(group, file_name), tool_recorder.drain()
 
 
 ##################
@@ -659,7 +1246,13 @@ console = logging.StreamHandler()
 console.setLevel(logging.INFO)
 logger_Filtered = logging.getLogger("Filtered")
 logger_TN_Warning = logging.getLogger("OrthofinderFiles")
-output_dir, einsi, subset = None, None, None
+logger_Scores = logging.getLogger("Scores")
+output_dir, einsi, subset, keep = None, None, None, None
+loo_workers, loo_msa, score_folds = 1, None, None
+blast_index, blast_top_hits = None, 100
+proteome_index = None
+intron_model = (5, 500)
+__cache_version__ = 1
 
 ########################################################################################################################
 # main
@@ -673,22 +1266,38 @@ if __name__ == "__main__":
     keep = args['--keep']
     einsi = args['--einsi']
     subset = args['--subset']
+    loo_msa = args['--loo_msa']
     true_negative_file = args['--orthofinder_files']
+    cache_dir = get_outdir(args['--cache']) if args['--cache'] else None
+    try:
+        jobs = max(1, int(args['--jobs']))
+        loo_workers = max(1, int(args['--loo_workers']))
+        blast_top_hits = max(1, int(args['--blast_top_hits']))
+        if args['--score_folds']:
+            score_folds = int(args['--score_folds'])
+        intron_model = tuple([int(x) for x in args['--intron_model'].split(",")])
+        tool_scheduler.configure(threads=int(args['--threads']) if args['--threads'] else None,
+                                 tool_threads=int(args['--tool_threads']) if args['--tool_threads'] else None,
+                                 timeout=int(args['--timeout']) if args['--timeout'] else None)
+    except ValueError:
+        sys.exit("\t[!] FATAL ERROR: --jobs, --loo_workers, --score_folds, --blast_top_hits, --intron_model, --threads, --tool_threads and --timeout need integers\n")
+    if len(intron_model) != 2:
+        sys.exit("\t[!] FATAL ERROR: --intron_model needs two integers: introns per kb and intron length, e.g. 5,500\n")
+    if score_folds is not None and score_folds < 2:
+        sys.exit("\t[!] FATAL ERROR: --score_folds needs at least 2 folds\n")
     check_programs("hmmsearch", "hmmemit", "hmmbuild", "mafft", "trimal")
 
     print("\n{}\n# GenePS #\n{}\n\nPreparing Files...\n".format("#"*10, "#"*10))
     # if true negative translation files provided
-    blast_specID_protID_hitList = defaultdict(lambda: defaultdict(list))
-    idPair_2_namePair, namePair_2_idPair = {}, {}
-    all_protein_fasta_dict = {}
 
     if true_negative_file:
         tn_args = parse_true_negative_arg(true_negative_file)
         blast_path, blast_file_set = get_blast_files(tn_args["blast_dir"])
-        idPair_2_namePair, namePair_2_idPair = hash_sequence_translation_file(tn_args["sequenceIDs"])
-        all_protein_fasta_dict = hash_fasta(tn_args["proteins"])
+        proteome_index = index_proteome(os.path.abspath(args['--proteome_index'] or os.path.join(output_dir, "proteome_index.sqlite")),
+                                        tn_args["proteins"], tn_args["sequenceIDs"])
         species_ids = hash_species_translation_file(tn_args["speciesIDs"])
-        number_blast_files = hash_all_blast_files(species_ids)
+        blast_index_path = os.path.abspath(args['--blast_index'] or os.path.join(output_dir, "blast_index.sqlite"))
+        blast_index, number_blast_files = index_all_blast_files(blast_index_path, blast_path, species_ids, blast_top_hits, jobs=jobs)
         if not number_blast_files - len(species_ids) == 0:
             print("\t[!] FATAL ERROR: Not all Blast files could be hashed\n")
             sys.exit()
@@ -701,34 +1310,48 @@ if __name__ == "__main__":
     overseer_obj = Overseer(infile)
     filtered_data_scope = overseer_obj.initialize_input_data()
     logging.info("# {} groups and {} files\n".format(len(overseer_obj.group_to_file_list), str(overseer_obj.input_scope)))
+    if cache_dir:
+        cached_scope = overseer_obj.load_cached_clusters(cache_dir, get_cache_options(tn_args if true_negative_file else None))
+        print("\t{} cluster(s) restored from cache\n".format(cached_scope))
+        logging.info("# {} clusters restored from cache: {}\n".format(cached_scope, cache_dir))
     with tempdir() as temp_dir:
-        filtered_data_scope = overseer_obj.generate_hmm_and_filtered_fasta(temp_dir)
-        if not filtered_data_scope > 0:
-            print("\t[!] FATAL ERROR: NO Multiple Sequence Alignments computable\n")
-            sys.exit()
-        TP_score_hashes = overseer_obj.compute_all_hmm_scores()
-        if true_negative_file:
-            TN_scores_hash = overseer_obj.compute_true_negative_hmm_scores()
+        if jobs > 1:
+            filtered_data_scope = overseer_obj.run_cluster_pipeline_pool(temp_dir, jobs, true_negatives=bool(true_negative_file))
+            if not filtered_data_scope > 0:
+                print("\t[!] FATAL ERROR: NO Multiple Sequence Alignments computable\n")
+                sys.exit()
+        else:
+            filtered_data_scope = overseer_obj.generate_hmm_and_filtered_fasta(temp_dir)
+            if not filtered_data_scope > 0:
+                print("\t[!] FATAL ERROR: NO Multiple Sequence Alignments computable\n")
+                sys.exit()
+            TP_score_hashes = overseer_obj.compute_all_hmm_scores()
+            if true_negative_file:
+                TN_scores_hash = overseer_obj.compute_true_negative_hmm_scores()
 
         print("\n")
         read_count = 1
         for name_group, all_files in overseer_obj.group_to_file_list.items():
             outfile_path = overseer_obj.group_to_result_path[name_group]
+            if cache_dir:
+                overseer_obj.remove_deleted_clusters(name_group)
+            if not all_files:
+                logging.warning("[!] no valid clusters in group {}; no group file written".format(name_group))
+                continue
+            overseer_obj.calibrate_group_score_cut_offs(name_group, true_negatives=bool(true_negative_file))
             with open(outfile_path + ".GenePS", "w") as results_file, open(outfile_path + ".fa.consensus", "w") as consensus_f:
                 results_file.write("group: {}\ngroup_size: {}\n".format(name_group, str(len(all_files))))
                 for cluster_name in all_files:
-                    consensus_f.write(">{}\n{}\n".format(cluster_name, get_consensus(overseer_obj.group_by_file_to_hmm[name_group][cluster_name])))
+                    with tool_recorder.context("{}/{}".format(name_group, cluster_name)):
+                        consensus_f.write(">{}\n{}\n".format(cluster_name, overseer_obj.get_cluster_consensus(name_group, cluster_name)))
                     length_range = overseer_obj.group_by_file_to_length_range[name_group][cluster_name]
-                    if true_negative_file:
-                        try:
-                            tn_scores = list(overseer_obj.group_by_file_to_twin_score_obj[name_group][cluster_name].score_dict.values())
-                        except AttributeError:
-                            tn_scores = [0]
-                        score_cut_off = overseer_obj.group_by_file_to_score_obj[name_group][cluster_name].calculate_score_distribution_parameters(true_negative_scores=tn_scores)
-                    else:
-                        score_cut_off = overseer_obj.group_by_file_to_score_obj[name_group][cluster_name].calculate_score_distribution_parameters() # if score cut off is not none
+                    score_cut_off = overseer_obj.get_score_cut_off(name_group, cluster_name, true_negatives=bool(true_negative_file))
                     results_file.write("#name: {}\n#score_cut_off: {}\n#length_range: {},{}\n".format(cluster_name, score_cut_off, length_range[0], length_range[1]))
+                    results_file.write("#span: {},{}\n".format(*get_expected_span(length_range, intron_model)))
                     print_progress(read_count, overseer_obj.valid_input_scope, prefix='\tWriting Results to Files:\t\t', suffix='Complete', bar_length=30)
                     read_count += 1
+        if cache_dir:
+            overseer_obj.store_clusters_in_cache(cache_dir)
     logging.info("# {} successfully processed files\n".format(overseer_obj.valid_input_scope))
+    logging.info("# external tool usage: {}\n".format(tool_recorder.write_report(output_dir)))
     print("\nDONE!\n")
@@ -4,8 +4,21 @@ import shutil
 import sys
 import contextlib
 import os
+import logging
+import logging.handlers
+import multiprocessing
+import mmap
+import json
+import time
+import threading
+import functools
+import math
 import tempfile as tmp
 from collections import defaultdict
+try:
+    import pyhmmer
+except ImportError:
+    pyhmmer = None
 
 
 def hash_fasta(fasta_file):
@@ -31,6 +44,33 @@ def hash_fasta(fasta_file):
         return None
 
 
+def index_fasta_offsets(fasta_file):
+    """faidx style index of a fasta file: yields (>header, byte offset of the sequence, byte length of the sequence
+    lines) for each entry. Headers are cut at the first space as in hash_fasta."""
+    header, offset, position = None, 0, 0
+    with open(fasta_file, "rb") as fasta_f:
+        for line in fasta_f:
+            if line.startswith(b">"):
+                if header is not None:
+                    yield header, offset, position - offset
+                header = line.strip().split(b" ")[0].decode()
+                offset = position + len(line)
+            position += len(line)
+    if header is not None:
+        yield header, offset, position - offset
+
+
+def map_fasta_file(fasta_file):
+    """read-only memory map of a fasta file"""
+    with open(fasta_file, "rb") as fasta_f:
+        return mmap.mmap(fasta_f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_fasta_sequence(fasta_map, offset, length):
+    """sequence at offset of a memory mapped fasta file without line breaks"""
+    return b"".join(fasta_map[offset:offset + length].split()).decode()
+
+
 def write_hash_to_fasta(file_path, dictionary, line_style="{}\n{}\n"):
     """writes a hash to a file in the given line_style. Line style default writes key and value to separate lines.
     If value is a list it joins elements without spaces."""
@@ -67,9 +107,80 @@ def generate_hmm(hmm_path, msa_path):
     return hmm_path
 
 
+def generate_hmm_from_msa(hmm_path, msa_string):
+    """builds hidden markov model from a MSA string in aligned fasta format, fed to hmmbuild via stdin"""
+    command = ["hmmbuild", "-o", "/dev/null", "--informat", "afa", hmm_path, "-"]
+    pipe_cmd(command, msa_string)
+    return hmm_path
+
+
+hmmer_backend = "pyhmmer" if pyhmmer is not None else "hmmsearch"
+
+
+def set_hmmer_backend(backend):
+    """selects 'pyhmmer' (in-process, if installed) or 'hmmsearch' (subprocess); returns the backend in use"""
+    global hmmer_backend
+    if backend not in ["pyhmmer", "hmmsearch"]:
+        raise ValueError("[!] unknown HMMER backend: {}".format(backend))
+    hmmer_backend = backend if pyhmmer is not None else "hmmsearch"
+    return hmmer_backend
+
+
+def read_hmm(hmm_file):
+    with pyhmmer.plan7.HMMFile(hmm_file) as hmm_f:
+        return hmm_f.read()
+
+
+@functools.lru_cache(maxsize=256)
+def load_hmm(hmm_file, size, mtime):
+    """parsed HMM of a file; cached by path, size and modification time, so every cluster HMM is only read once"""
+    return read_hmm(hmm_file)
+
+
+def fasta_string_to_sequences(fasta_string, alphabet):
+    """digital sequences of a fasta string; names are cut at the first space as by hmmsearch"""
+    sequences = []
+    name, sequence_lines = None, []
+    for line in fasta_string.splitlines() + [">"]:
+        if line.startswith(">"):
+            if name is not None:
+                sequences.append(pyhmmer.easel.TextSequence(name=name.encode(), sequence="".join(sequence_lines).upper()).digitize(alphabet))
+            name, sequence_lines = (line[1:].split() or [""])[0], []
+        else:
+            sequence_lines.append(line.strip())
+    return pyhmmer.easel.DigitalSequenceBlock(alphabet, sequences)
+
+
+def get_phmm_score_in_process(hmm_file, fasta_string, search_space=None, domain_search_space=None, cache_hmm=True):
+    """get_phmm_score_from_fasta with the HMMER library (pyhmmer) instead of a hmmsearch process; the score is
+    computed from the reported domains as in the domain table (full sequence score with one decimal)"""
+    start_time = time.time()
+    if cache_hmm:
+        stat = os.stat(hmm_file)
+        hmm = load_hmm(hmm_file, stat.st_size, stat.st_mtime_ns)
+    else:
+        hmm = read_hmm(hmm_file)
+    sequences = fasta_string_to_sequences(fasta_string, hmm.alphabet)
+    options = {option: value for option, value in [("Z", search_space), ("domZ", domain_search_space)] if value}
+    domain_rows = []
+    with tool_scheduler.reserve(1):
+        for top_hits in pyhmmer.hmmer.hmmsearch(hmm, sequences, cpus=1, **options):
+            for hit in top_hits:
+                if hit.reported:
+                    score = float("{:.1f}".format(hit.score))
+                    name = hit.name.decode() if isinstance(hit.name, bytes) else hit.name    # bytes before pyhmmer 0.11
+                    domain_rows.extend([(name, hit.length, score, domain.alignment.target_from, domain.alignment.target_to)
+                                        for domain in hit.domains if domain.reported])
+    tool_recorder.record(["pyhmmer", "hmmsearch", hmm_file], time.time() - start_time, None, None, len(fasta_string), 0, 0)
+    return compute_domain_scores(domain_rows)
+
+
 def get_phmm_score(hmm_file, query_file):
     """aligns query-fasta-file against HMM and returns a score hash in style of >header:score.
     The score is defined by: sum(score domains)/Ndomains * sum(DOMAINend-DOMAINstart/query_lengt, ...)"""
+    if hmmer_backend == "pyhmmer":
+        with open(query_file) as query_f:
+            return get_phmm_score_from_fasta(hmm_file, query_f.read())
     with tmp.NamedTemporaryFile() as domtblout:
         command = ["hmmsearch", "--domtblout", domtblout.name, "--noali", hmm_file, query_file]
         run_cmd(command=command, wait=True)
@@ -77,19 +188,55 @@ def get_phmm_score(hmm_file, query_file):
     return final_score_hash
 
 
+def get_phmm_score_from_fasta(hmm_file, fasta_string, search_space=None, domain_search_space=None, cache_hmm=True):
+    """same as get_phmm_score, but the queries are fed to hmmsearch as fasta string via stdin and the domain table
+    is read from stdout. With search_space (-Z), sequence E-values (reporting thresholds) are computed for that many
+    sequences instead of the number of queries; domain_search_space (--domZ) does the same for domain E-values.
+    Both 1 score every query as if it was searched alone. Temporary HMMs (cache_hmm=False) are not kept in the
+    HMM cache of the in-process backend."""
+    if not fasta_string.strip():    # hmmsearch rejects empty input
+        return {}
+    if hmmer_backend == "pyhmmer":
+        try:
+            return get_phmm_score_in_process(hmm_file, fasta_string, search_space, domain_search_space, cache_hmm)
+        except (ValueError, OSError) as error:     # e.g. symbols the library does not digitize; hmmsearch decides
+            logging.getLogger("Tools").debug("pyhmmer failed ({}), falling back to hmmsearch".format(error))
+    command = ["hmmsearch", "-o", "/dev/null", "--domtblout", "/dev/stdout", "--noali", "--tformat", "fasta"]
+    if search_space:
+        command += ["-Z", str(search_space)]
+    if domain_search_space:
+        command += ["--domZ", str(domain_search_space)]
+    command += [hmm_file, "-"]
+    return parse_hmmer_domain_lines(pipe_cmd(command, fasta_string).splitlines())
+
+
 def parse_hmmer_domain_table(hmmer_table):
-    score_dict = {}
-    coverage_dict = defaultdict(list)
-    for line in open(hmmer_table):
+    with open(hmmer_table) as table:
+        return parse_hmmer_domain_lines(table)
+
+
+def parse_hmmer_domain_lines(hmmer_lines):
+    domain_rows = []
+    for line in hmmer_lines:
         if not line.startswith("#"):
             line = line.strip("\n").split()
-            if ">" + line[0] not in coverage_dict:
-                score_dict[">" + line[0]] = float(line[7])/float(line[2])
-                coverage_dict[">" + line[0]].append([float(line[17]), float(line[18])])
-            elif coverage_dict[">" + line[0]][-1][1] >= float(line[17]):
-                coverage_dict[">" + line[0]][-1][1] = float(line[18])
-            else:
-                coverage_dict[">" + line[0]].append([float(line[17]), float(line[18])])
+            domain_rows.append((line[0], float(line[2]), float(line[7]), float(line[17]), float(line[18])))
+    return compute_domain_scores(domain_rows)
+
+
+def compute_domain_scores(domain_rows):
+    """score per target from its domains (target, target length, full sequence score, alignment from, alignment to):
+    length normalized score times the length covered by the domain alignments"""
+    score_dict = {}
+    coverage_dict = defaultdict(list)
+    for target, target_length, score, ali_from, ali_to in domain_rows:
+        if ">" + target not in coverage_dict:
+            score_dict[">" + target] = float(score)/float(target_length)
+            coverage_dict[">" + target].append([float(ali_from), float(ali_to)])
+        elif coverage_dict[">" + target][-1][1] >= float(ali_from):
+            coverage_dict[">" + target][-1][1] = float(ali_to)
+        else:
+            coverage_dict[">" + target].append([float(ali_from), float(ali_to)])
     return {header: round(score_dict[header] * (sum([x[1]-x[0] for x in coverage]))) for header, coverage in coverage_dict.items()}
 
 
@@ -103,6 +250,15 @@ def get_consensus(hmm_file):
     return "".join(cons_list)
 
 
+def get_expected_span(length_range, intron_model=(5, 500)):
+    """shortest and longest expected genomic span (bp) of the genes of a cluster: 3 bp per amino acid of the
+    length range (no introns for the shortest span) plus, for the longest span, intron_model[0] introns of
+    intron_model[1] bp per kb of coding sequence"""
+    min_cds, max_cds = [max(0, int(round(3 * float(length)))) for length in length_range]
+    introns = int(math.ceil(max_cds * intron_model[0] / 1000.0))
+    return min_cds, max_cds + introns * int(intron_model[1])
+
+
 def print_progress(iteration, total, prefix='', suffix='', decimals=1, bar_length=100):
     """
     Call in a loop to create terminal progress bar
@@ -149,23 +305,306 @@ def find_intersection_normal_distribution(m_p, m_n, std_p, std_n):
 '''
 
 
+class ToolScheduler:
+    """all external tools are started through this scheduler. With a thread budget, every call takes as many
+    threads as it uses from a budget shared by all threads and (fork) worker processes and waits while the budget
+    is used up. Multi-threaded tools get their thread flag set to 'tool_threads'. Calls running longer than
+    'timeout' seconds are killed. Unconfigured, tools are started as they come without flags or timeout."""
+    thread_flags = {"mafft": "--thread", "einsi": "--thread", "hmmbuild": "--cpu", "hmmsearch": "--cpu",
+                    "tblastn": "-num_threads"}
+
+    def __init__(self):
+        self.threads = None
+        self.tool_threads = None
+        self.timeout = None
+        self.condition = None
+        self.free_threads = None
+
+    def configure(self, threads=None, tool_threads=None, timeout=None):
+        """has to be called before worker processes are forked, so they share the budget"""
+        self.threads = threads
+        self.tool_threads = tool_threads if tool_threads else (1 if threads else None)
+        if self.threads and self.tool_threads:
+            self.tool_threads = min(self.tool_threads, self.threads)
+        self.timeout = timeout
+        context = multiprocessing.get_context("fork")
+        self.condition = context.Condition()
+        self.free_threads = context.RawValue("i", threads or 0)
+
+    def prepare_command(self, command):
+        """returns the command with thread flag (if any) and the number of threads the call will use. A thread flag
+        already set by the caller is kept (capped by the budget) instead of 'tool_threads'."""
+        if type(command) != list:
+            command = command.split()  # sanitation
+        flag = self.thread_flags.get(os.path.basename(command[0]))
+        if flag and flag in command[:-1]:
+            flag_idx = command.index(flag) + 1
+            threads = min(int(command[flag_idx]), self.threads) if self.threads else int(command[flag_idx])
+            return command[:flag_idx] + [str(threads)] + command[flag_idx + 1:], threads
+        if flag and self.tool_threads:
+            return [command[0], flag, str(self.tool_threads)] + command[1:], self.tool_threads
+        return command, 1
+
+    @contextlib.contextmanager
+    def reserve(self, threads):
+        """blocks until 'threads' threads of the budget are free and holds them while the call runs"""
+        if not self.threads:
+            yield
+            return
+        with self.condition:
+            while self.free_threads.value < threads:
+                self.condition.wait()
+            self.free_threads.value -= threads
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.free_threads.value += threads
+                self.condition.notify_all()
+
+    def start_timer(self, process, command, on_kill=None):
+        """kills process after timeout seconds (and calls on_kill); returns the started timer or None"""
+        if not self.timeout:
+            return None
+
+        def kill_process():
+            if process.returncode is None:
+                logging.getLogger("Tools").warning("[!] killed after {} sec: {}".format(self.timeout, " ".join(command)))
+                if on_kill is not None:
+                    on_kill()
+                process.kill()
+        timer = threading.Timer(self.timeout, kill_process)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+
+tool_scheduler = ToolScheduler()
+
+
+class ToolUsageRecorder:
+    """records every external tool call (tool, arguments, wall time, CPU time, peak RSS, input/output bytes) with
+    the stage of the tool and the context (e.g. group/cluster) set by the calling thread. Worker processes hand
+    their records to the main process, which writes the report next to LOG.txt."""
+    tool_to_stage = {"mafft": "MSA", "einsi": "MSA", "trimal": "trimming", "hmmbuild": "HMM build",
+                     "hmmsearch": "scoring", "hmmemit": "consensus", "makeblastdb": "BLAST", "tblastn": "BLAST",
+                     "blastdbcmd": "region extraction", "exonerate": "exonerate", "pyhmmer": "scoring"}
+    fields = ["tool", "stage", "context", "arguments", "wall_sec", "cpu_sec", "max_rss_kb", "input_bytes",
+              "output_bytes", "return_code"]
+
+    def __init__(self):
+        self.records = []
+        self.local = threading.local()
+
+    def get_context(self):
+        return getattr(self.local, "context", "-")
+
+    @contextlib.contextmanager
+    def context(self, label):
+        previous = self.get_context()
+        self.local.context = label
+        try:
+            yield
+        finally:
+            self.local.context = previous
+
+    def record(self, command, wall_time, cpu_time, max_rss, input_bytes, output_bytes, return_code):
+        tool = os.path.basename(command[0])
+        arguments = " ".join([os.path.basename(arg) if os.sep in arg else arg for arg in command[1:]])
+        self.records.append({"tool": tool, "stage": self.tool_to_stage.get(tool, "other"), "context": self.get_context(),
+                             "arguments": arguments[:200], "wall_sec": round(wall_time, 3),
+                             "cpu_sec": round(cpu_time, 3) if cpu_time is not None else None, "max_rss_kb": max_rss,
+                             "input_bytes": input_bytes, "output_bytes": output_bytes, "return_code": return_code})
+
+    def drain(self):
+        """returns and removes all records of this process"""
+        records, self.records = self.records, []
+        return records
+
+    def summarize(self, key):
+        """sums up calls, times and bytes (maximum of RSS) of all records per value of key"""
+        summary = defaultdict(lambda: {"calls": 0, "wall_sec": 0.0, "cpu_sec": 0.0, "max_rss_kb": 0, "input_bytes": 0, "output_bytes": 0})
+        for record in self.records:
+            entry = summary[record[key]]
+            entry["calls"] += 1
+            for field in ["wall_sec", "cpu_sec", "input_bytes", "output_bytes"]:
+                entry[field] += record[field] or 0
+            entry["max_rss_kb"] = max(entry["max_rss_kb"], record["max_rss_kb"] or 0)
+        for entry in summary.values():
+            entry["wall_sec"], entry["cpu_sec"] = round(entry["wall_sec"], 3), round(entry["cpu_sec"], 3)
+        return dict(sorted(summary.items(), key=lambda item: item[1]["wall_sec"], reverse=True))
+
+    def write_report(self, directory, prefix="tool_usage"):
+        """writes all calls to <prefix>.tsv and the sums per stage, tool and context to <prefix>.json"""
+        with open(os.path.join(directory, prefix + ".tsv"), "w") as tsv:
+            tsv.write("\t".join(self.fields) + "\n")
+            for record in self.records:
+                tsv.write("\t".join([str(record[field]) for field in self.fields]) + "\n")
+        with open(os.path.join(directory, prefix + ".json"), "w") as report:
+            json.dump({"stages": self.summarize("stage"), "tools": self.summarize("tool"),
+                       "contexts": self.summarize("context")}, report, indent=1)
+        return os.path.join(directory, prefix + ".json")
+
+
+tool_recorder = ToolUsageRecorder()
+
+
+def get_file_args(command):
+    """(size, modification time) of all arguments which are existing files"""
+    file_args = {}
+    for arg in command[1:]:
+        if not arg.startswith("/dev/") and os.path.isfile(arg):
+            stat = os.stat(arg)
+            file_args[arg] = (stat.st_size, stat.st_mtime)
+    return file_args
+
+
+class ToolCallError(Exception):
+    """an external tool exited with an error or was killed after the timeout; its output is incomplete"""
+
+    def __init__(self, command, return_code, killed=False):
+        self.command = command
+        self.return_code = return_code
+        self.killed = killed
+        if killed:
+            message = "[!] killed after timeout: {}".format(" ".join(command))
+        else:
+            message = "[!] exit code {}: {}".format(return_code, " ".join(command))
+        super().__init__(message)
+
+
+class ToolCall:
+    """one external tool call: takes its threads from the scheduler, starts the process, kills it on timeout and
+    records its resource usage (os.wait4) when finished. Input bytes are stdin plus existing file arguments, output
+    bytes are stdout plus file arguments written by the tool. Leaving the call raises ToolCallError if the tool
+    was killed or exited with an error, so its output is never used as a result."""
+
+    def __init__(self, command, input_string=None, stderr=subprocess.STDOUT):
+        self.command, self.threads = tool_scheduler.prepare_command(command)
+        self.input_string = input_string
+        self.stderr = stderr
+        self.output_bytes = 0
+        self.killed = False
+
+    def __enter__(self):
+        self.reservation = tool_scheduler.reserve(self.threads)
+        self.reservation.__enter__()
+        self.files_before = get_file_args(self.command)
+        self.start_time = time.time()
+        try:
+            self.process = subprocess.Popen(self.command,
+                                            stdin=subprocess.PIPE if self.input_string is not None else subprocess.DEVNULL,
+                                            stdout=subprocess.PIPE,
+                                            stderr=self.stderr,
+                                            universal_newlines=True,
+                                            bufsize=-1)
+        except OSError:
+            self.reservation.__exit__(*sys.exc_info())
+            raise
+        self.timer = tool_scheduler.start_timer(self.process, self.command, on_kill=self.mark_killed)
+        if self.input_string is not None:
+            self.writer = threading.Thread(target=self.write_input)
+            self.writer.start()
+        return self
+
+    def mark_killed(self):
+        self.killed = True
+
+    def write_input(self):
+        try:
+            self.process.stdin.write(self.input_string)
+            self.process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+
+    def read_all(self):
+        stream_data = self.process.stdout.read()
+        self.output_bytes += len(stream_data)
+        return stream_data
+
+    def read_lines(self):
+        for line in iter(self.process.stdout.readline, ''):
+            self.output_bytes += len(line)
+            yield line
+
+    def reap(self):
+        """waits for the process and returns its CPU time and peak RSS (None if it was already reaped)"""
+        try:
+            pid, status, rusage = os.wait4(self.process.pid, 0)
+            self.process.returncode = os.waitstatus_to_exitcode(status)
+            return rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss
+        except ChildProcessError:
+            self.process.wait()
+            return None, None
+
+    def __exit__(self, *exc_info):
+        try:
+            self.process.stdout.close()
+            if self.input_string is not None:
+                self.writer.join()
+            cpu_time, max_rss = self.reap()
+            if self.timer:
+                self.timer.cancel()
+            wall_time = time.time() - self.start_time
+            input_bytes = len(self.input_string) if self.input_string is not None else 0
+            input_bytes += sum([size for size, mtime in self.files_before.values()])
+            output_bytes = self.output_bytes + sum([size for arg, (size, mtime) in get_file_args(self.command).items()
+                                                    if self.files_before.get(arg) != (size, mtime)])
+            tool_recorder.record(self.command, wall_time, cpu_time, max_rss, input_bytes, output_bytes, self.process.returncode)
+        finally:
+            self.reservation.__exit__(*exc_info)
+        if exc_info[0] is None and (self.killed or self.process.returncode != 0):
+            raise ToolCallError(self.command, self.process.returncode, killed=self.killed)
+        return False
+
+
 def run_cmd(**kwargs):
-    cmd = kwargs['command']
-    if type(cmd) != list:
-        cmd = kwargs['command'].split() # sanitation
-    p = subprocess.Popen(cmd,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT,
-                         universal_newlines=True,
-                         bufsize=-1)
     wait = kwargs.get('wait', False)
     if wait:
-        stream_data = p.communicate()[0]
-        p.wait()
-        if p.returncode == 0:
-            pass
+        with ToolCall(kwargs['command']) as tool_call:
+            stream_data = tool_call.read_all()
     else:
-        return iter(p.stdout.readline, '')
+        return read_cmd_lines(kwargs['command'])
+
+
+def read_cmd_lines(command):
+    """yields the output lines of a command; the call is finished (threads given back, usage recorded) when the
+    generator is exhausted or closed. Raises ToolCallError after the last line if the tool failed."""
+    with ToolCall(command) as tool_call:
+        for line in tool_call.read_lines():
+            yield line
+
+
+def pipe_cmd(command, input_string=None):
+    """runs command with input_string as stdin and returns the complete stdout as string. Unlike run_cmd, stderr is
+    not mixed into the output (mafft reports its progress there)."""
+    with ToolCall(command, input_string=input_string, stderr=subprocess.DEVNULL) as tool_call:
+        stream_data = tool_call.read_all()
+    return stream_data
+
+
+def get_process_pool(jobs, initializer=None, initargs=()):
+    """returns a fork-based process pool, so workers inherit the module state (options, hashed input files)
+    set in the main process"""
+    return multiprocessing.get_context("fork").Pool(processes=jobs, initializer=initializer, initargs=initargs)
+
+
+def start_log_listener():
+    """returns a queue and a running listener which forwards log records from worker processes to the
+    handlers of the root logger in the main process (e.g. LOG.txt)"""
+    log_queue = multiprocessing.get_context("fork").Queue()
+    listener = logging.handlers.QueueListener(log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+    listener.start()
+    return log_queue, listener
+
+
+def init_worker_logging(log_queue):
+    """pool initializer: replaces the inherited root handlers of a worker by a single queue handler"""
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(logging.DEBUG)
 
 
 def which(program):
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 import unittest
 import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
 import build_models
 import tempfile as tmp
@@ -48,6 +51,12 @@ class TestHashFasta(unittest.TestCase):
         single_seq = len(self.fa_hash[">AMELL.GB42352-PA"])
         self.assertEqual(single_seq, 942)
 
+    def test_fasta_offset_index_equals_hash_fasta(self):
+        fasta_map = shared_code_box.map_fasta_file(os.path.join(test_data, file_name))
+        offset_hash = {header: shared_code_box.read_fasta_sequence(fasta_map, offset, length)
+                       for header, offset, length in shared_code_box.index_fasta_offsets(os.path.join(test_data, file_name))}
+        self.assertDictEqual(offset_hash, self.fa_hash)
+
 
 class TestCleanFastaHash(unittest.TestCase):
 
@@ -101,12 +110,24 @@ class TestIntersectionPoint(unittest.TestCase):
 
     def test_normal_intersection(self):
         interpoint = build_models.find_density_intersection(self.tp, self.tn)
-        self.assertEqual(interpoint, 300)
+        self.assertEqual(interpoint, 301)
 
     def test_identical_distributions(self):
         interpoint = build_models.find_density_intersection(self.tn, self.tn)
         self.assertEqual(interpoint, None)
 
+    def test_separated_distributions_midpoint(self):
+        interpoint = build_models.find_density_intersection([x + 400 for x in self.tp], self.tn)
+        self.assertEqual(interpoint, round((max(self.tn) + min(self.tp) + 400) / 2))
+
+    def test_grid_bandwidth_equals_estimate_on_grid(self):
+        self.assertAlmostEqual(build_models.grid_bandwidth(560.0), 29.400280056011187, places=8)
+
+    def test_batch_intersections_equal_single(self):
+        tp_tn_list = [(self.tp, self.tn), (self.tn, self.tn), ([x * 2 for x in self.tp], self.tn)]
+        single = [build_models.find_density_intersection(tp, tn) for tp, tn in tp_tn_list]
+        self.assertEqual(build_models.find_density_intersections(tp_tn_list), single)
+
 
 class TestLengthBinnedFasta(unittest.TestCase):
 
@@ -156,6 +177,131 @@ class TestGetpHmmScores(unittest.TestCase):
         score_dict = shared_code_box.parse_hmmer_domain_table(self.hmm_search_score_file)
         self.assertEqual(1336, score_dict[">SSCAP.L892_g29260.t1"])
 
+    def test_hmmsearch_stdout_lines_equal_table(self):
+        with open(self.hmm_search_score_file) as table:
+            score_dict = shared_code_box.parse_hmmer_domain_lines(table.read().splitlines())
+        self.assertDictEqual(score_dict, shared_code_box.parse_hmmer_domain_table(self.hmm_search_score_file))
+
+    def test_domain_scores_from_rows_equal_table(self):
+        with open(self.hmm_search_score_file) as table:
+            domain_rows = [(line.split()[0], line.split()[2], line.split()[7], line.split()[17], line.split()[18]) for line in table if not line.startswith("#")]
+        self.assertDictEqual(shared_code_box.compute_domain_scores(domain_rows), shared_code_box.parse_hmmer_domain_table(self.hmm_search_score_file))
+
+    @unittest.skipIf(shared_code_box.pyhmmer is None, "pyhmmer not installed")
+    def test_in_process_scores_equal_domain_table(self):
+        import io
+        hmm_file = os.path.join(test_data, "eef.hmm")
+        with open(os.path.join(test_data, file_name)) as fasta_f:
+            fasta_string = fasta_f.read()
+        with open(hmm_file, "rb") as hmm_f:
+            hmm = shared_code_box.pyhmmer.plan7.HMMFile(hmm_f).read()
+        domain_table = io.BytesIO()
+        for top_hits in shared_code_box.pyhmmer.hmmer.hmmsearch(hmm, shared_code_box.fasta_string_to_sequences(fasta_string, hmm.alphabet), cpus=1):
+            top_hits.write(domain_table, format="domains")
+        self.assertDictEqual(shared_code_box.parse_hmmer_domain_lines(domain_table.getvalue().decode().splitlines()),
+                             shared_code_box.get_phmm_score_in_process(hmm_file, fasta_string))
+
+    @unittest.skipIf(shared_code_box.pyhmmer is None, "pyhmmer not installed")
+    def test_temporary_hmm_not_cached(self):
+        with open(os.path.join(test_data, file_name)) as fasta_f:
+            fasta_string = fasta_f.read()
+        shared_code_box.load_hmm.cache_clear()
+        with tmp.NamedTemporaryFile() as hmm_tmp:
+            with open(os.path.join(test_data, "eef.hmm"), "rb") as hmm_f:
+                hmm_tmp.write(hmm_f.read())
+                hmm_tmp.flush()
+            scores = shared_code_box.get_phmm_score_in_process(hmm_tmp.name, fasta_string, cache_hmm=False)
+        self.assertEqual(0, shared_code_box.load_hmm.cache_info().currsize)
+        self.assertDictEqual(shared_code_box.get_phmm_score_in_process(os.path.join(test_data, "eef.hmm"), fasta_string), scores)
+        self.assertEqual(1, shared_code_box.load_hmm.cache_info().currsize)
+
+    @patch("shared_code_box.pyhmmer", None)
+    def test_hmmer_backend_falls_back_to_subprocess(self):
+        backend = shared_code_box.hmmer_backend
+        try:
+            self.assertEqual("hmmsearch", shared_code_box.set_hmmer_backend("pyhmmer"))
+        finally:
+            shared_code_box.hmmer_backend = backend
+
+    def test_pipe_cmd_feeds_stdin(self):
+        self.assertEqual(shared_code_box.pipe_cmd(["cat"], ">a\nMKL\n"), ">a\nMKL\n")
+
+    def test_parse_msa_lines(self):
+        self.assertEqual(build_models.parse_msa_lines(["progress\n", ">a desc\n", "MK-\n", "L\n", ">b\n", "MKVL\n"]), [">a", "MK-L", ">b", "MKVL"])
+
+
+class TestToolScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = shared_code_box.ToolScheduler()
+
+    def test_unconfigured_scheduler_keeps_command(self):
+        self.assertEqual(self.scheduler.prepare_command("hmmsearch a b"), (["hmmsearch", "a", "b"], 1))
+
+    def test_thread_flags_capped_by_budget(self):
+        self.scheduler.configure(threads=2, tool_threads=4)
+        self.assertEqual(self.scheduler.prepare_command(["mafft", "-"]), (["mafft", "--thread", "2", "-"], 2))
+        self.assertEqual(self.scheduler.prepare_command(["tblastn", "-query"]), (["tblastn", "-num_threads", "2", "-query"], 2))
+        self.assertEqual(self.scheduler.prepare_command(["exonerate", "-q"]), (["exonerate", "-q"], 1))
+
+    def test_thread_flag_of_caller_kept(self):
+        self.scheduler.configure(threads=4)
+        self.assertEqual(self.scheduler.prepare_command(["tblastn", "-query", "q", "-num_threads", "3"]), (["tblastn", "-query", "q", "-num_threads", "3"], 3))
+        self.assertEqual(self.scheduler.prepare_command(["tblastn", "-num_threads", "8", "-query", "q"]), (["tblastn", "-num_threads", "4", "-query", "q"], 4))
+
+    def test_budget_queues_calls(self):
+        self.scheduler.configure(threads=1)
+        with patch("shared_code_box.tool_scheduler", self.scheduler):
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(lambda x: shared_code_box.pipe_cmd(["sleep", "0.3"]), range(2)))
+            self.assertGreaterEqual(time.time() - start, 0.6)
+            self.assertEqual(self.scheduler.free_threads.value, 1)
+
+    def test_timeout_kills_call(self):
+        self.scheduler.configure(timeout=1)
+        with patch("shared_code_box.tool_scheduler", self.scheduler):
+            start = time.time()
+            with self.assertRaises(shared_code_box.ToolCallError) as error:
+                list(shared_code_box.run_cmd(command=["sleep", "5"], wait=False))
+            self.assertTrue(error.exception.killed)
+            self.assertLess(time.time() - start, 4)
+
+    def test_killed_or_failed_call_returns_no_output(self):
+        self.scheduler.configure(timeout=1)
+        with patch("shared_code_box.tool_scheduler", self.scheduler):
+            with self.assertRaises(shared_code_box.ToolCallError) as error:
+                shared_code_box.pipe_cmd(["sh", "-c", "echo partial; sleep 5"])
+            self.assertTrue(error.exception.killed)
+            with self.assertRaises(shared_code_box.ToolCallError) as error:
+                shared_code_box.run_cmd(command=["sh", "-c", "echo partial; exit 3"], wait=True)
+            self.assertEqual((error.exception.killed, error.exception.return_code), (False, 3))
+            self.assertEqual(shared_code_box.pipe_cmd(["echo", "complete"]), "complete\n")
+
+
+class TestToolUsageRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.recorder = shared_code_box.ToolUsageRecorder()
+
+    def test_record_of_piped_call(self):
+        with patch("shared_code_box.tool_recorder", self.recorder):
+            with self.recorder.context("group/cluster"):
+                self.assertEqual(shared_code_box.pipe_cmd(["cat"], ">a\nMKL\n"), ">a\nMKL\n")
+        record = self.recorder.records[0]
+        self.assertEqual((record["tool"], record["stage"], record["context"]), ("cat", "other", "group/cluster"))
+        self.assertEqual((record["input_bytes"], record["output_bytes"], record["return_code"]), (7, 7, 0))
+        self.assertIsNotNone(record["cpu_sec"])
+
+    def test_output_file_bytes_and_report(self):
+        with patch("shared_code_box.tool_recorder", self.recorder), tmp.TemporaryDirectory() as out_dir:
+            shared_code_box.run_cmd(command=["cp", os.path.join(test_data, file_name), os.path.join(out_dir, "copy.fa")], wait=True)
+            file_size = os.path.getsize(os.path.join(test_data, file_name))
+            self.assertEqual((self.recorder.records[0]["input_bytes"], self.recorder.records[0]["output_bytes"]), (file_size, file_size))
+            with open(self.recorder.write_report(out_dir)) as report:
+                self.assertEqual(json.load(report)["contexts"]["-"]["calls"], 1)
+            self.assertEqual(len(open(os.path.join(out_dir, "tool_usage.tsv")).readlines()), 2)
+
 
 class TestScoreObject(unittest.TestCase):
 
@@ -170,6 +316,27 @@ class TestScoreObject(unittest.TestCase):
         self.assertEqual(score_dict[">ALUMB.ALUE_0000951001-mRNA-1"], 17)
         self.assertNotIn(">ACRAS.cds.Contig3658m.1561", score_dict)
 
+    def test_iterative_scoring_parallel_equals_serial(self):
+        serial_dict = dict(self.score_obj.iterative_score_computation())
+        parallel_obj = build_models.ScoreObject(self.fasta_dict, os.path.join(test_data, "eef.hmm"))
+        self.assertDictEqual(serial_dict, parallel_obj.iterative_score_computation(workers=3))
+
+    @patch("build_models.ScoreObject.held_out_round", side_effect=lambda held_out, msa_hash=None: {h: len(held_out) for h in held_out})
+    def test_kfold_scoring_scores_every_protein_once(self, held_out_round):
+        score_dict = self.score_obj.kfold_score_computation(2)
+        self.assertEqual(held_out_round.call_count, 2)
+        self.assertDictEqual(score_dict, {">ACRAS.cds.Contig10403m.5077": 2, ">ALUMB.ALUE_0000951001-mRNA-1": 1, ">ACRAS.cds.Contig3658m.1561": 2})
+
+    @patch("build_models.generate_hmm_from_msa")
+    @patch("build_models.ScoreObject.generate_msa_string", return_value=">a\nMKV")
+    def test_kfold_rounds_fixed_search_space(self, generate_msa_string, generate_hmm_from_msa):
+        with patch("build_models.get_phmm_score_from_fasta", return_value={}) as hmmsearch:
+            self.score_obj.kfold_score_computation(2)
+            self.score_obj.iterative_score_computation()
+        self.assertEqual(5, hmmsearch.call_count)
+        self.assertTrue(all([call[1] == {"search_space": 1, "domain_search_space": 1, "cache_hmm": False} for call in hmmsearch.call_args_list]))
+        self.assertListEqual([2, 1, 1, 1, 1], [call[0][1].count(">") for call in hmmsearch.call_args_list])
+
     def test_bulk_scoring_hand_checked_score(self):
         score_dict = self.score_obj.bulk_score_computation()
         self.assertEqual(score_dict[">ALUMB.ALUE_0000951001-mRNA-1"], 190)
@@ -178,6 +345,10 @@ class TestScoreObject(unittest.TestCase):
         length_dict = {">ACRAS.cds.Contig10403m.5077": 10, ">ALUMB.ALUE_0000951001-mRNA-1": 20, ">ACRAS.cds.Contig3658m.1561": 30}
         self.assertListEqual(list(build_models.calculate_length_range(length_dict)), [10.0, 30.0])
 
+    def test_expected_span_from_length_range(self):
+        self.assertTupleEqual((120, 1240), shared_code_box.get_expected_span((40, 80)))    # 240 bp cds: 2 introns of 500 bp
+        self.assertTupleEqual((0, 3900), shared_code_box.get_expected_span(("-12.5", "1000"), intron_model=(1, 300)))
+
     def test_fall_back_to_median_if_weired_distribution(self):
         self.score_obj.score_dict = {x : x for x in range(20, 60, 2)}
         self.assertEqual(20, round(self.score_obj.calculate_score_distribution_parameters(true_negative_scores=list(range(20, 130, 10)))))
@@ -200,6 +371,75 @@ class TestScoreObject(unittest.TestCase):
         self.assertEqual(20, round(self.score_obj.calculate_score_distribution_parameters(true_negative_scores=[2, 3, 9])))
 
 
+class TestClusterCache(unittest.TestCase):
+
+    options = {"einsi": False, "subset": False}
+
+    def test_cache_key_independent_of_header_order(self):
+        key_a = build_models.get_cluster_cache_key("cluster", {">a": "MKL", ">b": "MKV"}, self.options)
+        key_b = build_models.get_cluster_cache_key("cluster", {">b": "MKV", ">a": "MKL"}, self.options)
+        self.assertEqual(key_a, key_b)
+
+    def test_cache_key_changes_with_sequences_and_options(self):
+        key = build_models.get_cluster_cache_key("cluster", {">a": "MKL", ">b": "MKV"}, self.options)
+        self.assertNotEqual(key, build_models.get_cluster_cache_key("cluster", {">a": "MKL", ">b": "MKA"}, self.options))
+        self.assertNotEqual(key, build_models.get_cluster_cache_key("cluster", {">a": "MKL", ">b": "MKV"}, {"einsi": True, "subset": False}))
+
+    def test_write_and_read_cache_entry(self):
+        with tmp.TemporaryDirectory() as cache_dir:
+            self.assertEqual(build_models.read_cluster_cache(cache_dir, "abc123"), None)
+            build_models.write_cluster_cache(cache_dir, "abc123", {"filtered": True}, {})
+            self.assertDictEqual(build_models.read_cluster_cache(cache_dir, "abc123"), {"filtered": True})
+
+
+class TestBlastIndex(unittest.TestCase):
+
+    blast_lines = {"0": ["0_1\t0_1", "0_1\t0_2", "0_1\t0_3", "0_2\t0_2", "0_2\t0_1"], "1": ["1_5\t1_5", "1_5\t1_7"]}
+
+    def write_blast_files(self, blast_dir):
+        for species_id, lines in self.blast_lines.items():
+            with open(os.path.join(blast_dir, "Blast{}_{}.txt".format(species_id, species_id)), "w") as blast_f:
+                blast_f.write("\n".join([line + "\t100\t50" for line in lines]) + "\n")
+
+    def test_index_keeps_top_hits_in_order(self):
+        with tmp.TemporaryDirectory() as blast_dir:
+            self.write_blast_files(blast_dir)
+            index_path = os.path.join(blast_dir, "index.sqlite")
+            index_obj, species = build_models.index_all_blast_files(index_path, blast_dir, {"0", "1"}, 2)
+            self.assertEqual(species, 2)
+            self.assertEqual(index_obj.get_hits("0", "1"), ["1", "2"])
+            self.assertEqual(index_obj.get_hits("1", "5"), ["5", "7"])
+            self.assertEqual(index_obj.get_hits("1", "6"), [])
+
+    def test_parallel_index_equals_serial(self):
+        with tmp.TemporaryDirectory() as blast_dir:
+            self.write_blast_files(blast_dir)
+            serial, _ = build_models.index_all_blast_files(os.path.join(blast_dir, "serial.sqlite"), blast_dir, {"0", "1"}, 5)
+            parallel, _ = build_models.index_all_blast_files(os.path.join(blast_dir, "parallel.sqlite"), blast_dir, {"0", "1"}, 5, jobs=2)
+            for species_id, prot_id in [("0", "1"), ("0", "2"), ("1", "5")]:
+                self.assertEqual(serial.get_hits(species_id, prot_id), parallel.get_hits(species_id, prot_id))
+
+    def test_next_best_blast_hit_skips_cluster_members(self):
+        self.assertEqual(build_models.next_best_blast_hit({"1", "2"}, ["1", "2", "3"]), "3")
+        self.assertEqual(build_models.next_best_blast_hit({"1", "2"}, ["1", "2"]), None)
+
+
+class TestProteomeIndex(unittest.TestCase):
+
+    def test_proteome_index_lookups(self):
+        with tmp.TemporaryDirectory() as index_dir:
+            sequence_ids = os.path.join(index_dir, "SequenceIDs.txt")
+            with open(sequence_ids, "w") as id_file:
+                id_file.write("0_0: AMELL.GB42352-PA\n0_1: unknown\n")
+            index_obj = build_models.index_proteome(os.path.join(index_dir, "proteome.sqlite"), os.path.join(test_data, file_name), sequence_ids)
+            self.assertEqual(index_obj.count_sequences(), 190)
+            self.assertEqual(index_obj.get_id_pair("AMELL.GB42352-PA"), "0_0")
+            self.assertEqual(index_obj.get_name("0_0"), "AMELL.GB42352-PA")
+            self.assertEqual(len(index_obj.get_sequence(">AMELL.GB42352-PA")), 942)
+            self.assertEqual(index_obj.get_sequence(">unknown"), None)
+            self.assertEqual(index_obj.get_id_pair("missing"), None)
+
+
 class TestMsaObject(unittest.TestCase):
 
     msa_path = open(os.path.join(test_data, "eef.aln"))
@@ -211,6 +451,16 @@ class TestMsaObject(unittest.TestCase):
         msa_list = build_models.msa_operations("blaaa")
         self.assertEqual(len(msa_list)/2, 190)
 
+    def test_msa_list_to_hash(self):
+        msa_hash = build_models.msa_list_to_hash([">a", "MK-L", ">b", "M--L"])
+        self.assertDictEqual(msa_hash, {">a": "MK-L", ">b": "M--L"})
+
+    def test_drop_sequences_removes_gap_only_columns(self):
+        msa_hash = {">a": "MKAL", ">b": "M--L", ">c": "M-AL"}
+        self.assertEqual(build_models.drop_sequences_from_msa(msa_hash, [">a"]), ">b\nM-L\n>c\nMAL")
+        self.assertEqual(build_models.drop_sequences_from_msa(msa_hash, [">c"]), ">a\nMKAL\n>b\nM--L")
+        self.assertEqual(build_models.drop_sequences_from_msa(msa_hash, [">a", ">c"]), ">b\nML")
+
 
 class Overseer(unittest.TestCase):
 
@@ -230,6 +480,46 @@ class Overseer(unittest.TestCase):
         self.assertEqual(overseer_obj.group_by_file_to_filepath["compile_script"]["eef_3.5_no_cea"], "/home/jgravemeyer/Dropbox/MSc_project/src/GenePS/test_data/compile_script/eef_3.5_no_cea.fa")
         self.assertNotIn("eef.hmm", overseer_obj.group_by_file_to_filepath["compile_script"])
 
+    @staticmethod
+    def fake_cluster_hmm(overseer_obj, group, file_name, directory):
+        if file_name == "filtered":
+            return False
+        overseer_obj.group_by_file_to_msa_obj[group][file_name] = "msa_" + file_name
+        overseer_obj.group_by_file_to_hmm[group][file_name] = "hmm_" + file_name
+        return True
+
+    @staticmethod
+    def fake_cluster_scores(overseer_obj, group, file_name):
+        overseer_obj.group_by_file_to_score_obj[group][file_name] = {"proteins": len(overseer_obj.group_by_file_to_cluster_hash[group][file_name])}
+
+    def build_clusters(self, jobs):
+        overseer_obj = build_models.Overseer("test")
+        for group, file_list in [("group_b", ["c_3", "filtered", "c_1"]), ("group_a", ["c_2", "c_4"])]:
+            for size, file_name in enumerate(file_list, 3):
+                overseer_obj.add_cluster(group, file_name, file_name + ".fa", {">{}_{}".format(file_name, idx): "MKV" for idx in range(size)})
+        with patch("build_models.Overseer.generate_cluster_hmm_and_filtered_fasta", self.fake_cluster_hmm), \
+                patch("build_models.Overseer.compute_cluster_hmm_scores", self.fake_cluster_scores), \
+                patch("build_models.get_consensus", side_effect=lambda hmm: "consensus_" + hmm), \
+                patch("build_models.print_progress"), patch("builtins.print"), tmp.TemporaryDirectory() as directory:
+            if jobs > 1:
+                scope = overseer_obj.run_cluster_pipeline_pool(directory, jobs)
+            else:
+                scope = overseer_obj.generate_hmm_and_filtered_fasta(directory)
+                overseer_obj.compute_all_hmm_scores()
+                for group, file_list in overseer_obj.group_to_file_list.items():
+                    for file_name in file_list:
+                        overseer_obj.get_cluster_consensus(group, file_name)
+        results = {attribute: {group: list(getattr(overseer_obj, attribute)[group].items()) for group in getattr(overseer_obj, attribute)}
+                   for attribute in build_models.Overseer.per_cluster_attributes}
+        return scope, dict(overseer_obj.group_to_file_list), dict(overseer_obj.group_to_filtered_file_list), results
+
+    def test_cluster_pool_same_results_as_serial(self):
+        serial = self.build_clusters(jobs=1)
+        self.assertEqual(4, serial[0])
+        self.assertDictEqual({"group_b": ["filtered"]}, serial[2])
+        self.assertListEqual([("c_3", "consensus_hmm_c_3"), ("c_1", "consensus_hmm_c_1")], serial[3]["group_by_file_to_consensus"]["group_b"])
+        self.assertEqual(serial, self.build_clusters(jobs=3))
+
     def test_filter_file_list_remove_two(self):
         overseer_obj = build_models.Overseer("test")
         overseer_obj.group_to_file_list["testgroup"] = ["1", "2", "3", "4"]
@@ -245,6 +535,21 @@ class Overseer(unittest.TestCase):
         valid_files = overseer_obj.remove_filtered_files({})
         self.assertListEqual(overseer_obj.group_to_file_list["testgroup"], ["1", "2", "3", "4"])
         self.assertEqual(4, valid_files)
+
+    def test_remove_deleted_clusters(self):
+        with tmp.TemporaryDirectory() as directory, patch("build_models.output_dir", directory):
+            overseer_obj = build_models.Overseer("test")
+            for group, file_list, cluster_names in [("group_a", ["c_1"], ["c_1", "c_2"]), ("group_b", [], ["c_3", "c_4"])]:
+                overseer_obj.group_to_file_list[group] = file_list
+                overseer_obj.group_to_result_path[group] = os.path.join(directory, group)
+                with open(os.path.join(directory, group + ".GenePS"), "w") as group_f:
+                    group_f.write("group: {}\n#name: {}\n#name: {}\n".format(group, *cluster_names))
+                open(os.path.join(directory, group + ".fa.consensus"), "w").close()
+            for file_name in ["c_1.hmm", "c_2.hmm", "c_2.fasta", "c_3.hmm"]:
+                open(os.path.join(directory, file_name), "w").close()
+            self.assertListEqual(["c_2"], overseer_obj.remove_deleted_clusters("group_a"))
+            self.assertListEqual(["c_3", "c_4"], overseer_obj.remove_deleted_clusters("group_b"))
+            self.assertListEqual(["c_1.hmm", "group_a.GenePS", "group_a.fa.consensus"], sorted(os.listdir(directory)))
 '''
     @patch("make_Datasets.output_dir", return_value="")
     @patch("make_Datasets.generate_hmm", return_value="Test_HMM")
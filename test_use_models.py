@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 import unittest
 import os
+import random
 from unittest.mock import patch
-from shared_code_box import tempdir
+from shared_code_box import tempdir, ToolCallError, get_phmm_score_from_fasta
+import shared_code_box
 import use_models
 from collections import defaultdict, namedtuple
-from Blast_wrapper import read_blast_output, HspListObject
+from Blast_wrapper import read_blast_output, HspListObject, write_tagged_query_file, read_tagged_blast_output, GenomeIndexObject,\
+    make_blast_db, run_tblastn, run_tblastn_all_groups, Region, BlastObject
 from Exonerate_GenBlast_Wrapper import remove_non_letter_signs, clear_hashed_bases, aacode_3to1, ExonerateObject
 import Exonerate_GenBlast_Wrapper
+import Blast_wrapper
 
 script_path = os.path.dirname(os.path.realpath(__file__))
 test_data = os.path.join(script_path, "test_data")
@@ -75,6 +79,199 @@ class TestBlastObject(unittest.TestCase):
         self.assertEqual(chunk_single, 100)
         self.assertEqual(query_single, 15)
 
+    def test_tagged_blast_output_split_by_group(self):
+        with tempdir() as tmp:
+            tagged_file = os.path.join(tmp, "tagged.blast")
+            with open(self.blast_file) as blast_f, open(tagged_file, "w") as tagged_f:
+                for line in blast_f:
+                    tagged_f.write(line.replace("OrthologousGroups_I3.5.OGoverlapp.txt\t", "GenePSq1\t"))
+            tag_to_group_query = {"GenePSq0": ("group_a", "cluster_a"), "GenePSq1": ("group_b", "OrthologousGroups_I3.5.OGoverlapp.txt")}
+            group_to_blast_obj = read_tagged_blast_output(tagged_file, "fake_db", tag_to_group_query)
+        self.assertListEqual(["group_b"], list(group_to_blast_obj))
+        self.assertDictEqual(read_blast_output(self.blast_file, "fake_db").blast_out, group_to_blast_obj["group_b"].blast_out)
+
+    def test_write_tagged_query_file(self):
+        with tempdir() as tmp:
+            for group in ["group_a", "group_b"]:
+                with open(os.path.join(tmp, group), "w") as consensus_f:
+                    consensus_f.write(">cluster_1\nMKV\n>cluster_2\nMAA\n")
+            tag_to_group_query = write_tagged_query_file({group: os.path.join(tmp, group) for group in ["group_a", "group_b"]}, os.path.join(tmp, "queries.fa"))
+            with open(os.path.join(tmp, "queries.fa")) as query_f:
+                headers = [line.strip() for line in query_f if line.startswith(">")]
+        self.assertListEqual([">GenePSq0", ">GenePSq1", ">GenePSq2", ">GenePSq3"], headers)
+        self.assertTupleEqual(("group_b", "cluster_2"), tag_to_group_query["GenePSq3"])
+
+    def test_genome_index_region(self):
+        with tempdir() as tmp:
+            genome_path = os.path.join(tmp, "genome.fa")
+            with open(genome_path, "w") as genome_f:
+                genome_f.write(">contig_1 description\nacgtACGTAC\nGGGGCCCCTT\nAAT\n>contig_2\nTTTT\n")
+            index_path = os.path.join(tmp, "cache_genome.fai")
+            genome_index = GenomeIndexObject(genome_path, index_path).load()
+            self.assertTrue(os.path.exists(index_path))
+            self.assertFalse(os.path.exists(genome_path + ".fai"))
+            self.assertEqual("ACGTACGTACGG", genome_index.get_region("contig_1", 1, 12))
+            self.assertEqual("CTTAAT", genome_index.get_region("contig_1", 18, 23))
+            self.assertEqual("CTTAAT", genome_index.get_region("contig_1", 18, 5018))
+            self.assertEqual("TTTT", GenomeIndexObject(genome_path, index_path).load().get_region("contig_2", 1, 100))
+            self.assertEqual("TTTT", GenomeIndexObject(genome_path).load().get_region("contig_2", 1, 100))
+
+    def test_genome_index_versioned_accessions(self):
+        with tempdir() as tmp:
+            genome_path = os.path.join(tmp, "genome.fa")
+            with open(genome_path, "w") as genome_f:
+                genome_f.write(">NC_003279.8 Caenorhabditis elegans chromosome I\nACGTA\n>gi|25|ref|NC_003280.10|\nTTTT\n")
+            genome_index = GenomeIndexObject(genome_path).load()
+            self.assertEqual("CGT", genome_index.get_region("NC_003279", 2, 4))
+            self.assertEqual("CGT", genome_index.get_region("NC_003279.8", 2, 4))
+        self.assertEqual(4, genome_index.get_contig_length("NC_003280"))
+        self.assertFalse(genome_index.has_contig("ref"))
+
+    def test_genome_index_without_final_newline(self):
+        with tempdir() as tmp:
+            genome_path = os.path.join(tmp, "genome.fa")
+            for last_line in ["GGGGCCCCTT", "AAT"]:
+                with open(genome_path, "w") as genome_f:
+                    genome_f.write(">contig_1\nACGTACGTAC\n{}\n>contig_2\nTTTTTTTTTT\n{}".format(last_line, last_line))
+                genome_index = GenomeIndexObject(genome_path).load()
+                self.assertEqual("AC" + last_line, genome_index.get_region("contig_1", 9, 100))
+                self.assertEqual("TT" + last_line, genome_index.get_region("contig_2", 9, 100))
+            with open(genome_path, "w") as genome_f:
+                genome_f.write(">contig_1\nACGTACGTAC\nAAT\nGGGGCCCCTT")
+            self.assertRaises(ValueError, Blast_wrapper.index_genome_fasta, genome_path)
+
+    def test_uneven_genome_lines_fall_back_to_blastdbcmd(self):
+        with tempdir() as tmp:
+            genome_path = os.path.join(tmp, "genome.fa")
+            with open(genome_path, "w") as genome_f:
+                genome_f.write(">contig_1\nACG\nTACGT\nA\n")
+            with patch("Blast_wrapper.parse_blastdb", return_value="CGTA") as blastdbcmd:
+                self.assertIsNone(Blast_wrapper.get_genome_index(genome_path, os.path.join(tmp, "cache", "key", "genome")))
+                self.assertEqual("CGTA", Blast_wrapper.extract_region(genome_path, "contig_1", 2, 5))
+                self.assertEqual(5, BlastObject({}, genome_path).get_region_end("contig_1", 2, 5))
+            self.assertEqual((os.path.join(tmp, "cache", "key", "genome"), "contig_1", 2, 5), blastdbcmd.call_args[0])
+
+    def test_infer_regions_per_query_distances(self):
+        hsp_rows = [(1001, 1100), (5001, 5100), (30001, 30100)]
+        blast_out = {"contig_1": {query: [{"contig": "contig_1", "evalue": 0.0, "q_start": 1, "q_end": 30, "s_start": s_start, "s_end": s_end, "q_len": 60, "strand": "+"}
+                                          for s_start, s_end in hsp_rows] for query in ["default", "short"]}}
+        with tempdir() as tmp:
+            genome_path = os.path.join(tmp, "genome.fa")
+            with open(genome_path, "w") as genome_f:
+                genome_f.write(">contig_1\n{}\n".format("A" * 40000))
+            blast_obj = BlastObject(blast_out, genome_path)
+            blast_obj.infer_regions({"short": (500, 100)})
+        self.assertListEqual([(1, 10100), (25001, 35100)], [(region.s_start, region.s_end) for region in blast_obj.inferred_regions["contig_1"]["default"]])
+        self.assertListEqual([(901, 1200), (4901, 5200), (29901, 30200)], [(region.s_start, region.s_end) for region in blast_obj.inferred_regions["contig_1"]["short"]])
+
+    @staticmethod
+    def make_hsp_list(hsp_rows, strand):
+        return [{"contig": "contig_1", "evalue": 0.0, "q_start": q_start, "q_end": q_end, "s_start": s_start, "s_end": s_end, "q_len": 200, "strand": strand}
+                for q_start, q_end, s_start, s_end in hsp_rows]
+
+    def test_chain_to_region_splits_tandem_copies(self):
+        hsp_rows = [(1, 100, 1000, 1299), (101, 200, 2000, 2299), (1, 100, 4000, 4299), (101, 200, 5000, 5299)]
+        hits = HspListObject(self.make_hsp_list(hsp_rows, "+"), 10000)
+        hits.sort_hsp_list()
+        self.assertListEqual([[0, 1, 2, 3]], hits.merge_to_region())
+        self.assertListEqual([[0, 1], [2, 3]], hits.chain_to_region())
+
+    def test_chain_to_region_reverse_strand(self):
+        hsp_rows = [(1, 100, 5299, 5000), (101, 200, 4299, 4000), (1, 100, 2299, 2000), (101, 200, 1299, 1000)]
+        hits = HspListObject(self.make_hsp_list(hsp_rows, "-"), 10000)
+        hits.sort_hsp_list()
+        self.assertListEqual([[0, 1], [2, 3]], hits.chain_to_region())
+        self.assertListEqual([101, 1, 101, 1], hits.q_start)
+
+    def test_chain_to_region_skipped_exons_and_overlapping_chains(self):
+        hsp_rows = [(1, 56, 1000, 1167), (353, 410, 3400, 3573), (1, 100, 20000, 20299), (1, 100, 20100, 20399)]
+        hits = HspListObject(self.make_hsp_list(hsp_rows, "+"), 10000)
+        hits.sort_hsp_list()
+        self.assertListEqual([[0, 1], [2, 3]], hits.chain_to_region())
+
+    def test_infer_regions_chain_hsps(self):
+        hsp_rows = [(1, 100, 5299, 5000), (101, 200, 4299, 4000), (1, 100, 2299, 2000), (101, 200, 1299, 1000)]
+        with tempdir() as tmp:
+            genome_path = os.path.join(tmp, "genome.fa")
+            with open(genome_path, "w") as genome_f:
+                genome_f.write(">contig_1\n{}\n".format("A" * 6000))
+            blast_obj = BlastObject({"contig_1": {"query": self.make_hsp_list(hsp_rows, "-")}}, genome_path)
+            blast_obj.infer_regions({"query": (10000, 100)})
+            merged_regions = blast_obj.inferred_regions["contig_1"]["query"]
+            blast_obj.infer_regions(chain_hsps=True)
+            chained_regions = blast_obj.inferred_regions["contig_1"]["query"]
+        self.assertListEqual([(900, 5399)], [(region.s_start, region.s_end) for region in merged_regions])
+        self.assertListEqual([(900, 2399, "-", 99), (3900, 5399, "-", 99)],
+                             [(region.s_start, region.s_end, region.strand, region.query_cov) for region in chained_regions])
+
+    @staticmethod
+    def fake_makeblastdb(command, wait):
+        for ending in [".nhr", ".nin", ".nsq"]:
+            with open(command[command.index("-out") + 1] + ending, "w") as volume:
+                volume.write("volume")
+
+    def test_make_blast_db_cache(self):
+        with tempdir() as tmp:
+            genome_path = os.path.join(tmp, "genome.fa")
+            with open(genome_path, "w") as genome_f:
+                genome_f.write(">contig_1\nACGT\n")
+            with patch("Blast_wrapper.run_cmd", side_effect=self.fake_makeblastdb) as makeblastdb:
+                db_path = make_blast_db(genome_path, os.path.join(tmp, "cache"))
+                self.assertEqual(db_path, make_blast_db(genome_path, os.path.join(tmp, "cache")))
+                self.assertEqual(1, makeblastdb.call_count)
+                os.remove(db_path + ".nsq")     # interrupted or damaged database is rebuilt
+                self.assertEqual(db_path, make_blast_db(genome_path, os.path.join(tmp, "cache")))
+                self.assertEqual(2, makeblastdb.call_count)
+            self.assertTrue(os.path.exists(db_path + ".nsq"))
+            key = os.path.basename(os.path.dirname(db_path))
+            self.assertListEqual(sorted(["checksums", key, key + ".lock"]), sorted(os.listdir(os.path.join(tmp, "cache"))))
+
+    def test_make_blast_db_failed_build_not_cached(self):
+        def killed_makeblastdb(command, wait):
+            self.fake_makeblastdb(command, wait)    # partial volumes
+            raise ToolCallError(command, -9, killed=True)
+        with tempdir() as tmp:
+            genome_path = os.path.join(tmp, "genome.fa")
+            with open(genome_path, "w") as genome_f:
+                genome_f.write(">contig_1\nACGT\n")
+            with patch("Blast_wrapper.run_cmd", side_effect=killed_makeblastdb):
+                with self.assertRaises(ToolCallError):
+                    make_blast_db(genome_path, os.path.join(tmp, "cache"))
+            self.assertListEqual(["checksums"], [name for name in os.listdir(os.path.join(tmp, "cache")) if not name.endswith(".lock")])
+            with patch("Blast_wrapper.run_cmd", side_effect=self.fake_makeblastdb) as makeblastdb:
+                make_blast_db(genome_path, os.path.join(tmp, "cache"))
+                self.assertEqual(1, makeblastdb.call_count)
+
+    def test_tblastn_cache(self):
+        def fake_tblastn(command, wait):
+            with open(self.blast_file) as blast_f, open(command[command.index("-out") + 1], "w") as out_f:
+                query = "GenePSq0" if command[2].endswith(".queries.fa") else "OrthologousGroups_I3.5.OGoverlapp.txt"
+                out_f.write(blast_f.read().replace("OrthologousGroups_I3.5.OGoverlapp.txt\t", query + "\t"))
+        with tempdir() as tmp:
+            genome_path, query_path = os.path.join(tmp, "genome.fa"), os.path.join(tmp, "group.consensus")
+            with open(genome_path, "w") as genome_f, open(query_path, "w") as query_f:
+                genome_f.write(">contig_1\nACGT\n")
+                query_f.write(">OrthologousGroups_I3.5.OGoverlapp.txt\nMKV\n")
+            with patch("Blast_wrapper.run_cmd", side_effect=fake_tblastn) as tblastn:
+                blast_obj = run_tblastn("db", query_path, os.path.join(tmp, "out_1"), genome_path, os.path.join(tmp, "cache"))
+                cached_obj = run_tblastn("db", query_path, os.path.join(tmp, "out_2"), genome_path, os.path.join(tmp, "cache"))
+                group_to_blast_obj = run_tblastn_all_groups("db", {"group": query_path}, os.path.join(tmp, "out_3"), genome_path, os.path.join(tmp, "cache"))
+                self.assertEqual(1, tblastn.call_count)
+        self.assertDictEqual(blast_obj.blast_out, cached_obj.blast_out)
+        self.assertDictEqual(blast_obj.blast_out, group_to_blast_obj["group"].blast_out)
+        self.assertEqual(genome_path, cached_obj.db_path)
+
+    def test_tblastn_all_groups_threads(self):
+        with tempdir() as tmp:
+            query_path = os.path.join(tmp, "group.consensus")
+            with open(query_path, "w") as query_f:
+                query_f.write(">cluster_1\nMKV\n")
+            with patch("Blast_wrapper.run_cmd") as tblastn, patch("Blast_wrapper.read_tagged_blast_output", return_value={}):
+                run_tblastn_all_groups("db", {"group": query_path}, os.path.join(tmp, "out_1"), threads=6)
+                run_tblastn_all_groups("db", {"group": query_path}, os.path.join(tmp, "out_2"))
+        self.assertListEqual(["-num_threads", "6"], tblastn.call_args_list[0][1]["command"][-2:])
+        self.assertNotIn("-num_threads", tblastn.call_args_list[1][1]["command"])
+
 '''
 class TestExonerateObject(unittest.TestCase):
 
@@ -163,13 +360,13 @@ class TestOverlapp(unittest.TestCase):
 
     @patch('Exonerate_GenBlast_Wrapper.PredictionObject.check_overlap', return_value=True)
     def test_all_overlapp(self, overlapp):
-        filtered, passed = use_models.isolate_overlapping_predictions(self.make_pred_object_list())
+        filtered, passed = Exonerate_GenBlast_Wrapper.isolate_overlapping_predictions_pairwise(self.make_pred_object_list())
         self.assertEqual(passed[0].score, 628)
         self.assertEqual(len(filtered), 6)
 
     @patch('Exonerate_GenBlast_Wrapper.PredictionObject.check_overlap', return_value=False)
     def test_no_overlapp(self, overlapp):
-        filtered, passed = use_models.isolate_overlapping_predictions(self.make_pred_object_list())
+        filtered, passed = Exonerate_GenBlast_Wrapper.isolate_overlapping_predictions_pairwise(self.make_pred_object_list())
         self.assertEqual(len(passed), 7)
         self.assertEqual(len(filtered), 0)
 
@@ -196,6 +393,52 @@ class TestOverlapp(unittest.TestCase):
             for idx3 in range(idx + 1, len(passed)):
                 self.assertNotEqual(passed[idx], passed[idx+1])
 
+    @staticmethod
+    def make_random_pred_object_list(amount, seed):
+        random_gen = random.Random(seed)
+        pred_obj_list = []
+        for idx in range(amount):
+            region = Region(contig=random_gen.choice(["I", "II"]), s_start=1, s_end=3000, strand=random_gen.choice("+-"), chunk_cov=100, query_cov=100, q_len=100)
+            pred_obj = Exonerate_GenBlast_Wrapper.PredictionObject(region, random_gen.randint(1, 5), "-", "-", "-")
+            pred_obj.gene_start = random_gen.randint(1, 2000)
+            pred_obj.gene_end = pred_obj.gene_start + random_gen.randint(0, 300)
+            if random_gen.random() < 0.3:   # minus strand predictions of other tools (scipio)
+                pred_obj.gene_start, pred_obj.gene_end = pred_obj.gene_end, pred_obj.gene_start
+            pred_obj.gene_length = abs(pred_obj.gene_end - pred_obj.gene_start)
+            pred_obj.aln_score = random_gen.randint(1, 3)   # many ties
+            pred_obj_list.append(pred_obj)
+        return pred_obj_list
+
+    def test_interval_index_same_result_as_pairwise(self):
+        for seed in range(50):
+            pred_obj_list = self.make_random_pred_object_list(60, seed)
+            self.assertEqual(Exonerate_GenBlast_Wrapper.isolate_overlapping_predictions_pairwise(pred_obj_list),
+                             Exonerate_GenBlast_Wrapper.isolate_overlapping_predictions(pred_obj_list))
+
+    def test_genome_wide_overlaps_across_groups(self):
+        overseer = use_models.Overseer("genome", "genome.fa", "prediction_location")
+        pred_obj_list = self.make_pred_object_list()
+        for idx, pred_obj in enumerate(pred_obj_list):
+            overseer.group_by_contig_to_passed_prediction_list["group_{}".format(idx % 2)][pred_obj.contig].append(pred_obj)
+        filtered = overseer.resolve_genome_wide_overlaps()
+        self.assertEqual(4, filtered)
+        valid = [pred_obj for group in overseer.group_by_cluster_by_contig_to_valid_prediction for pred_obj in overseer.group_by_cluster_by_contig_to_valid_prediction[group]["-"]["II"]]
+        self.assertSetEqual({628, 217, 44}, set([pred_obj.score for pred_obj in valid]))
+
+    def test_keep_writes_shared_exonerate_file_once(self):
+        with tempdir() as tmp:
+            overseer = use_models.Overseer("genome", "genome.fa", tmp)
+            overseer.group_to_out_dir = {"group": os.path.join(tmp, "group")}
+            window_file = os.path.join(tmp, "window.exon")
+            with open(window_file, "w") as window_f:
+                window_f.write("exonerate output\n")
+            for cluster in ["cluster_1", "cluster_2"]:
+                overseer.exonerate_path_to_regions.setdefault(window_file, []).append("group/{} I:1-100".format(cluster))
+            with patch("use_models.keep", True):
+                overseer.write_output()
+            with open(os.path.join(tmp, "group_intermediate_exonerate.txt")) as exo_f:
+                self.assertEqual("# GenePS regions: group/cluster_1 I:1-100; group/cluster_2 I:1-100\nexonerate output\n", exo_f.read())
+
 
 class TestDataProviderObject(unittest.TestCase):
 
@@ -209,6 +452,220 @@ class TestDataProviderObject(unittest.TestCase):
         self.assertEqual(self.data_base.group_by_cluster_to_score_cutoff["next_best_blast_eef"]["eef_3.5"], 1.1826699418473992)
         self.assertEqual(self.data_base.group_by_cluster_to_length_range["next_best_blast_eef"]["eef_3.5"], ['303.97390927100224', '913.1505146921315'])
 
+    def test_span_is_optional(self):
+        self.assertFalse(self.data_base.group_by_cluster_to_span["next_best_blast_eef"])
+        with patch("use_models.data_base", self.data_base):
+            self.assertEqual((10000, 5000), use_models.get_region_distances("next_best_blast_eef")["eef_3.5"])
+
+    def test_region_distances_from_span(self):
+        with tempdir() as tmp:
+            for ending in [".hmm", ".fasta"]:
+                with open(os.path.join(tmp, "short_cluster" + ending), "w") as cluster_f:
+                    cluster_f.write(">protein\nMKV\n")
+            with open(os.path.join(tmp, "group.GenePS"), "w") as group_f:
+                group_f.write("group: group\ngroup_size: 1\n#name: short_cluster\n#score_cut_off: 10.0\n#length_range: 40,80\n#span: 120,1240\n")
+            data_base = use_models.DataProviderObject(tmp)
+        self.assertListEqual([120, 1240], data_base.group_by_cluster_to_span["group"]["short_cluster"])
+        with patch("use_models.data_base", data_base):
+            self.assertEqual((1240, 620), use_models.get_region_distances("group")["short_cluster"])
+            with patch("use_models.flank_distance", 2000):
+                self.assertEqual((1240, 2000), use_models.get_region_distances("group")["short_cluster"])
+
+
+class TestExonerateRyo(unittest.TestCase):
+
+    exonerate_file = os.path.join(test_data, "run_geneps/elegans_eef_true.exonerate")
+    exonerate_obj = ExonerateObject(exonerate_file)
+
+    def ryo_lines(self, drop_last_gff=False):
+        """--ryo output equivalent to the alignment output of exonerate_file"""
+        with open(self.exonerate_file) as ex:
+            gff_blocks = [block.split("# --- END OF GFF DUMP ---")[0] for block in ex.read().split("# --- START OF GFF DUMP ---")[1:]]
+        if drop_last_gff:
+            gff_blocks = gff_blocks[:-1]
+        lines = ["Command line: [exonerate --ryo]\n", "Hostname: [test]\n"]
+        for hit, gff in zip(self.exonerate_obj.target_dna, gff_blocks + [None]):
+            lines.append("\t".join(["GenePS_ryo", hit.query, "", hit.target, "", "+"] + list(hit.qrange) + list(hit.trange) + [hit.score]) + "\n")
+            cds = self.exonerate_obj.target_dna[hit]
+            lines.extend(["{}\n".format(cds[idx:idx + 60]) for idx in range(0, len(cds), 60)] + ["GenePS_ryo_end\n"])
+            if gff is not None:
+                lines.extend(["# --- START OF GFF DUMP ---\n"] + [line + "\n" for line in gff.split("\n")] + ["# --- END OF GFF DUMP ---\n"])
+        return lines + ["-- completed exonerate analysis\n"]
+
+    def test_ryo_parser_same_predictions_as_alignment_parser(self):
+        ryo_obj = ExonerateObject(None, ryo_lines=iter(self.ryo_lines()))
+        self.assertIsNone(ryo_obj.path)
+        self.assertListEqual(list(self.exonerate_obj.target_dna), list(ryo_obj.target_dna))
+        for hit in self.exonerate_obj.target_dna:
+            self.assertEqual(self.exonerate_obj.target_dna[hit], ryo_obj.target_dna[hit])
+            self.assertEqual(self.exonerate_obj.target_prot[hit], ryo_obj.target_prot[hit])
+            self.assertListEqual(self.exonerate_obj.gff[hit], ryo_obj.gff[hit])
+
+    def test_ryo_parser_ignores_record_without_gff(self):
+        ryo_obj = ExonerateObject(None, ryo_lines=iter(self.ryo_lines(drop_last_gff=True)))
+        self.assertEqual(len(self.exonerate_obj.target_dna) - 1, len(ryo_obj.target_dna))
+
+    def test_ryo_output_written_only_with_output_path(self):
+        with tempdir() as tmp, patch("Exonerate_GenBlast_Wrapper.run_cmd", side_effect=lambda **kwargs: iter(self.ryo_lines())):
+            self.assertIsNotNone(Exonerate_GenBlast_Wrapper.run_exonerate("-m p2g -E no", "region.exon", None, "region.fa", "query.fa", ryo=True))
+            self.assertListEqual([], os.listdir(tmp))
+            ex_obj = Exonerate_GenBlast_Wrapper.run_exonerate("-m p2g -E no", "region.exon", tmp, "region.fa", "query.fa", ryo=True)
+            self.assertEqual(os.path.join(os.path.realpath(tmp), "region.exon"), ex_obj.path)
+            with open(ex_obj.path) as ex:
+                self.assertEqual("".join(self.ryo_lines()), ex.read())
+
+    def test_killed_exonerate_gives_no_predictions(self):
+        def killed_run(**kwargs):
+            yield from self.ryo_lines()[:-1]
+            raise ToolCallError(["exonerate"], -9, killed=True)
+        with tempdir() as tmp, patch("Exonerate_GenBlast_Wrapper.run_cmd", side_effect=killed_run):
+            self.assertIsNone(Exonerate_GenBlast_Wrapper.run_exonerate("-m p2g -E no", "region.exon", None, "region.fa", "query.fa", ryo=True))
+            self.assertIsNone(Exonerate_GenBlast_Wrapper.run_exonerate("-m p2g -E no", "region.exon", tmp, "region.fa", "query.fa"))
+
+
+class TestPredictRegions(unittest.TestCase):
+
+    exonerate_file = os.path.join(test_data, "run_geneps/elegans_eef_true.exonerate")
+
+    exonerate_calls = []
+
+    def fake_run_exonerate(self, mode_string, name, directory, region, query, ryo=False):
+        self.exonerate_calls.append((directory, ryo))
+        return ExonerateObject(self.exonerate_file)
+
+    @staticmethod
+    def fake_phmm_scores(hmm_file, fasta_string, search_space=None, domain_search_space=None):
+        return {line: (100 if hmm_file == "TP_hmm" else 10) for line in fasta_string.split("\n") if line.startswith(">")}
+
+    def predict(self, jobs, cluster_to_proteins=None, fake_run_exonerate=None):
+        cluster_hash = defaultdict(lambda: defaultdict(lambda: "fake"))
+        data_base = namedtuple("DataProvider", "group_by_cluster_to_fasta_file, group_by_cluster_to_fasta_hash, group_by_cluster_to_hmm, "
+                                               "group_by_cluster_to_TN_hmm, group_by_cluster_to_score_cutoff, group_by_cluster_to_length_range")
+        fasta_hash = {"group": cluster_to_proteins} if cluster_to_proteins else defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: "MKV")))
+        data_base = data_base(cluster_hash, fasta_hash,
+                              defaultdict(lambda: defaultdict(lambda: "TP_hmm")), defaultdict(lambda: defaultdict(lambda: "TN_hmm")),
+                              defaultdict(lambda: defaultdict(lambda: 50)), defaultdict(lambda: defaultdict(lambda: [0, 10000])))
+        region = Region(contig="I", s_start=1, s_end=20000, strand="+", chunk_cov=100, query_cov=100, q_len=800)
+        with tempdir() as tmp, patch("use_models.data_base", data_base), patch("use_models.region_to_fasta", return_value=">I\nACGT"), \
+                patch("use_models.run_exonerate", side_effect=fake_run_exonerate or self.fake_run_exonerate), \
+                patch("use_models.get_phmm_score_from_fasta", side_effect=self.fake_phmm_scores) as hmmsearch:
+            work_units = [("group", "cluster_{}".format(idx % 2), region, "genome", tmp, "-") for idx in range(4)]
+            region_results = use_models.compute_region_work_units(work_units, jobs=jobs)
+            self.assertListEqual([], [name for name in os.listdir(tmp) if name.endswith(".region.fa")])
+        return region_results, hmmsearch.call_count
+
+    def test_predict_regions_one_hmmsearch_per_cluster_and_stage(self):
+        region_results, hmmsearch_calls = self.predict(jobs=1)
+        self.assertEqual(6, hmmsearch_calls)    # 2 clusters * (TP, TP after refinement, TN)
+        self.assertEqual(4, len(region_results))
+        for ex_obj, pred_status_list in region_results:
+            self.assertEqual(os.path.realpath(self.exonerate_file), ex_obj.path)
+            self.assertTrue(pred_status_list)
+            self.assertTrue(all([status is True and pred_obj.score == 100 for pred_obj, status in pred_status_list]))
+
+    def test_score_units_search_space_per_region_size(self):
+        calls = []
+
+        def record_phmm_scores(hmm_file, fasta_string, search_space=None, domain_search_space=None):
+            calls.append((search_space, domain_search_space, fasta_string.count(">")))
+            return self.fake_phmm_scores(hmm_file, fasta_string)
+        work_units = [("group", "cluster", None, "genome", "out", "-")] * 3
+        unit_to_fasta = {0: ">0\nMKV", 1: ">0\nMKV\n>1\nMKL", 2: ">0\nMKV\n>1\nMKA"}
+        with patch("use_models.get_phmm_score_from_fasta", side_effect=record_phmm_scores):
+            unit_to_scores = use_models.score_units_by_cluster(work_units, unit_to_fasta, {"group": {"cluster": "TP_hmm"}})
+            self.assertListEqual([(1, None, 1), (2, None, 4)], sorted(calls))
+            self.assertDictEqual({0: {">0": 100}, 1: {">0": 100, ">1": 100}, 2: {">0": 100, ">1": 100}}, unit_to_scores)
+            calls.clear()
+            use_models.score_units_by_cluster(work_units, unit_to_fasta, {"group": {"cluster": "TN_hmm"}}, search_space=1)
+            self.assertListEqual([(1, 1, 5)], calls)
+
+    @unittest.skipIf(shared_code_box.pyhmmer is None, "pyhmmer not installed")
+    def test_score_units_TN_batch_same_as_single_predictions(self):
+        hmm = os.path.join(test_data, "run_geneps/eef_3.5.TN_hmm")
+        proteins = []
+        for fasta_file in ["eef_3.5.fasta", "OrthologousGroups_I3.5.OG0000365.txt.fasta"]:
+            with open(os.path.join(test_data, "run_geneps", fasta_file)) as fasta_f:
+                proteins.extend(["".join(entry.split("\n")[1:]) for entry in fasta_f.read().split(">")[1:]])
+        work_units = [("group", "cluster", None, "genome", "out", "-")] * 3
+        unit_to_fasta = {0: ">0\n{}\n>1\n{}\n>2\n{}".format(*proteins[:3]), 1: ">0\n{}".format(proteins[3]),
+                         2: ">0\n{}\n>1\n{}".format(proteins[4][:60], proteins[5])}
+        single_scores = {unit_idx: {} for unit_idx in unit_to_fasta}
+        for unit_idx, fasta_string in unit_to_fasta.items():
+            for entry in fasta_string.split(">")[1:]:
+                single_scores[unit_idx].update(get_phmm_score_from_fasta(hmm, ">" + entry))
+        unit_to_scores = use_models.score_units_by_cluster(work_units, unit_to_fasta, {"group": {"cluster": hmm}}, search_space=1)
+        self.assertTrue(any(single_scores.values()))
+        self.assertDictEqual(single_scores, unit_to_scores)
+
+    def test_predict_regions_pool_same_results(self):
+        serial, serial_calls = self.predict(jobs=1)
+        parallel, parallel_calls = self.predict(jobs=3)
+        self.assertEqual(serial_calls, parallel_calls)
+        self.assertListEqual([(ex_obj.path, [(pred_obj.gene_start, pred_obj.score, status) for pred_obj, status in pred_status_list]) for ex_obj, pred_status_list in serial],
+                             [(ex_obj.path, [(pred_obj.gene_start, pred_obj.score, status) for pred_obj, status in pred_status_list]) for ex_obj, pred_status_list in parallel])
+
+    def test_predict_regions_ryo_writes_exonerate_output_only_with_keep(self):
+        for keep, writes_files in [(None, False), (True, True)]:
+            self.exonerate_calls.clear()
+            with patch("use_models.ryo", True), patch("use_models.keep", keep):
+                self.predict(jobs=1)
+            self.assertTrue(self.exonerate_calls)
+            self.assertTrue(all([ryo is True and (directory is not None) == writes_files for directory, ryo in self.exonerate_calls]))
+
+    def fake_run_exonerate_tagged(self, mode_string, name, directory, region, query, ryo=False):
+        """hits of the test output, distributed over the (tagged) queries of the query file"""
+        self.exonerate_calls.append((directory, ryo))
+        with open(query) as q_file:
+            tags = [line[1:].strip() for line in q_file if line.startswith(">")]
+        ex_obj = ExonerateObject(self.exonerate_file)
+        return ex_obj.split_by_query({hit.query: [(0, tags[idx % len(tags)])] for idx, hit in enumerate(ex_obj.target_dna)})[0]
+
+    def test_plan_shared_windows(self):
+        regions = [Region(contig="I", s_start=100, s_end=500, strand="+", chunk_cov=100, query_cov=100, q_len=800),
+                   Region(contig="I", s_start=400, s_end=900, strand="+", chunk_cov=100, query_cov=100, q_len=800),
+                   Region(contig="I", s_start=450, s_end=600, strand="-", chunk_cov=100, query_cov=100, q_len=800),
+                   Region(contig="II", s_start=450, s_end=600, strand="+", chunk_cov=100, query_cov=100, q_len=800),
+                   Region(contig="I", s_start=900, s_end=1000, strand="+", chunk_cov=100, query_cov=100, q_len=800)]
+        windows = use_models.plan_shared_windows([("group", "cluster_{}".format(idx), region) for idx, region in enumerate(regions)])
+        self.assertListEqual([[0, 1, 4], [2], [3]], [member_idx for window, member_idx in windows])
+        self.assertEqual((100, 1000), (windows[0][0].s_start, windows[0][0].s_end))
+
+    def test_predict_regions_shared_windows_split_by_cluster(self):
+        cluster_to_proteins = {"cluster_0": {">protein_0": "MKV", ">shared": "MKVL"}, "cluster_1": {">protein_1": "MKVA", ">shared": "MKVL"}}
+        self.exonerate_calls.clear()
+        with patch("use_models.share_regions", True):
+            region_results, hmmsearch_calls = self.predict(jobs=1, cluster_to_proteins=cluster_to_proteins, fake_run_exonerate=self.fake_run_exonerate_tagged)
+        self.assertEqual(2, len(self.exonerate_calls))    # one window: align + refine instead of 4 + 4
+        self.assertEqual(6, hmmsearch_calls)
+        for idx, (ex_obj, pred_status_list) in enumerate(region_results):
+            if idx < 2:
+                self.assertTrue(pred_status_list)
+                self.assertTrue(set([hit.query for hit in ex_obj.target_dna]).issubset([header[1:] for header in cluster_to_proteins["cluster_{}".format(idx)]]))
+            else:   # same clusters as work units 0 and 1 in the same window
+                self.assertIsNone(ex_obj)
+
+    def test_compute_region_work_units_empty(self):
+        self.assertListEqual([], use_models.compute_region_work_units([], jobs=4))
+
+
+class TestAnalyseAllGenomes(unittest.TestCase):
+
+    genome_dict = {"/genomes/genome_{}.fa".format(idx): "genome_{}".format(idx) for idx in range(4)}
+
+    @staticmethod
+    def fake_analyse_genome(genome_path, genome_prefix, genome_count, region_jobs=1):
+        with open(os.path.join(use_models.get_outdir(use_models.out_dir, add_dir=genome_prefix), "summary.txt"), "w") as sum_file:
+            sum_file.write(genome_path)
+
+    def test_analyse_all_genomes_parallel_writes_every_genome(self):
+        with tempdir() as tmp, patch("use_models.out_dir", tmp), \
+                patch("use_models.analyse_genome", side_effect=self.fake_analyse_genome):
+            use_models.analyse_all_genomes(self.genome_dict, genome_jobs=2)
+            for genome_path, genome_prefix in self.genome_dict.items():
+                with open(os.path.join(tmp, genome_prefix, "summary.txt")) as sum_file:
+                    self.assertEqual(genome_path, sum_file.read())
+
+
 '''
 
 class TestOverseerPredictAllRegions(unittest.TestCase):
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 '''
-Usage: use_models.py                          -i <DIR> -g <FILE> [-c <INT>] [-o <DIR>] [--keep] [--verbose] [--frag] [--quick]
+Usage: use_models.py                          -i <DIR> -g <FILE> [-c <INT>] [-o <DIR>] [--keep] [--verbose] [--frag] [--quick] [--jobs <INT>] [--genome_jobs <INT>] [--single_blast] [--ryo] [--share_regions] [--genome_wide_overlaps] [--merge_distance <INT>] [--flank_distance <INT>] [--chain_hsps] [--db_cache <DIR>] [--threads <INT>] [--tool_threads <INT>] [--timeout <INT>]
 
     Options:
         -h, --help                            show this screen.
@@ -16,6 +16,19 @@ Usage: use_models.py                          -i <DIR> -g <FILE> [-c <INT>] [-o
         --frag                                If enabled, a length filter will be applied to remove potentially fragmented predictions
         --keep                                Keeps intermediate files (Blast output, merged regions, exonerate output)
         --verbose                             Prints progress details to the screen
+        --jobs <INT>                          Number of candidate regions predicted in parallel (exonerate and HMM filters) [default: 1]
+        --genome_jobs <INT>                   Number of genomes (-g list) analysed in parallel; regions of each genome are then predicted one after another [default: 1]
+        --single_blast                        Runs one tblastn with the consensus sequences of all groups instead of one per group; it gets all --threads (or --jobs) threads, shared by --genome_jobs, unless --tool_threads is set
+        --ryo                                 Exonerate reports compact records (--ryo) which are parsed while it runs; its output is only written to files with --keep
+        --share_regions                       Overlapping candidate regions of all clusters and groups (same contig and strand) are merged into shared windows; exonerate runs once per window with the proteins of all its clusters
+        --genome_wide_overlaps                Overlapping valid predictions of different groups compete as well (one prediction per locus and strand in the whole genome instead of per group)
+        --merge_distance <INT>                Fixed distance (bp) up to which Blast hits are merged into one region for all clusters (default: longest expected gene span of the cluster, or 10000 for models without span)
+        --flank_distance <INT>                Fixed flank (bp) added to both sides of every region (default: half of the longest expected gene span of the cluster, or 5000 for models without span)
+        --chain_hsps                          Blast hits of a cluster are chained by query and genome order (collinear chains, gaps up to the merging distance) instead of merged by distance only; tandem copies get separate regions
+        --db_cache <DIR>                      Directory for BLAST databases and tblastn results, re-used across runs as long as genome, consensus sequences and options are unchanged (default: <out_dir>/blast_db_cache)
+        --threads <INT>                       Total number of threads all external tools (tblastn, exonerate, hmmer) may use at once (default: no limit)
+        --tool_threads <INT>                  Threads per tblastn/hmmsearch call (default: 1 with --threads, else tool defaults)
+        --timeout <INT>                       Seconds after which a single external tool call is killed (default: no timeout)
 
 '''
 
@@ -24,10 +37,12 @@ import sys
 import logging
 import tempfile as tmp
 from docopt import docopt
-from shared_code_box import tempdir, check_programs, get_phmm_score, write_to_tempfile, get_outdir, hash_fasta
+from shared_code_box import tempdir, check_programs, get_phmm_score_from_fasta, write_to_tempfile, get_outdir, hash_fasta,\
+    tool_scheduler, tool_recorder, get_process_pool, start_log_listener, init_worker_logging, ToolCallError
 from Exonerate_GenBlast_Wrapper import run_exonerate, all_proteins_to_fasta_string,\
     isolate_overlapping_predictions, PredictionObject
-from Blast_wrapper import run_tblastn, make_blast_db
+from Blast_wrapper import run_tblastn, run_tblastn_all_groups, make_blast_db, get_genome_index, extract_region,\
+    region_to_fasta, default_merging_distance, default_flanking_distance
 from collections import defaultdict
 from itertools import chain #GK
 
@@ -43,6 +58,17 @@ verbose = None
 genome = None
 frag = None
 quick = None
+jobs = 1
+genome_jobs = 1
+single_blast = None
+single_blast_threads = None
+ryo = None
+share_regions = None
+genome_wide_overlaps = None
+merge_distance = None
+flank_distance = None
+chain_hsps = None
+db_cache = None
 console = logging.StreamHandler()
 console.setLevel(logging.INFO)
 logger_blast_region = logging.getLogger("BLAST")
@@ -73,12 +99,17 @@ def format_genome_hash(argument):
 
 
 def check_arguments(args):
-    global coverage_min, out_dir, gene_ps_results, keep, verbose, genome, frag, quick
+    global coverage_min, out_dir, gene_ps_results, keep, verbose, genome, frag, quick, jobs, genome_jobs, single_blast, single_blast_threads, ryo, share_regions, genome_wide_overlaps, merge_distance, flank_distance, chain_hsps, db_cache
     gene_ps_results = os.path.abspath(args['--use_models_input'])
     keep = args['--keep']
     verbose = args['--verbose']
     frag = args['--frag']
     quick = args['--quick']
+    single_blast = args['--single_blast']
+    ryo = args['--ryo']
+    share_regions = args['--share_regions']
+    genome_wide_overlaps = args['--genome_wide_overlaps']
+    chain_hsps = args['--chain_hsps']
     error_list = []
     if not os.path.exists(gene_ps_results):
         error_list.append("[!]\t ERROR: input directory: {} does not exist".format(gene_ps_results))
@@ -89,6 +120,21 @@ def check_arguments(args):
             coverage_min = int(args['--coverage_filer'])
         except ValueError:
             error_list.append("[!]\t ERROR: coverage_min needs integer; '{}' is not an integer".format(coverage_min))
+    try:
+        jobs = max(1, int(args['--jobs']))
+        genome_jobs = max(1, int(args['--genome_jobs']))
+        merge_distance = int(args['--merge_distance']) if args['--merge_distance'] else None
+        flank_distance = int(args['--flank_distance']) if args['--flank_distance'] else None
+    except ValueError:
+        error_list.append("[!]\t ERROR: --jobs, --genome_jobs, --merge_distance and --flank_distance need integers")
+    try:
+        tool_scheduler.configure(threads=int(args['--threads']) if args['--threads'] else None,
+                                 tool_threads=int(args['--tool_threads']) if args['--tool_threads'] else None,
+                                 timeout=int(args['--timeout']) if args['--timeout'] else None)
+        if single_blast and not args['--tool_threads']:
+            single_blast_threads = max(1, (tool_scheduler.threads or jobs) // genome_jobs)
+    except ValueError:
+        error_list.append("[!]\t ERROR: --threads, --tool_threads and --timeout need integers")
     if args["--out_dir"]:
         if os.path.isdir(args["--out_dir"]):
             out_dir = get_outdir(args["--out_dir"])
@@ -96,6 +142,10 @@ def check_arguments(args):
             out_dir = get_outdir("/".join(gene_ps_results.split("/")[:-1]), add_dir=args["--out_dir"])
     else:
         out_dir = get_outdir("/".join(gene_ps_results.split("/")[:-1]), add_dir="Predictions")
+    if args["--db_cache"]:
+        db_cache = os.path.abspath(args["--db_cache"])
+    else:
+        db_cache = os.path.join(out_dir, "blast_db_cache")
     errors, genome_hash = format_genome_hash(args)
     error_list.extend(errors)
     if error_list:
@@ -120,19 +170,25 @@ def convert_summary_to_string(summary_array):
     return "\n".join(summary_list)
 
 
-def markov_model_scoring(fasta_string, hmm):
-    if hmm:
-        with tmp.NamedTemporaryFile() as ex_file:
-            write_to_tempfile(ex_file.name, fasta_string)
-            score_hash = get_phmm_score(hmm, ex_file.name)
-            if score_hash:
-                return score_hash
-    return None
+def get_region_distances(group):
+    """merging and flanking distance of the candidate regions per cluster of a group: the longest expected gene
+    span of the cluster (#span in the .GenePS file) and half of it, unless fixed by --merge_distance or
+    --flank_distance. Clusters without span (models of older versions) keep the defaults of BlastObject."""
+    cluster_to_distances = {}
+    for cluster in data_base.group_by_cluster_to_score_cutoff[group]:
+        if cluster in data_base.group_by_cluster_to_span[group]:
+            max_span = data_base.group_by_cluster_to_span[group][cluster][1]
+            merging, flanking = max_span, max_span // 2
+        else:
+            merging, flanking = default_merging_distance, default_flanking_distance
+        cluster_to_distances[cluster] = (merging if merge_distance is None else merge_distance, flanking if flank_distance is None else flank_distance)
+    return cluster_to_distances
 
 
 def write_merged_region_to_intermediate(blast_ob):
     results_list = [
         "# Merging Distance: {}, Flanking Distance {}".format(blast_ob.merging_distance, blast_ob.flanking_distance),
+        "# Per query Merging/Flanking Distance: {}".format(", ".join(["{}: {}/{}".format(query, *distances) for query, distances in sorted(blast_ob.query_to_distances.items())])),
         "# Fields: contig, subject, subject_start, subject_end, strand, chunk_coverage, total_coverage, query_length"]
     for contig in blast_ob.inferred_regions:
         for query in blast_ob.inferred_regions[contig]:
@@ -141,52 +197,140 @@ def write_merged_region_to_intermediate(blast_ob):
     return "\n".join(results_list)
 
 
-def find_best_exonerate_result(region_tuple, region_fasta, group, cluster, dir_path):
-    '''first aligns all proteins in p2g mode, scores them against the hmm and extracts the highest scoring predictions.
-    Then the corresponding actual proteins of those are re-aligned in p2g -E yes mode. Returned exonerate object,
-    holds thoses (few-best) predictions -> needs for further filtering.'''
-    query_fasta = data_base.group_by_cluster_to_fasta_file[group][cluster]
-    query_hash = data_base.group_by_cluster_to_fasta_hash[group][cluster]
-    hmm = data_base.group_by_cluster_to_hmm[group][cluster]
-    cutoff = data_base.group_by_cluster_to_score_cutoff[group][cluster]
-    length_range = data_base.group_by_cluster_to_length_range[group][cluster]
-    with tmp.NamedTemporaryFile() as reg_file:
-        write_to_tempfile(reg_file.name, region_fasta)
-        ex_obj = run_exonerate("-m p2g -E no", "{}.exon_p2g", dir_path, reg_file.name, query_fasta)
-        try:
-            TP_scores = markov_model_scoring(all_proteins_to_fasta_string(ex_obj), hmm)
-            if not quick:
-                max_score = max(list(TP_scores.values()))
-                max_header = set([header.split(";")[0] for header, score in TP_scores.items() if score == max_score])
-                with tmp.NamedTemporaryFile() as q_file:
-                    max_val_fasta = "\n".join(["{}\n{}".format(header, query_hash[header]) for header in max_header])
-                    write_to_tempfile(q_file.name, max_val_fasta)
-                    ex_obj = run_exonerate("-m p2g -E yes", "{}.exon".format(q_file.name), dir_path, reg_file.name, q_file.name)
-                    TP_scores = markov_model_scoring(all_proteins_to_fasta_string(ex_obj), hmm)
-            best_pred = []
-            for key_tuple in ex_obj.target_dna:
-                score_id = ">" + key_tuple.query + ";{}".format(key_tuple.idx)
-                pred_obj = PredictionObject(region_tuple, TP_scores[score_id], cluster, cutoff, length_range)
-                pred_obj.infer_data_from_exonerate_obj(ex_obj, key_tuple)
-                best_pred.append(pred_obj)
-            filtered, passed = isolate_overlapping_predictions(sorted(best_pred, key=lambda x: x.score, reverse=True))
-            return ex_obj, passed
-        except (AttributeError, TypeError, KeyError):
-            return None, None
-
-
-def prediction_filter(pred_obj, TN_HMM):
+def exonerate_output_directory(out_directory):
+    """directory for exonerate output files; None (no files) with --ryo unless --keep asks for them"""
+    if ryo and not keep:
+        return None
+    return out_directory
+
+
+def plan_shared_windows(work_units):
+    """merges overlapping regions (same contig and strand) of all work units, across clusters and groups, into
+    shared target windows. Returns a list of (window region, [work unit index]) ordered by their first work unit."""
+    windows = []
+    for idx in sorted(range(len(work_units)), key=lambda idx: (work_units[idx][2].contig, work_units[idx][2].strand, work_units[idx][2].s_start, idx)):
+        region = work_units[idx][2]
+        if windows and (windows[-1][0].contig, windows[-1][0].strand) == (region.contig, region.strand) and region.s_start <= windows[-1][0].s_end:
+            window, member_idx = windows[-1]
+            windows[-1] = (window._replace(s_end=max(window.s_end, region.s_end)), member_idx + [idx])
+        else:
+            windows.append((region, [idx]))
+    return sorted([(window, sorted(member_idx)) for window, member_idx in windows], key=lambda window: window[1][0])
+
+
+def run_exonerate_on_window(mode_string, out_directory, window_file, member_queries):
+    """runs exonerate once with the union of the queries of all members of a window (member_queries: one dict
+    >header: sequence per member) and splits the hits back to the members by query membership. Returns one
+    exonerate object per member (None without hits)."""
+    query_to_tag, query_to_members = {}, defaultdict(list)
+    for member_idx, query_hash in enumerate(member_queries):
+        for header, sequence in query_hash.items():
+            tag = query_to_tag.setdefault((header, sequence), "GenePSq{}".format(len(query_to_tag)))
+            query_to_members[tag].append((member_idx, header[1:]))
+    if not query_to_tag:
+        return [None] * len(member_queries)
+    with tmp.NamedTemporaryFile() as q_file:
+        write_to_tempfile(q_file.name, "\n".join([">{}\n{}".format(tag, sequence) for (header, sequence), tag in query_to_tag.items()]))
+        ex_obj = run_exonerate(mode_string, "{}.exon".format(q_file.name), exonerate_output_directory(out_directory), window_file, q_file.name, ryo=ryo)
+    if ex_obj is None:
+        return [None] * len(member_queries)
+    member_to_ex_obj = ex_obj.split_by_query(query_to_members)
+    return [member_to_ex_obj.get(member_idx) for member_idx in range(len(member_queries))]
+
+
+def align_window(window_job):
+    """first stage of a target window: writes the window to a fasta file and aligns all proteins of the clusters of
+    its work units in p2g mode (once per window; a cluster with several work units in the window gets the hits
+    only for the first one). Returns the window file and (exonerate object, predicted proteins as fasta string) per
+    work unit (both None if exonerate found nothing)."""
+    window, member_units = window_job
+    group, cluster, region, genome_path, out_directory, tool_context = member_units[0]
+    with tmp.NamedTemporaryFile("w", dir=out_directory, suffix=".region.fa", delete=False) as reg_file:
+        reg_file.write(region_to_fasta(genome_path, window))
+    with tool_recorder.context(tool_context):
+        if len(member_units) == 1:
+            ex_obj_list = [run_exonerate("-m p2g -E no", "{}.exon_p2g".format(os.path.basename(reg_file.name)), exonerate_output_directory(out_directory),
+                                         reg_file.name, data_base.group_by_cluster_to_fasta_file[group][cluster], ryo=ryo)]
+        else:
+            member_queries, seen_clusters = [], set()
+            for member_unit in member_units:
+                member_queries.append({} if tuple(member_unit[:2]) in seen_clusters else data_base.group_by_cluster_to_fasta_hash[member_unit[0]][member_unit[1]])
+                seen_clusters.add(tuple(member_unit[:2]))
+            ex_obj_list = run_exonerate_on_window("-m p2g -E no", out_directory, reg_file.name, member_queries)
+    return reg_file.name, [(None, None) if ex_obj is None else (ex_obj, all_proteins_to_fasta_string(ex_obj)) for ex_obj in ex_obj_list]
+
+
+def refine_window(refine_job):
+    """second stage (not with --quick): re-aligns the cluster proteins with the highest HMM score in the first
+    stage in p2g -E yes mode, once per window for all its work units. refine_job: window file, [(work unit, TP
+    scores)]. Returns (exonerate object, predicted proteins) per work unit (None if exonerate found nothing)."""
+    window_file, member_jobs = refine_job
+    member_queries = []
+    for work_unit, TP_scores in member_jobs:
+        query_hash = data_base.group_by_cluster_to_fasta_hash[work_unit[0]][work_unit[1]]
+        max_score = max(list(TP_scores.values()))
+        member_queries.append({header: query_hash[header] for header in set([header.split(";")[0] for header, score in TP_scores.items() if score == max_score])})
+    group, cluster, region, genome_path, out_directory, tool_context = member_jobs[0][0]
+    with tool_recorder.context(tool_context):
+        if len(member_jobs) == 1:
+            with tmp.NamedTemporaryFile() as q_file:
+                write_to_tempfile(q_file.name, "\n".join(["{}\n{}".format(header, sequence) for header, sequence in member_queries[0].items()]))
+                ex_obj_list = [run_exonerate("-m p2g -E yes", "{}.exon".format(q_file.name), exonerate_output_directory(out_directory), window_file, q_file.name, ryo=ryo)]
+        else:
+            ex_obj_list = run_exonerate_on_window("-m p2g -E yes", out_directory, window_file, member_queries)
+    return [(None, None) if ex_obj is None else (ex_obj, all_proteins_to_fasta_string(ex_obj)) for ex_obj in ex_obj_list]
+
+
+def build_region_predictions(prediction_job):
+    """last stage of a region: prediction objects of all exonerate hits with their HMM scores; overlapping
+    predictions within the region are removed. Returns None if a hit has no score."""
+    work_unit, ex_obj, TP_scores = prediction_job
+    group, cluster, region, genome_path, out_directory, tool_context = work_unit
+    best_pred = []
+    try:
+        for key_tuple in ex_obj.target_dna:
+            score_id = ">" + key_tuple.query + ";{}".format(key_tuple.idx)
+            pred_obj = PredictionObject(region, TP_scores[score_id], cluster, data_base.group_by_cluster_to_score_cutoff[group][cluster],
+                                        data_base.group_by_cluster_to_length_range[group][cluster])
+            pred_obj.infer_data_from_exonerate_obj(ex_obj, key_tuple)
+            best_pred.append(pred_obj)
+    except KeyError:
+        return None
+    filtered, passed = isolate_overlapping_predictions(sorted(best_pred, key=lambda x: x.score, reverse=True))
+    return passed
+
+
+def score_units_by_cluster(work_units, unit_to_fasta, cluster_to_hmm, search_space=None):
+    """scores the proteins of all regions of a cluster with one hmmsearch run per number of proteins in a region.
+    unit_to_fasta: work unit index: fasta string; headers are tagged with the index. The search space (-Z) is the
+    number of proteins of a region, so the reporting thresholds are those of one hmmsearch run per region and scores
+    do not depend on the batch. A fixed search_space (e.g. 1 for single predictions) is used for -Z and --domZ of
+    one run per cluster instead. Returns a dict index: {>header: score} (empty if no hits)."""
+    cluster_to_units = defaultdict(list)
+    for unit_idx in unit_to_fasta:
+        unit_search_space = search_space or unit_to_fasta[unit_idx].count(">")
+        cluster_to_units[(tuple(work_units[unit_idx][:2]), unit_search_space)].append(unit_idx)
+    unit_to_scores = {unit_idx: {} for unit_idx in unit_to_fasta}
+    for ((group, cluster), unit_search_space), unit_idx_list in cluster_to_units.items():
+        hmm = cluster_to_hmm[group][cluster]
+        if hmm:
+            tagged_fasta = "\n".join([unit_to_fasta[unit_idx].replace(">", ">{}|".format(unit_idx)) for unit_idx in unit_idx_list])
+            with tool_recorder.context(work_units[unit_idx_list[0]][5]):
+                tagged_scores = get_phmm_score_from_fasta(hmm, tagged_fasta, search_space=unit_search_space, domain_search_space=search_space)
+            for tagged_header, score in tagged_scores.items():
+                unit_idx, header = tagged_header[1:].split("|", 1)
+                unit_to_scores[int(unit_idx)][">" + header] = score
+    return unit_to_scores
+
+
+def prediction_filter(pred_obj, TN_score, TN_HMM):
+    """passes predictions reaching the cluster cutoff which score higher against the TP than against the TN HMM"""
     status = False
     TP_score = pred_obj.score
     if TP_score and TP_score >= pred_obj.cutoff:
         if TN_HMM:
-            protein_fasta = ">{}\n{}".format(pred_obj.cluster, pred_obj.protein)
-            try:
-                TN_score = list(markov_model_scoring(protein_fasta, TN_HMM).values())[0]
-                if TN_score < TP_score:
-                    status = True
-            except AttributeError:
-                pass
+            if TN_score is not None and TN_score < TP_score:
+                status = True
         else:
             status = True
     if frag and status is True:
@@ -195,6 +339,106 @@ def prediction_filter(pred_obj, TN_HMM):
     return status
 
 
+def region_stage_worker(stage_job):
+    """worker function of the region pool; returns the tool usage records of the stage along with the result"""
+    tool_recorder.drain()   # records inherited from the main process
+    stage_function, argument = stage_job
+    return stage_function(argument), tool_recorder.drain()
+
+
+def map_region_stage(stage_function, arguments, pool=None):
+    """results of stage_function for all arguments in input order, computed by the pool if given"""
+    if pool is None:
+        return [stage_function(argument) for argument in arguments]
+    stage_results = []
+    for result, tool_records in pool.imap(region_stage_worker, [(stage_function, argument) for argument in arguments]):
+        tool_recorder.records.extend(tool_records)
+        stage_results.append(result)
+    return stage_results
+
+
+def predict_regions(work_units, pool=None):
+    """exonerate predictions and prediction filter status for all work units. Exonerate runs per region, or with
+    --share_regions per shared window of overlapping regions (in the pool); the TP HMM scores after each exonerate
+    stage and the TN HMM scores are computed with one hmmsearch per cluster. Returns (exonerate object or None,
+    [(prediction, status)]) per work unit."""
+    if not work_units:
+        return []
+    if share_regions:
+        windows = plan_shared_windows(work_units)
+    else:
+        windows = [(work_unit[2], [idx]) for idx, work_unit in enumerate(work_units)]
+    window_results = map_region_stage(align_window, [(window, [work_units[idx] for idx in member_idx]) for window, member_idx in windows], pool)
+    ex_objs, protein_fastas, unit_to_window = [None] * len(work_units), [None] * len(work_units), {}
+    prediction_units = list(work_units)
+    for window_idx, ((window, member_idx), (window_file, member_results)) in enumerate(zip(windows, window_results)):
+        for idx, (ex_obj, protein_fasta) in zip(member_idx, member_results):
+            ex_objs[idx], protein_fastas[idx], unit_to_window[idx] = ex_obj, protein_fasta, window_idx
+            group, cluster, region, genome_path, out_directory, tool_context = work_units[idx]
+            prediction_units[idx] = (group, cluster, region._replace(s_start=window.s_start, s_end=window.s_end), genome_path, out_directory, tool_context)
+    window_files = [window_file for window_file, member_results in window_results]
+    unit_to_first_of_cluster = {}    # work units of a cluster sharing a window get the hits of the first one
+    for window, member_idx in windows:
+        cluster_to_first_idx = {}
+        for idx in member_idx:
+            unit_to_first_of_cluster[idx] = cluster_to_first_idx.setdefault(tuple(work_units[idx][:2]), idx)
+    exonerate_calls, exonerate_calls_per_region = len(windows), len(work_units)
+    TP_scores = score_units_by_cluster(work_units, {idx: fasta for idx, fasta in enumerate(protein_fastas) if fasta is not None}, data_base.group_by_cluster_to_hmm)
+    if not quick:
+        window_to_refine_idx = defaultdict(list)
+        for idx in sorted([idx for idx in TP_scores if TP_scores[idx]]):
+            window_to_refine_idx[unit_to_window[idx]].append(idx)
+        refined = map_region_stage(refine_window, [(window_files[window_idx], [(work_units[idx], TP_scores[idx]) for idx in refine_idx])
+                                                   for window_idx, refine_idx in window_to_refine_idx.items()], pool)
+        exonerate_calls += len(window_to_refine_idx)
+        refined_idx = set(chain.from_iterable(window_to_refine_idx.values()))
+        exonerate_calls_per_region += len(refined_idx) + len([idx for idx in range(len(work_units)) if unit_to_first_of_cluster[idx] in refined_idx and unit_to_first_of_cluster[idx] != idx])
+        ex_objs, protein_fastas = [None] * len(work_units), {}
+        for refine_idx, member_results in zip(window_to_refine_idx.values(), refined):
+            for idx, (ex_obj, protein_fasta) in zip(refine_idx, member_results):
+                ex_objs[idx] = ex_obj
+                if protein_fasta is not None:
+                    protein_fastas[idx] = protein_fasta
+        TP_scores = score_units_by_cluster(work_units, protein_fastas, data_base.group_by_cluster_to_hmm)
+    for window_file in window_files:
+        os.remove(window_file)
+    if share_regions:
+        print("\t[+] {} shared windows for {} regions: {} exonerate calls instead of {} ({} saved)".format(
+            len(windows), len(work_units), exonerate_calls, exonerate_calls_per_region, exonerate_calls_per_region - exonerate_calls))
+        logger_prediction.info("shared windows: {} for {} regions - exonerate calls: {} instead of {} ({} saved)".format(
+            len(windows), len(work_units), exonerate_calls, exonerate_calls_per_region, exonerate_calls_per_region - exonerate_calls))
+    prediction_idx = [idx for idx in TP_scores if ex_objs[idx] is not None and TP_scores[idx]]
+    unit_to_predictions = dict(zip(prediction_idx, map_region_stage(build_region_predictions, [(prediction_units[idx], ex_objs[idx], TP_scores[idx]) for idx in prediction_idx], pool)))
+    unit_to_TN_fasta = {}
+    for idx, pred_obj_list in unit_to_predictions.items():
+        fasta_list = [">{}\n{}".format(pred_idx, pred_obj.protein) for pred_idx, pred_obj in enumerate(pred_obj_list or [])
+                      if pred_obj.score and pred_obj.score >= pred_obj.cutoff]
+        if fasta_list:
+            unit_to_TN_fasta[idx] = "\n".join(fasta_list)
+    TN_scores = score_units_by_cluster(work_units, unit_to_TN_fasta, data_base.group_by_cluster_to_TN_hmm, search_space=1)
+    region_results = []
+    for idx, (group, cluster) in enumerate([work_unit[:2] for work_unit in work_units]):
+        if unit_to_predictions.get(idx) is None:
+            region_results.append((None, []))
+        else:
+            TN_hmm = data_base.group_by_cluster_to_TN_hmm[group][cluster]
+            region_results.append((ex_objs[idx], [(pred_obj, prediction_filter(pred_obj, TN_scores.get(idx, {}).get(">{}".format(pred_idx)), TN_hmm))
+                                                    for pred_idx, pred_obj in enumerate(unit_to_predictions[idx])]))
+    return region_results
+
+
+def compute_region_work_units(work_units, jobs=1):
+    """results of predict_regions for all work units in input order; with jobs > 1 exonerate runs in a pool"""
+    if jobs < 2 or len(work_units) < 2:
+        return predict_regions(work_units)
+    log_queue, log_listener = start_log_listener()
+    try:
+        with get_process_pool(min(jobs, len(work_units)), initializer=init_worker_logging, initargs=(log_queue,)) as pool:
+            return predict_regions(work_units, pool)
+    finally:
+        log_listener.stop()
+
+
 ########################################################################################################################
 # Class: DataProvider (reads in and processes Gene PS files
 ########################################################################################################################
@@ -213,6 +457,7 @@ class DataProviderObject:
         self.group_by_cluster_to_fasta_hash = defaultdict(dict)
         self.group_by_cluster_to_length_range = defaultdict(dict)
         self.group_by_cluster_to_score_cutoff = defaultdict(dict)
+        self.group_by_cluster_to_span = defaultdict(dict)
         self.cluster_scope = self.load_data_and_initialize_global_variables()
 
     def check_loaded_data(self, cluster_count, input_scope, error_list):
@@ -270,6 +515,8 @@ class DataProviderObject:
                                     self.group_by_cluster_to_fasta_hash[group_name][cluster] = hash_fasta(self.group_by_cluster_to_fasta_file[group_name][cluster])
                                 else:
                                     error_list += files_not_found
+                            elif line.startswith("#span:"):     # optional, older models have no span
+                                self.group_by_cluster_to_span[group_name][cluster] = [int(x) for x in line.split(":")[1].strip().split(",")]
                             else:
                                 pass
         return self.check_loaded_data(cluster_count, input_scope, error_list)
@@ -283,10 +530,11 @@ class Overseer:
     def __init__(self, g_prefix, genome_location, prediction_location):
         self.g_prefix = g_prefix
         self.genome_path = genome_location
+        self.db_path = genome_location
         self.root_directory = prediction_location
         self.group_to_out_dir = {}
         self.group_to_blast_obj = {}
-        self.exonerate_file_paths = []
+        self.exonerate_path_to_regions = {}    # shared windows: one exonerate file for several regions
 
         # statistics
         self.input_scope = 0
@@ -325,14 +573,20 @@ class Overseer:
     # --> from_header_list_to_fasta
     def blast_all_consensus(self, tmp_directory):
         self.merged_regions = 0
+        if single_blast:
+            group_to_blast_obj = self.blast_all_consensus_at_once(tmp_directory)
         for group in data_base.group_names:
             consensus_file = data_base.group_to_consensus_file[group]
-            if keep:
-                blast_obj = run_tblastn(self.genome_path, consensus_file, self.group_to_out_dir[group] + "_intermediate_blast.txt")
-            else:
-                blast_obj = run_tblastn(self.genome_path, consensus_file, os.path.join(tmp_directory, group))
+            with tool_recorder.context("{}/{}".format(self.g_prefix, group)):
+                if single_blast:
+                    blast_obj = group_to_blast_obj.get(group)
+                elif keep:
+                    blast_obj = run_tblastn(self.db_path, consensus_file, self.group_to_out_dir[group] + "_intermediate_blast.txt", self.genome_path, db_cache)
+                else:
+                    blast_obj = run_tblastn(self.db_path, consensus_file, os.path.join(tmp_directory, group), self.genome_path, db_cache)
+                if blast_obj is not None:
+                    blast_obj.infer_regions(get_region_distances(group), chain_hsps=chain_hsps)
             if blast_obj is not None:
-                blast_obj.infer_regions()
                 self.merged_regions += blast_obj.amount_regions
                 self.group_to_blast_obj[group] = blast_obj
                 if keep:
@@ -342,6 +596,15 @@ class Overseer:
                 logger_blast_region.warning("No Candidate regions found - group: {}".format(group))
         return self.merged_regions
 
+    def blast_all_consensus_at_once(self, tmp_directory):
+        """one tblastn run with the consensus sequences of all groups; returns a dict group: BlastObject"""
+        if keep:
+            blast_file = os.path.join(self.root_directory, "intermediate_blast_all_groups.txt")
+        else:
+            blast_file = os.path.join(tmp_directory, "all_groups")
+        with tool_recorder.context(self.g_prefix):
+            return run_tblastn_all_groups(self.db_path, {group: data_base.group_to_consensus_file[group] for group in data_base.group_names}, blast_file, self.genome_path, db_cache, single_blast_threads)
+
     ##############################################################################################
     # run exonerate on all region -> regional prediction filter -> contigwise_overplapping_control
     ##############################################################################################
@@ -374,32 +637,63 @@ class Overseer:
             self.group_by_cluster_by_contig_to_valid_prediction[group][p_pred.cluster][p_pred.contig].append(p_pred)
         return filtered
 
-    def get_exonerate_models(self, out_directory):
+    def get_exonerate_models(self, out_directory, jobs=1):
+        """exonerate + prediction filter for all regions passing the coverage filter; with jobs > 1 the regions are
+        distributed over a process pool. Counters, output dicts and the per-contig overlap resolution are updated
+        afterwards in the serial region order, so the results do not depend on jobs. Regions are passed as
+        coordinates; their sequences are read from the genome when needed and streamed to region.fasta."""
+        work_units = []
+        with open(os.path.join(self.root_directory, "region.fasta"), "w") as region_f:
+            for group in self.group_to_blast_obj:
+                for contig in self.group_to_blast_obj[group].inferred_regions:
+                    for cluster, region_list in self.group_to_blast_obj[group].inferred_regions[contig].items():
+                        for region in region_list:
+                            region_f.write(">{}_{}_{}\n{}\n".format(region.contig, region.s_start, region.s_end,
+                                                                    extract_region(self.genome_path, region.contig, region.s_start, region.s_end)))
+                            if coverage_filter(region) is True:
+                                work_units.append((group, cluster, region, self.genome_path, out_directory, "{}/{}/{}".format(self.g_prefix, group, cluster)))
+        region_results = iter(compute_region_work_units(work_units, jobs))
         for group in self.group_to_blast_obj:
             for contig in self.group_to_blast_obj[group].inferred_regions:
                 for cluster, region_list in self.group_to_blast_obj[group].inferred_regions[contig].items():
                     for region in region_list:
-                        out_re.write( ">" + region.contig + "_" + str(region.s_start) + "_" + str(region.s_end) + "\n") #GK
-                        out_re.write(self.group_to_blast_obj[group].fasta_region[region]+ "\n") #GK
                         if coverage_filter(region) is True:
-                            region_fasta = self.group_to_blast_obj[group].region_tuple_to_fasta[region]
-                            exo_obj, pred_obj_list = find_best_exonerate_result(region, region_fasta, group, cluster, out_directory)
-                            if exo_obj is None:
+                            ex_obj, pred_status_list = next(region_results)
+                            if ex_obj is None:
                                 self.filter_count += 1
                                 logger_prediction.info("No Exonerate prediction - genome: {} group: {} cluster: {} loci: {} {}_{}".format(self.g_prefix, group, cluster, region.contig, region.s_start, region.s_end))
                             else:
-                                self.merged_regions += len(pred_obj_list) - 1
-                                self.exonerate_file_paths.append(exo_obj.path)
-                                for pred_obj in pred_obj_list:
-                                    status = prediction_filter(pred_obj, data_base.group_by_cluster_to_TN_hmm[group][cluster])
+                                self.merged_regions += len(pred_status_list) - 1
+                                if ex_obj.path is not None:
+                                    self.exonerate_path_to_regions.setdefault(ex_obj.path, []).append(
+                                        "{}/{} {}:{}-{}".format(group, cluster, region.contig, region.s_start, region.s_end))
+                                for pred_obj, status in pred_status_list:
                                     self.filter_count += self.inform_overseer_about_status(status, group, pred_obj)
                         else:
                             self.filter_count += 1
                             logger_validate.info("Low Coverage - genome: {} group: {} cluster: {} loci: {} {}_{} {} cov_chunk: {} cov_total:{}".format(self.g_prefix, group, cluster, contig, region.s_start, region.s_end, region.strand, region.chunk_cov, region.query_cov))
-                overlap_list, passed_list = isolate_overlapping_predictions(self.group_by_contig_to_passed_prediction_list[group][contig])
-                self.filter_count += self.inform_overseer_about_overlap(group, overlap_list, passed_list)
+                if not genome_wide_overlaps:
+                    overlap_list, passed_list = isolate_overlapping_predictions(self.group_by_contig_to_passed_prediction_list[group][contig])
+                    self.filter_count += self.inform_overseer_about_overlap(group, overlap_list, passed_list)
+        if genome_wide_overlaps:
+            self.filter_count += self.resolve_genome_wide_overlaps()
         return self.merged_regions - self.filter_count
 
+    def resolve_genome_wide_overlaps(self):
+        """overlap resolution of the passed predictions of all groups and contigs at once (--genome_wide_overlaps);
+        returns the number of removed predictions"""
+        pred_obj_list, pred_to_group = [], {}
+        for group in self.group_by_contig_to_passed_prediction_list:
+            for contig_pred_list in self.group_by_contig_to_passed_prediction_list[group].values():
+                pred_obj_list.extend(contig_pred_list)
+                pred_to_group.update({pred_obj: group for pred_obj in contig_pred_list})
+        overlap_list, passed_list = isolate_overlapping_predictions(pred_obj_list)
+        filtered = 0
+        for group in self.group_by_contig_to_passed_prediction_list:
+            filtered += self.inform_overseer_about_overlap(group, [pred_obj for pred_obj in overlap_list if pred_to_group[pred_obj] == group],
+                                                           [pred_obj for pred_obj in passed_list if pred_to_group[pred_obj] == group])
+        return filtered
+
     ####################################################################################################################
     # Overseer: write to files
     ####################################################################################################################
@@ -416,7 +710,7 @@ class Overseer:
             for contig in group_cluster_contig_prediction[group][cluster]:
                 for p_obj in group_cluster_contig_prediction[group][cluster][contig]:
                     fasta_header = ">{} geneID:{} Location:{};{}-{} HMM_score:{} Strand:{}".format(
-                        genome_prefix, p_obj.geneID, contig, str(p_obj.gene_start), str(p_obj.gene_end), str(round(p_obj.score, 3)), p_obj.strand)
+                        self.g_prefix, p_obj.geneID, contig, str(p_obj.gene_start), str(p_obj.gene_end), str(round(p_obj.score, 3)), p_obj.strand)
                     protein_dna_gff_array[0].extend([fasta_header, p_obj.protein])
                     protein_dna_gff_array[1].extend([fasta_header, p_obj.DNA])
                     protein_dna_gff_array[2].append("\n".join(p_obj.gff))
@@ -458,7 +752,8 @@ class Overseer:
             self.write_gff_for_augustus(group, self.group_by_cluster_by_contig_to_filtered_prediction, output_type="EXONERATE") #GK
             if keep:
                 with open(self.group_to_out_dir[group] + "_intermediate_exonerate.txt", "wb") as exo_file:
-                    for exof in self.exonerate_file_paths:
+                    for exof, region_list in self.exonerate_path_to_regions.items():
+                        exo_file.write("# GenePS regions: {}\n".format("; ".join(region_list)).encode())
                         with open(exof, "rb") as infile:
                             exo_file.write(infile.read())
         return written_valid_files, written_filtered_files
@@ -497,14 +792,17 @@ class Overseer:
 ########################################################################################################################
 
 
-def run_GenePS_on_single_genome(current_genome, genome_location, mode="exonerate"):
+def run_GenePS_on_single_genome(current_genome, genome_location, mode="exonerate", region_jobs=1):
     prediction_output = get_outdir(out_dir, add_dir=current_genome)
+    genome_tmp_dir = get_outdir(tmp_dir, add_dir=current_genome)
     overseer_obj = Overseer(current_genome, genome_location, prediction_output)
     overseer_obj.make_group_directories()
     if mode == "exonerate":
-        db_path = make_blast_db(genome_location, os.path.split(genome_location)[0])
-        amount_merged_regions = overseer_obj.blast_all_consensus(tmp_dir)
-        amount_valid_predictions = overseer_obj.get_exonerate_models(tmp_dir)
+        with tool_recorder.context(current_genome):
+            overseer_obj.db_path = make_blast_db(genome_location, db_cache)
+        get_genome_index(genome_location, overseer_obj.db_path)   # region sequences are sliced from the memory mapped genome
+        amount_merged_regions = overseer_obj.blast_all_consensus(genome_tmp_dir)
+        amount_valid_predictions = overseer_obj.get_exonerate_models(genome_tmp_dir, jobs=region_jobs)
     else:
         raise Exception("[!] unknown mode: {}".format(mode))
     written_valid, written_filtered = overseer_obj.write_output()
@@ -516,6 +814,56 @@ def run_GenePS_on_single_genome(current_genome, genome_location, mode="exonerate
         logging.error("number of Clusters written to files is not in line with the expectations")
         sys.exit()
 
+
+def analyse_genome(genome_path, genome_prefix, genome_count, region_jobs=1):
+    """runs GenePS on one genome and writes its summary.txt"""
+    logging.info("[{}] Analysing genome: {}\n".format(str(genome_count), genome_prefix))
+    group_summary, cluster_summary = run_GenePS_on_single_genome(genome_prefix, genome_path, mode="exonerate", region_jobs=region_jobs)
+    with open(os.path.join(out_dir, "{}/summary.txt".format(genome_prefix)), "w") as sum_file:
+        sum_file.write(group_summary)
+        sum_file.write("\n{}\n".format(100 * "-"))
+        sum_file.write(cluster_summary)
+
+
+def analyse_genome_worker(genome_item):
+    """worker function of the genome pool; the model library (data_base) is inherited from the main process.
+    Returns the genome, whether the run finished and the tool usage records of the run."""
+    genome_path, genome_prefix, genome_count = genome_item
+    tool_recorder.drain()   # records inherited from the main process
+    try:
+        analyse_genome(genome_path, genome_prefix, genome_count)
+    except SystemExit:
+        return genome_prefix, False, tool_recorder.drain()
+    except ToolCallError as error:
+        logging.error("{} ({})".format(error, genome_prefix))
+        return genome_prefix, False, tool_recorder.drain()
+    return genome_prefix, True, tool_recorder.drain()
+
+
+def analyse_all_genomes(genome_dict, genome_jobs=1):
+    """analyses all genomes one after another (regions in parallel with --jobs) or genome_jobs genomes at once.
+    All genomes share the thread budget of tool_scheduler."""
+    genome_items = [(genome_path, genome_prefix, genome_count) for genome_count, (genome_path, genome_prefix) in enumerate(genome_dict.items(), 1)]
+    if genome_jobs < 2 or len(genome_items) < 2:
+        for genome_path, genome_prefix, genome_count in genome_items:
+            analyse_genome(genome_path, genome_prefix, genome_count, region_jobs=jobs)
+        return
+    failed_genomes = []
+    log_queue, log_listener = start_log_listener()
+    try:
+        with get_process_pool(min(genome_jobs, len(genome_items)), initializer=init_worker_logging, initargs=(log_queue,)) as pool:
+            for genome_prefix, finished, tool_records in pool.imap_unordered(analyse_genome_worker, genome_items):
+                tool_recorder.records.extend(tool_records)
+                if finished:
+                    print("[+] Finished genome: {}".format(genome_prefix))
+                else:
+                    failed_genomes.append(genome_prefix)
+    finally:
+        log_listener.stop()
+    if failed_genomes:
+        print("\n[!] analysis failed for genome(s): {}\n".format(", ".join(failed_genomes)))
+        sys.exit()
+
 ###############
 # main function
 ###############
@@ -523,7 +871,6 @@ def run_GenePS_on_single_genome(current_genome, genome_location, mode="exonerate
 if __name__ == "__main__":
     __version__ = 0.1
     args = docopt(__doc__)
-    out_re = open("region.fasta", "w") #GK
 
     print("\n[+] Checking Arguments and Dependencies...")
     check_programs("tblastn", "makeblastdb", "exonerate")
@@ -547,12 +894,5 @@ if __name__ == "__main__":
     # run on all genomes
     ####################
     with tempdir() as tmp_dir:
-        genome_count = 1
-        for genome_path, genome_prefix in genome_dict.items():
-            logging.info("[{}] Analysing genome: {}\n".format(str(genome_count), genome_prefix))
-            group_summary, cluster_summary = run_GenePS_on_single_genome(genome_prefix, genome_path, mode="exonerate")
-            with open(os.path.join(out_dir, "{}/summary.txt".format(genome_prefix)), "w") as sum_file:
-                sum_file.write(group_summary)
-                sum_file.write("\n{}\n".format(100 * "-"))
-                sum_file.write(cluster_summary)
-            genome_count += 1
+        analyse_all_genomes(genome_dict, genome_jobs)
+    logging.info("# external tool usage: {}\n".format(tool_recorder.write_report(out_dir)))